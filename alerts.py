@@ -0,0 +1,244 @@
+import logging
+import re
+import threading
+
+from frame_change import hamming_distance
+
+
+# How alert rules are checked after a frame has been described:
+#   "combined"  - rules without a text pre-filter are answered in the description request itself;
+#                 the rest are checked afterwards in one text-only request
+#   "text_only" - one text-only request judges all surviving rules from the description
+#   "separate"  - one extra image request judges all surviving rules (the original behaviour)
+ALERT_MODES = ("combined", "text_only", "separate")
+
+VERDICT_PATTERN = re.compile(r'^[\s*]*ALERT\s*(\d*)\s*\**\s*:\s*\**\s*(YES|NO)\b.*$', re.IGNORECASE | re.MULTILINE)
+# The start of a verdict line, and a last line that may still grow into one while a response is streamed
+VERDICT_START_PATTERN = re.compile(r'^[\s*]*ALERT\s*\d*\s*\**\s*:', re.IGNORECASE | re.MULTILINE)
+PARTIAL_VERDICT_PATTERN = re.compile(r'[\s*]*(A(L(E(R(T\s*\d*\s*\**)?)?)?)?)?', re.IGNORECASE)
+ANSWER_PATTERN = re.compile(r'^\s*(\d+)\s*[:.)\-]\s*\**\s*(yes|no)\b', re.IGNORECASE | re.MULTILINE)
+
+
+class AlertRule:
+    """
+    A named alert condition. The optional pre-filters are checked locally before the rule costs
+    a model call:
+    - keywords: at least one must appear in the analysis text (case-insensitive)
+    - pattern: regular expression that must match the analysis text
+    - min_change: the frame must differ from the one this rule was last checked on by more than
+      this many bits of the change detector's hash
+    """
+
+    def __init__(self, name, condition, keywords=None, pattern=None, min_change=0, enabled=True):
+        self.name = name
+        self.condition = condition
+        self.keywords = [keyword.lower() for keyword in (keywords or []) if keyword]
+        self.pattern = re.compile(pattern, re.IGNORECASE) if pattern else None
+        self.min_change = min_change
+        self.enabled = enabled
+        self.last_checked_hash = None
+        # Counters for the rule's evaluation statistics
+        self.evaluations = 0
+        self.model_checks = 0
+        self.hits = 0
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], data.get("condition", data["name"]), keywords=data.get("keywords"),
+                   pattern=data.get("pattern"), min_change=data.get("min_change", 0),
+                   enabled=data.get("enabled", True))
+
+    @property
+    def has_text_filter(self):
+        return bool(self.keywords or self.pattern)
+
+    def passes_frame_filter(self, frame_hash):
+        if not self.min_change or frame_hash is None or self.last_checked_hash is None:
+            return True
+        return hamming_distance(frame_hash, self.last_checked_hash) > self.min_change
+
+    def passes_text_filter(self, analysis_text):
+        if self.keywords:
+            text = analysis_text.lower()
+            if not any(keyword in text for keyword in self.keywords):
+                return False
+        if self.pattern and not self.pattern.search(analysis_text):
+            return False
+        return True
+
+    def label(self):
+        return self.condition if self.name == self.condition else f"{self.name} ({self.condition})"
+
+    def stats_text(self):
+        hit_rate = self.hits / self.model_checks if self.model_checks else 0.0
+        return (f"{self.name}: evaluated {self.evaluations}, model checks {self.model_checks}, "
+                f"hits {self.hits} ({hit_rate:.0%} of checks)")
+
+
+class AlertEngine:
+    """
+    Holds the alert rules and decides, per frame, which of them need a model check.
+    Rules can be edited from the GUI thread while the analysis thread evaluates them.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = {}
+        self.lock = threading.Lock()
+        self.version = 0  # bumped on every change so cached decisions can be invalidated
+        self.frames_evaluated = 0
+        for rule in rules or []:
+            self.add_rule(rule)
+
+    @classmethod
+    def from_config(cls, rule_dicts):
+        rules = []
+        for data in rule_dicts:
+            try:
+                rules.append(AlertRule.from_dict(data))
+            except (KeyError, re.error) as e:
+                logging.error(f"Invalid alert rule {data!r}: {e}")
+        return cls(rules)
+
+    def add_rule(self, rule):
+        with self.lock:
+            self.rules[rule.name] = rule
+            self.version += 1
+
+    def remove_rule(self, name):
+        with self.lock:
+            removed = self.rules.pop(name, None)
+            self.version += 1
+            return removed
+
+    def clear(self):
+        with self.lock:
+            self.rules.clear()
+            self.version += 1
+
+    def active_rules(self):
+        with self.lock:
+            return [rule for rule in self.rules.values() if rule.enabled]
+
+    def has_active_rules(self):
+        return bool(self.active_rules())
+
+    def rules_before_description(self, frame_hash):
+        """
+        Rules that can be answered in the same request as the description: enabled, past the
+        frame-change gate and without a text pre-filter (which needs the description first).
+        """
+        return [rule for rule in self.active_rules()
+                if not rule.has_text_filter and rule.passes_frame_filter(frame_hash)]
+
+    def rules_after_description(self, analysis_text, frame_hash, exclude=()):
+        """
+        Run the local pre-filters and return the rules that still need a model check.
+        """
+        survivors = []
+        for rule in self.active_rules():
+            if rule in exclude:
+                continue
+            if rule.passes_frame_filter(frame_hash) and rule.passes_text_filter(analysis_text):
+                survivors.append(rule)
+        return survivors
+
+    def record(self, results, frame_hash):
+        """
+        Update statistics after a frame was evaluated.
+        :param results: {AlertRule: True/False} for every rule that was sent to the model
+        :return: Rules whose condition was met
+        """
+        triggered = []
+        with self.lock:
+            self.frames_evaluated += 1
+            for rule in self.rules.values():
+                if rule.enabled:
+                    rule.evaluations += 1
+            for rule, met in results.items():
+                rule.model_checks += 1
+                rule.last_checked_hash = frame_hash
+                if met:
+                    rule.hits += 1
+                    triggered.append(rule)
+            log_stats = self.frames_evaluated % 20 == 0
+        if results:
+            logging.info(f"Alert rules checked: {len(results)} of {len(self.active_rules())}, "
+                         f"triggered: {[rule.name for rule in triggered]}")
+        if log_stats:
+            logging.info("Alert rule statistics: " + "; ".join(self.stats()))
+        return triggered
+
+    def stats(self):
+        with self.lock:
+            return [rule.stats_text() for rule in self.rules.values()]
+
+
+def build_combined_prompt(prompt, rules):
+    conditions = "\n".join(f"{i}. {rule.condition}" for i, rule in enumerate(rules, 1))
+    return (f"{prompt}\n\n"
+            f"After your answer, add one final line per numbered condition below, exactly in the form "
+            f"'ALERT <number>: YES' if the condition is met in the image, otherwise 'ALERT <number>: NO'.\n"
+            f"Conditions:\n{conditions}")
+
+
+def split_verdicts(response, rules):
+    """
+    Separate the description from the verdict lines requested by build_combined_prompt.
+    :return: (description, {AlertRule: True/False} for the rules the model answered)
+    """
+    verdicts = {}
+    for match in VERDICT_PATTERN.finditer(response):
+        index = int(match.group(1)) if match.group(1) else 1
+        if 1 <= index <= len(rules):
+            verdicts[rules[index - 1]] = match.group(2).upper() == 'YES'
+    description = VERDICT_PATTERN.sub('', response).strip()
+    return description, verdicts
+
+
+def strip_partial_verdicts(text):
+    """
+    Remove the verdict lines from a combined response that is still being streamed.
+    They follow the description, so everything from the first one on is dropped.
+    """
+    match = VERDICT_START_PATTERN.search(text)
+    if match:
+        return text[:match.start()].strip()
+    head, _, last = text.rpartition('\n')
+    if PARTIAL_VERDICT_PATTERN.fullmatch(last):
+        return head.strip()
+    return text.strip()
+
+
+def build_text_check_prompt(rules, analysis_text):
+    conditions = "\n".join(f"{i}. {rule.condition}" for i, rule in enumerate(rules, 1))
+    return (f"Image description: {analysis_text}\n\n"
+            f"Based only on this description, decide for each numbered condition whether it is met. "
+            f"Answer with one line per condition in the form '1: Yes' or '1: No' and nothing else.\n"
+            f"{conditions}")
+
+
+def build_image_check_prompt(rules, analysis_text):
+    conditions = "\n".join(f"{i}. {rule.condition}" for i, rule in enumerate(rules, 1))
+    return (f"Based on the image and the following analysis, decide for each numbered condition whether it is met. "
+            f"Answer with one line per condition in the form '1: Yes' or '1: No' and nothing else.\n"
+            f"{conditions}\n\nImage analysis: {analysis_text}")
+
+
+def parse_answers(response, rules):
+    """
+    :return: {AlertRule: True/False}; rules the model did not answer count as not met
+    """
+    answers = {rule: False for rule in rules}
+    matches = list(ANSWER_PATTERN.finditer(response))
+    if not matches and len(rules) == 1:
+        answers[rules[0]] = parse_yes_no(response)
+        return answers
+    for match in matches:
+        index = int(match.group(1))
+        if 1 <= index <= len(rules):
+            answers[rules[index - 1]] = match.group(2).lower() == 'yes'
+    return answers
+
+
+def parse_yes_no(response):
+    return response.strip().strip('.!"\'').lower().startswith('yes')
@@ -0,0 +1,544 @@
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from PIL import Image
+
+from preprocess import encode_image_to_base64
+
+
+class BackendError(Exception):
+    pass
+
+
+class BackendUnavailableError(BackendError):
+    """Raised without contacting the server while its circuit breaker is open."""
+
+
+def image_to_base64(image):
+    # Frames from the pipeline arrive already encoded
+    if isinstance(image, str):
+        return image
+    return encode_image_to_base64(image)
+
+
+def images_to_base64(image):
+    """
+    :param image: One image or a list of images, each a PIL Image or base64 string
+    :return: List of base64 strings
+    """
+    if isinstance(image, (list, tuple)):
+        return [image_to_base64(item) for item in image]
+    return [image_to_base64(image)]
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a backend after failure_threshold consecutive failures. Once reset_timeout
+    seconds have passed a single trial request is let through; its outcome closes or re-opens the circuit.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning(f"Circuit opened after {self.failures} consecutive failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def retry_after(self):
+        with self.lock:
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+
+# The Interruption of the request each thread is sending, if it can be interrupted
+sending = threading.local()
+
+
+class Interruption:
+    """
+    The connection a thread is sending a request on. interrupt() shuts its socket down from another
+    thread, which ends the request at once, even while it still waits for the response headers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = None
+        self.interrupted = False
+
+    def use(self, connection):
+        """Called when the request takes a connection from the pool and again once it is connected."""
+        with self.lock:
+            self.connection = connection
+            if self.interrupted:
+                self.shutdown()
+
+    def interrupt(self):
+        with self.lock:
+            self.interrupted = True
+            self.shutdown()
+
+    def shutdown(self):
+        sock = self.connection.sock if self.connection is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class InterruptibleConnectionMixin:
+    def connect(self):
+        super().connect()
+        interruption = getattr(sending, 'interruption', None)
+        if interruption is not None:
+            interruption.use(self)
+
+    def request(self, *args, **kwargs):
+        interruption = getattr(sending, 'interruption', None)
+        if interruption is not None:
+            interruption.use(self)
+        return super().request(*args, **kwargs)
+
+
+class InterruptibleHTTPConnection(InterruptibleConnectionMixin, HTTPConnection):
+    pass
+
+
+class InterruptibleHTTPSConnection(InterruptibleConnectionMixin, HTTPSConnection):
+    pass
+
+
+class InterruptibleHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = InterruptibleHTTPConnection
+
+
+class InterruptibleHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = InterruptibleHTTPSConnection
+
+
+class InterruptibleAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections report to the Interruption of the thread sending on them."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": InterruptibleHTTPConnectionPool,
+                                                   "https": InterruptibleHTTPSConnectionPool}
+
+
+class BackendClient:
+    """
+    Base class for HTTP model backends. Keeps a pooled keep-alive session, applies separate
+    connect/read timeouts, retries transient failures with jittered exponential backoff and
+    guards the server with a circuit breaker.
+    """
+    name = None
+    health_path = "/"
+
+    def __init__(self, base_url, connect_timeout=5.0, read_timeout=180.0, max_retries=2, retry_backoff=0.5,
+                 failure_threshold=3, reset_timeout=30.0):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = requests.Session()
+        adapter = InterruptibleAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def settings_from_config(cls, config):
+        """
+        :return: Keyword arguments for the constructor from the settings dict, apart from the URL
+        """
+        return dict(connect_timeout=config["connect_timeout"],
+                    read_timeout=config["read_timeout"],
+                    max_retries=config["max_retries"],
+                    retry_backoff=config["retry_backoff"],
+                    failure_threshold=config["circuit_failure_threshold"],
+                    reset_timeout=config["circuit_reset_timeout"])
+
+    @classmethod
+    def from_config(cls, config, url_key):
+        return cls(config[url_key], **cls.settings_from_config(config))
+
+    def check_health(self):
+        """
+        Cheap GET that does not run the model. Does not affect the circuit breaker.
+        :return: True if the server answered
+        """
+        try:
+            response = self.session.get(self.base_url + self.health_path, timeout=(self.timeout[0], self.timeout[0]))
+        except requests.RequestException:
+            return False
+        response.close()
+        return response.status_code < 400
+
+    def post(self, path, payload, stream=False, cancel=None):
+        """
+        POST JSON to the backend with retries.
+        :param cancel: CancelToken; cancelling it shuts down the connection while the request is sent
+            or waits for the response headers, and no new attempt is made
+        :return: requests.Response with a 2xx status
+        :raises BackendError: When all attempts failed or the circuit is open
+        :raises GenerationCancelled: When the token was cancelled before the response headers arrived
+        """
+        if cancel is not None:
+            cancel.check()
+        if not self.breaker.allow_request():
+            raise BackendUnavailableError(
+                f"{self.name} backend is unavailable, retrying in {self.breaker.retry_after():.0f}s")
+
+        url = self.base_url + path
+        attempt = 0
+        while True:
+            try:
+                response = self.send(url, payload, stream, cancel)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # An interrupted request fails like a dropped connection
+                if cancel is not None:
+                    cancel.check()
+                error = e
+            else:
+                if response.status_code < 400:
+                    self.breaker.record_success()
+                    return response
+                error = f"HTTP {response.status_code} from {url}"
+                response.close()
+                if response.status_code < 500 and response.status_code != 429:
+                    # The server answered, so it is up; the request itself was rejected
+                    self.breaker.record_success()
+                    raise BackendError(f"Error communicating with {self.name}: {error}")
+
+            if attempt >= self.max_retries:
+                self.breaker.record_failure()
+                raise BackendError(f"Error communicating with {self.name}: {error}")
+            delay = random.uniform(0, self.retry_backoff * (2 ** attempt))
+            attempt += 1
+            logging.warning(f"{self.name} request failed ({error}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+            time.sleep(delay)
+            if cancel is not None:
+                cancel.check()
+
+    def send(self, url, payload, stream, cancel):
+        if cancel is None:
+            return self.session.post(url, json=payload, timeout=self.timeout, stream=stream)
+        # Servers send nothing until the prompt and images are processed, so waiting for the
+        # headers can take most of the request; the connection is shut down to stop that wait
+        interruption = sending.interruption = Interruption()
+        cancel.on_cancel(interruption.interrupt)
+        try:
+            return self.session.post(url, json=payload, timeout=self.timeout, stream=stream)
+        finally:
+            cancel.remove(interruption.interrupt)
+            sending.interruption = None
+
+    def read_stream(self, response, on_token, cancel=None):
+        """
+        Consume a streaming response line by line, passing each text chunk to on_token.
+        :param cancel: CancelToken; cancelling it closes the connection, which stops the generation
+        :return: The full generated text
+        :raises GenerationCancelled: When the token was cancelled before the stream ended
+        """
+        def close_stream():
+            # Unblocks a read waiting for the next line (urllib3 2.3+); older versions stop at the next line
+            shutdown = getattr(response.raw, 'shutdown', None)
+            if shutdown is not None:
+                shutdown()
+
+        if cancel is not None:
+            cancel.on_cancel(close_stream)
+        chunks = []
+        try:
+            with response:
+                for line in response.iter_lines():
+                    if cancel is not None:
+                        cancel.check()
+                    if not line:
+                        continue
+                    token, done = self.parse_stream_line(line.decode('utf-8'))
+                    if token:
+                        chunks.append(token)
+                        on_token(token)
+                    if done:
+                        break
+        except (requests.RequestException, OSError, ValueError) as e:
+            # A cancelled generation surfaces as a read error once close_stream() shut the socket
+            if cancel is not None:
+                cancel.check()
+            raise BackendError(f"{self.name} stream interrupted: {e}") from e
+        finally:
+            if cancel is not None:
+                cancel.remove(close_stream)
+        if cancel is not None:
+            # A stream cut short by shutdown() can end without an error
+            cancel.check()
+        return ''.join(chunks).strip()
+
+    def parse_stream_line(self, line):
+        """
+        :return: (text chunk, whether the generation is finished)
+        """
+        raise NotImplementedError
+
+    def analyze(self, image, prompt, model=None, on_token=None, cancel=None):
+        """
+        Describe an image. When on_token is given the response is streamed and on_token
+        is called with every text chunk as it arrives.
+        :param image: PIL Image or an already base64-encoded image string, or a list of them
+            to send several images in one request
+        :param cancel: CancelToken that aborts the generation on the server when cancelled
+        :raises GenerationCancelled: When the token was cancelled before the answer was complete
+        """
+        raise NotImplementedError
+
+    def generate_text(self, prompt, model=None, max_length=8):
+        """
+        Text-only completion without an image, limited to max_length tokens.
+        """
+        raise NotImplementedError
+
+    def warm_up(self, model=None):
+        """
+        Make the server load the model with the cheapest possible request.
+        """
+        self.generate_text("Hi", model, max_length=1)
+
+    def close(self):
+        self.session.close()
+
+
+class KoboldCPPClient(BackendClient):
+    name = "KoboldCPP"
+    generate_path = "/api/v1/generate"
+    stream_path = "/api/extra/generate/stream"
+    abort_path = "/api/extra/abort"
+    health_path = "/api/v1/model"
+
+    def build_payload(self, image_base64, prompt, max_length=100, genkey="KCPP4535"):
+        """
+        :param image_base64: Encoded image, list of encoded images, or None for a text-only request
+        :param genkey: Identifies the generation, so it can be aborted without touching other clients' requests
+        """
+        payload = {
+            "n": 1,
+            "max_context_length": 8192,
+            "max_length": max_length,
+            "rep_pen": 1.15,
+            "temperature": 0.3,
+            "top_p": 1,
+            "top_k": 0,
+            "top_a": 0,
+            "typical": 1,
+            "tfs": 1,
+            "rep_pen_range": 320,
+            "rep_pen_slope": 0.7,
+            "sampler_order": [6,0,1,3,4,2,5], #[6, 5, 0, 1, 3, 4, 2],
+            "memory": "<|start_header_id|>system<|end_header_id|>\n\n <｜begin_of_sentence｜>{prompt}\n\n",
+            "trim_stop": True,
+            "images": [image_base64],
+            "genkey": genkey,
+            "min_p": 0.1,
+            "dynatemp_range": 0,
+            "dynatemp_exponent": 1,
+            "smoothing_factor": 0,
+            "banned_tokens": [],
+            "render_special": False,
+            "presence_penalty": 0,
+            "logit_bias": {},
+            "prompt": f"\n(Attached Image)\n<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n",
+            "quiet": True,
+            "stop_sequence": ["<|eot_id|><|start_header_id|>user<|end_header_id|>", "<|eot_id|><|start_header_id|>assistant<|end_header_id|>"],
+            "use_default_badwordsids": False,
+            "bypass_eos": False
+        }
+        if image_base64 is None:
+            payload["images"] = []
+            payload["prompt"] = payload["prompt"].replace("\n(Attached Image)\n", "\n", 1)
+        elif isinstance(image_base64, list):
+            payload["images"] = image_base64
+            payload["prompt"] = payload["prompt"].replace("\n(Attached Image)\n",
+                                                          "\n" + "(Attached Image)\n" * len(image_base64), 1)
+        return payload
+
+    def analyze(self, image, prompt, model=None, on_token=None, cancel=None):
+        if image is None:
+            # Use a blank 1x1 pixel image when no image is provided
+            image = Image.new('RGB', (1, 1), color='white')
+        genkey = f"KCPP{uuid.uuid4().hex[:8]}"
+        if isinstance(image, (list, tuple)):
+            payload = self.build_payload(images_to_base64(image), prompt, genkey=genkey)
+        else:
+            payload = self.build_payload(image_to_base64(image), prompt, genkey=genkey)
+
+        if cancel is None:
+            if on_token is not None:
+                return self.read_stream(self.post(self.stream_path, payload, stream=True), on_token)
+            return self.read_result(self.post(self.generate_path, payload))
+
+        # The abort request is sent from its own thread so cancel() returns at once
+        def abort():
+            threading.Thread(target=self.abort, args=(genkey,), name="abort", daemon=True).start()
+
+        cancel.on_cancel(abort)
+        try:
+            if on_token is not None:
+                return self.read_stream(self.post(self.stream_path, payload, stream=True, cancel=cancel),
+                                        on_token, cancel)
+            text = self.read_result(self.post(self.generate_path, payload, cancel=cancel))
+            # An aborted generation still answers, with the text generated so far
+            cancel.check()
+            return text
+        finally:
+            cancel.remove(abort)
+
+    def abort(self, genkey):
+        """Stop the generation started with genkey; the server answers its request with the text so far."""
+        try:
+            response = self.session.post(self.base_url + self.abort_path, json={"genkey": genkey},
+                                         timeout=(self.timeout[0], self.timeout[0]))
+            response.close()
+            logging.info(f"Aborted {self.name} generation {genkey}")
+        except requests.RequestException as e:
+            logging.warning(f"Could not abort {self.name} generation {genkey}: {e}")
+
+    def generate_text(self, prompt, model=None, max_length=8):
+        payload = self.build_payload(None, prompt, max_length=max_length)
+        return self.read_result(self.post(self.generate_path, payload))
+
+    def read_result(self, response):
+        try:
+            return response.json()['results'][0]['text'].strip()
+        except (ValueError, KeyError, IndexError) as e:
+            raise BackendError(f"Unexpected response from {self.name}: {e}") from e
+
+    def parse_stream_line(self, line):
+        # Server-sent events: "event: message" followed by "data: {"token": ..., "finish_reason": ...}"
+        if not line.startswith('data:'):
+            return '', False
+        try:
+            data = json.loads(line[5:])
+        except ValueError as e:
+            raise BackendError(f"Unexpected stream event from {self.name}: {e}") from e
+        finish_reason = data.get('finish_reason')
+        return data.get('token', ''), finish_reason not in (None, '', 'null')
+
+
+class OllamaClient(BackendClient):
+    name = "Ollama"
+    generate_path = "/api/generate"
+    health_path = "/api/tags"
+
+    def __init__(self, base_url, keep_alive=None, **kwargs):
+        """
+        :param keep_alive: How long the server keeps the model loaded after a request, as Ollama's
+            keep_alive takes it ("30m", seconds, -1 for ever); None for the server's default
+        """
+        super().__init__(base_url, **kwargs)
+        self.keep_alive = keep_alive
+
+    @classmethod
+    def settings_from_config(cls, config):
+        return dict(super().settings_from_config(config), keep_alive=config["ollama_keep_alive"])
+
+    def build_payload(self, model, prompt, **fields):
+        payload = dict(model=model, prompt=prompt, **fields)
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+    def analyze(self, image, prompt, model="llava", on_token=None, cancel=None):
+        # Ollama stops generating when the client disconnects, so a cancellable request is always
+        # streamed: closing the connection is how it is aborted, before or after the first chunk
+        stream = on_token is not None or cancel is not None
+        payload = self.build_payload(model, prompt, stream=stream, images=images_to_base64(image))
+
+        if stream:
+            return self.read_stream(self.post(self.generate_path, payload, stream=True, cancel=cancel),
+                                    on_token or (lambda token: None), cancel)
+
+        return self.read_result(self.post(self.generate_path, payload))
+
+    def generate_text(self, prompt, model="llava", max_length=8):
+        payload = self.build_payload(model, prompt, stream=False, options={"num_predict": max_length})
+        return self.read_result(self.post(self.generate_path, payload))
+
+    def warm_up(self, model="llava"):
+        # A request without a prompt only loads the model (and applies keep_alive)
+        payload = {"model": model}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        response = self.post(self.generate_path, payload)
+        try:
+            load_duration = response.json().get('load_duration')
+        except ValueError:
+            load_duration = None
+        if load_duration:
+            logging.info(f"{self.name} loaded {model} in {load_duration / 1e9:.2f}s")
+
+    def read_result(self, response):
+        try:
+            return response.json().get('response', '').strip()
+        except ValueError as e:
+            raise BackendError(f"Unexpected response from {self.name}: {e}") from e
+
+    def parse_stream_line(self, line):
+        # Newline-delimited JSON objects, the last one has "done": true
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            raise BackendError(f"Unexpected stream line from {self.name}: {e}") from e
+        if 'error' in data:
+            raise BackendError(f"{self.name} error: {data['error']}")
+        return data.get('response', ''), data.get('done', False)
+
+
+def create_backend_client(backend, config):
+    """
+    :param backend: "koboldcpp", "ollama" or "pool" (the servers in backend_endpoints)
+    :param config: Settings dict from config.load_config()
+    """
+    if backend == "pool":
+        # Imported here because backend_pool builds on this module
+        from backend_pool import BackendPool
+        return BackendPool.from_config(config)
+    if backend == "koboldcpp":
+        return KoboldCPPClient.from_config(config, "koboldcpp_url")
+    if backend == "ollama":
+        return OllamaClient.from_config(config, "ollama_url")
+    raise ValueError(f"Unknown backend: {backend}")
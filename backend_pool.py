@@ -0,0 +1,301 @@
+import collections
+import logging
+import threading
+import time
+
+from backend_client import (BackendError, BackendUnavailableError, CircuitBreaker, KoboldCPPClient, OllamaClient,
+                            image_to_base64, images_to_base64)
+from cancellation import GenerationCancelled
+
+
+ENDPOINT_CLIENTS = {"koboldcpp": KoboldCPPClient, "ollama": OllamaClient}
+
+# "least_loaded" sends each request to the endpoint with the fewest requests in flight per unit of
+# weight; "latency" to the one expected to finish it first, given its recent latency and queue
+POOL_POLICIES = ("least_loaded", "latency")
+
+
+class Endpoint:
+    """
+    One server in a BackendPool with its load and statistics. Only changed under the pool's lock.
+    :param model: Ollama model for this server; the model of the request is used when None
+    :param weight: Relative capacity; an endpoint with weight 2 gets twice the requests of one with weight 1
+    :param max_in_flight: Requests sent to this server at the same time, at most
+    """
+    LATENCY_SMOOTHING = 0.3  # weight of the newest sample in the moving average
+
+    def __init__(self, backend, client, model=None, weight=1.0, max_in_flight=2):
+        self.backend = backend
+        self.client = client
+        self.model = model
+        self.weight = max(weight, 1e-3)
+        self.max_in_flight = max(1, max_in_flight)
+        self.healthy = True
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.latency = None  # moving average of successful request times, seconds
+        self.latencies = collections.deque(maxlen=100)
+        self.completed_at = collections.deque()  # monotonic times of the successes in the last minute
+
+    @property
+    def url(self):
+        return self.client.base_url
+
+    def usable(self):
+        breaker = self.client.breaker
+        return breaker.state != CircuitBreaker.OPEN or breaker.retry_after() == 0
+
+    def record(self, elapsed, ok, now):
+        """
+        :param ok: Whether the request succeeded; None for a cancelled one, which is not counted
+        """
+        self.in_flight -= 1
+        if ok is None:
+            return
+        self.requests += 1
+        if not ok:
+            self.failures += 1
+            return
+        self.latencies.append(elapsed)
+        self.latency = elapsed if self.latency is None else \
+            self.latency + self.LATENCY_SMOOTHING * (elapsed - self.latency)
+        self.completed_at.append(now)
+
+    def stats(self, now):
+        while self.completed_at and self.completed_at[0] < now - 60:
+            self.completed_at.popleft()
+        latencies = sorted(self.latencies)
+        return {
+            "backend": self.backend,
+            "url": self.url,
+            "healthy": self.healthy and self.usable(),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "requests_per_minute": len(self.completed_at),
+            "latency": self.latency,
+            "p50": latencies[len(latencies) // 2] if latencies else None,
+            "p95": latencies[int(len(latencies) * 0.95)] if latencies else None,
+        }
+
+
+def format_endpoint_stats(stats):
+    def ms(value):
+        return f"{value * 1000:.0f}ms" if value is not None else "-"
+    return (f"{stats['backend']} {stats['url']}: {'up' if stats['healthy'] else 'DOWN'}, "
+            f"{stats['in_flight']} in flight, {stats['requests']} requests ({stats['failures']} failed), "
+            f"{stats['requests_per_minute']}/min, latency {ms(stats['latency'])} "
+            f"(p50 {ms(stats['p50'])}, p95 {ms(stats['p95'])})")
+
+
+class BackendPool:
+    """
+    Spreads requests over several KoboldCPP and Ollama servers. Has the interface of a BackendClient.
+
+    Every request goes to the best usable endpoint under the pool's policy; endpoints that reached
+    max_in_flight are skipped, and the caller waits when all of them are busy. When a request fails
+    it is sent to the next endpoint, until each has been tried once. A streamed request is only
+    moved while no text has been passed to on_token yet. An endpoint is skipped while its circuit
+    breaker is open or its last health check failed; with health_interval set, a background thread
+    checks every endpoint that often and logs the statistics every stats_interval seconds.
+    """
+    name = "Backend pool"
+
+    def __init__(self, endpoints, policy="least_loaded", health_interval=10.0, stats_interval=300.0):
+        """
+        :param endpoints: List of Endpoint
+        """
+        if not endpoints:
+            raise ValueError("A backend pool needs at least one endpoint")
+        if policy not in POOL_POLICIES:
+            raise ValueError(f"Unknown pool policy: {policy}")
+        self.endpoints = endpoints
+        self.policy = policy
+        self.stats_interval = stats_interval
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.health_thread = None
+        if health_interval:
+            self.health_thread = threading.Thread(target=self.health_loop, args=(health_interval,),
+                                                  name="backend-health", daemon=True)
+            self.health_thread.start()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Endpoints come from backend_endpoints: dicts with "backend" ("koboldcpp" or "ollama"), "url"
+        and optionally "model", "weight" and "max_in_flight". The other client settings are shared.
+        """
+        endpoints = []
+        for spec in config["backend_endpoints"]:
+            client_class = ENDPOINT_CLIENTS.get(spec.get("backend"))
+            if client_class is None:
+                raise ValueError(f"Unknown backend in backend_endpoints: {spec.get('backend')}")
+            endpoints.append(Endpoint(spec["backend"], client_class(spec["url"], **client_class.settings_from_config(config)),
+                                      model=spec.get("model"), weight=spec.get("weight", 1.0),
+                                      max_in_flight=spec.get("max_in_flight", config["pool_max_in_flight"])))
+        return cls(endpoints, policy=config["pool_policy"], health_interval=config["pool_health_interval"],
+                   stats_interval=config["pool_stats_interval"])
+
+    def score(self, endpoint):
+        """Lower is better."""
+        latency = endpoint.latency or 0.0  # endpoints without a measurement are tried early
+        if self.policy == "latency":
+            return (endpoint.in_flight + 1) * latency / endpoint.weight, endpoint.in_flight
+        return endpoint.in_flight / endpoint.weight, latency
+
+    def acquire(self, tried, cancel=None):
+        """
+        Reserve the best endpoint that has not been tried for this request, waiting while all are busy.
+        :param cancel: CancelToken; cancelling it ends the wait
+        :return: Endpoint, or None when no endpoint is left to try
+        :raises GenerationCancelled: When the token was cancelled before an endpoint was free
+        """
+        def wake():
+            with self.condition:
+                self.condition.notify_all()
+
+        if cancel is not None:
+            cancel.on_cancel(wake)
+        try:
+            return self._acquire(tried, cancel)
+        finally:
+            if cancel is not None:
+                cancel.remove(wake)
+
+    def _acquire(self, tried, cancel):
+        with self.condition:
+            while True:
+                if cancel is not None:
+                    cancel.check()
+                candidates = [endpoint for endpoint in self.endpoints
+                              if endpoint not in tried and endpoint.usable()]
+                # Health checks can be stale; unhealthy endpoints are still tried when nothing else is left
+                healthy = [endpoint for endpoint in candidates if endpoint.healthy]
+                candidates = healthy or candidates
+                if not candidates:
+                    return None
+                free = [endpoint for endpoint in candidates if endpoint.in_flight < endpoint.max_in_flight]
+                if free:
+                    endpoint = min(free, key=self.score)
+                    endpoint.in_flight += 1
+                    return endpoint
+                self.condition.wait(1.0)
+
+    def release(self, endpoint, elapsed, ok):
+        with self.condition:
+            endpoint.record(elapsed, ok, time.monotonic())
+            self.condition.notify()
+
+    def dispatch(self, request, can_fail_over=lambda: True, cancel=None):
+        """
+        :param request: Called with the chosen Endpoint, returns the result
+        :param can_fail_over: Whether a failed request may still be sent to another endpoint
+        :param cancel: CancelToken of the request, checked while waiting for a free endpoint
+        """
+        tried = []
+        error = None
+        while True:
+            endpoint = self.acquire(tried, cancel)
+            if endpoint is None:
+                break
+            tried.append(endpoint)
+            start_time = time.monotonic()
+            try:
+                result = request(endpoint)
+            except BackendError as e:
+                self.release(endpoint, time.monotonic() - start_time, False)
+                error = e
+                if not can_fail_over():
+                    raise
+                logging.warning(f"Request to {endpoint.url} failed ({e}), trying another endpoint")
+                continue
+            except GenerationCancelled:
+                self.release(endpoint, time.monotonic() - start_time, None)
+                raise
+            except Exception:
+                self.release(endpoint, time.monotonic() - start_time, False)
+                raise
+            self.release(endpoint, time.monotonic() - start_time, True)
+            return result
+        if error is not None:
+            raise error
+        raise BackendUnavailableError("No backend endpoint is available")
+
+    def analyze(self, image, prompt, model=None, on_token=None, cancel=None):
+        # Encode once for all attempts
+        image = images_to_base64(image) if isinstance(image, (list, tuple)) else \
+            image_to_base64(image) if image is not None else None
+        streamed = []
+
+        def request(endpoint):
+            tokens = None
+            if on_token is not None:
+                def tokens(token):
+                    streamed.append(True)
+                    on_token(token)
+            return endpoint.client.analyze(image, prompt, endpoint.model or model, on_token=tokens, cancel=cancel)
+
+        return self.dispatch(request, can_fail_over=lambda: not streamed, cancel=cancel)
+
+    def generate_text(self, prompt, model=None, max_length=8):
+        return self.dispatch(lambda endpoint: endpoint.client.generate_text(prompt, endpoint.model or model,
+                                                                             max_length=max_length))
+
+    def warm_up(self, model=None):
+        """Load the model on every reachable endpoint, in parallel."""
+        def warm(endpoint):
+            try:
+                endpoint.client.warm_up(endpoint.model or model)
+            except BackendError as e:
+                logging.warning(f"Warm-up of {endpoint.url} failed: {e}")
+
+        threads = [threading.Thread(target=warm, args=(endpoint,), name="warm-up", daemon=True)
+                   for endpoint in self.endpoints if endpoint.usable()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stats(self):
+        """
+        :return: One dict per endpoint with backend, url, healthy, in_flight, requests, failures,
+            requests_per_minute (successes in the last minute), and latency (moving average), p50 and p95
+            over the last 100 successes in seconds, None before the first success
+        """
+        now = time.monotonic()
+        with self.condition:
+            return [endpoint.stats(now) for endpoint in self.endpoints]
+
+    def log_stats(self):
+        for stats in self.stats():
+            logging.info(f"Backend pool: {format_endpoint_stats(stats)}")
+
+    def check_health(self):
+        for endpoint in self.endpoints:
+            healthy = endpoint.client.check_health()
+            if healthy != endpoint.healthy:
+                if healthy:
+                    logging.info(f"Backend endpoint {endpoint.url} is reachable again")
+                else:
+                    logging.warning(f"Backend endpoint {endpoint.url} failed its health check")
+            with self.condition:
+                endpoint.healthy = healthy
+                self.condition.notify_all()
+
+    def health_loop(self, interval):
+        last_stats = time.monotonic()
+        while not self.stop_event.wait(interval):
+            self.check_health()
+            if self.stats_interval and time.monotonic() - last_stats >= self.stats_interval:
+                last_stats = time.monotonic()
+                self.log_stats()
+
+    def close(self):
+        self.stop_event.set()
+        if self.health_thread is not None:
+            self.health_thread.join()
+        self.log_stats()
+        for endpoint in self.endpoints:
+            endpoint.client.close()
@@ -0,0 +1,326 @@
+"""
+Re-analyze saved captures with a new prompt.
+
+    python -m batch --prompt "List every open window" [PATH_OR_GLOB ...] [--archive]
+                    [--start 2026-10-01T00:00] [--end 2026-10-02T00:00] [--concurrency 4] [--run NAME]
+
+Sources are screenshot files (directories, files or glob patterns) and, with --archive, the frame
+archive. Without any source, saved_screenshots/ and the archive (when frame_storage is "archive") are
+used. Results are saved to the history database with the capture time of each frame. Progress is
+recorded per run; running the same command again skips the frames that were already finished.
+"""
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from PIL import Image
+
+from config import CONFIG_PATH, load_config
+from frame_archive import FrameArchive, read_frame
+from history import HistoryManager
+from preprocess import PreprocessSettings, resize_image, encode_image_to_base64
+
+
+SCREENSHOT_NAME_PATTERN = re.compile(r'screenshot_(\d{8}_\d{6})(?:_(\d{3}))?\.png$')
+
+
+class BatchFrame:
+    """
+    A saved capture to analyze.
+    :param key: Identifies the frame in the run's progress records: the file path or "frame:<archive id>"
+    :param source: File path, or the FrameArchive location tuple for read_frame()
+    """
+
+    def __init__(self, key, captured_at, source, frame_id=None):
+        self.key = key
+        self.captured_at = captured_at
+        self.source = source
+        self.frame_id = frame_id
+
+
+def screenshot_time(path):
+    match = SCREENSHOT_NAME_PATTERN.search(os.path.basename(path))
+    if match:
+        captured_at = datetime.strptime(match.group(1), "%Y%m%d_%H%M%S")
+        return captured_at.replace(microsecond=int(match.group(2) or 0) * 1000)
+    return datetime.fromtimestamp(os.path.getmtime(path))
+
+
+def find_screenshots(patterns, start=None, end=None):
+    """
+    :param patterns: Directories (all screenshot_*.png inside), files or glob patterns
+    :param start: Only frames captured at or after this datetime
+    :param end: Only frames captured at or before this datetime
+    :return: List of BatchFrame, oldest first
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "screenshot_*.png")
+        paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    frames = []
+    for path in paths:
+        captured_at = screenshot_time(path)
+        if (start is None or captured_at >= start) and (end is None or captured_at <= end):
+            path = os.path.abspath(path)
+            frames.append(BatchFrame(path, captured_at, path))
+    frames.sort(key=lambda frame: frame.captured_at)
+    return frames
+
+
+def find_archived_frames(archive, start=None, end=None):
+    """
+    :param archive: FrameArchive
+    :return: List of BatchFrame, oldest first
+    """
+    return [BatchFrame(f"frame:{frame_id}", datetime.fromtimestamp(captured_at), location, frame_id)
+            for frame_id, captured_at, location in archive.frame_locations(start, end)]
+
+
+def prepare_frame(source, settings):
+    """
+    Load, resize and encode one frame. Runs in a worker process.
+    :return: Base64 payload, or None for a blank frame
+    """
+    if isinstance(source, str):
+        with Image.open(source) as image:
+            image = image.convert('RGB')
+    else:
+        image = read_frame(*source)
+    image = resize_image(image, settings)
+    if image.getbbox() is None:
+        return None
+    return encode_image_to_base64(image, settings)
+
+
+def ignore_interrupts():
+    # Ctrl+C reaches the whole process group; only the main process should react to it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def default_run_name(prompt, backend, model):
+    """Runs with the same prompt, backend and model share progress, so repeating a command resumes it."""
+    return hashlib.sha1(f"{prompt}\0{backend}\0{model or ''}".encode('utf-8')).hexdigest()[:12]
+
+
+class BatchAnalyzer:
+    """
+    Analyzes saved frames with up to `concurrency` requests in flight to the backend.
+
+    Frames are decoded, resized and encoded on a process pool. Each request thread prepares its next
+    frame while waiting for the model's answer on the current one. Results are written to the history
+    database `write_batch_size` at a time, together with the run's progress records. A frame that
+    failed is not recorded, so it is retried when the run is repeated.
+    """
+
+    def __init__(self, history_manager, config, prompt, run=None, concurrency=2, processes=None,
+                 write_batch_size=50, settings=None):
+        """
+        :param config: Settings dict from config.load_config(); backend, ollama_model and the client settings are used
+        :param run: Name under which progress is recorded; derived from prompt, backend and model when None
+        """
+        self.history_manager = history_manager
+        self.config = config
+        self.prompt = prompt
+        self.backend = config["backend"]
+        self.model = config["ollama_model"] if self.backend in ("ollama", "pool") else None
+        self.run_name = run or default_run_name(prompt, self.backend, self.model)
+        self.concurrency = max(1, concurrency)
+        self.processes = processes
+        self.write_batch_size = write_batch_size
+        self.settings = settings or PreprocessSettings.from_config(config)
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.pending_results = []
+        self.analyzed = 0
+        self.blank = 0
+        self.failed = 0
+
+    def cancel(self):
+        """Stop taking new frames; requests in flight finish and their results are saved."""
+        self.cancel_event.set()
+
+    def run(self, frames, progress=None):
+        """
+        :param frames: BatchFrames to analyze
+        :param progress: Called as progress(finished, total) after every frame
+        :return: (analyzed, skipped as already finished, failed)
+        """
+        finished = self.history_manager.batch_progress(self.run_name)
+        todo = [frame for frame in frames if frame.key not in finished]
+        skipped = len(frames) - len(todo)
+        logging.info(f"Batch run {self.run_name}: {len(todo)} frames to analyze, {skipped} already finished")
+        frame_iter = iter(todo)
+        total = len(todo)
+
+        def next_frame():
+            if self.cancel_event.is_set():
+                return None
+            with self.lock:
+                return next(frame_iter, None)
+
+        # Imported here so listing frames does not wait for requests
+        from backend_client import BackendUnavailableError, create_backend_client
+        # A backend pool balances the load over its servers only when all threads share it
+        shared_client = create_backend_client(self.backend, self.config) if self.backend == "pool" else None
+
+        def request_loop(pool):
+            client = shared_client or create_backend_client(self.backend, self.config)
+            try:
+                frame = next_frame()
+                prepared = pool.submit(prepare_frame, frame.source, self.settings) if frame else None
+                while frame is not None:
+                    current, current_prepared = frame, prepared
+                    # Start preparing the next frame before waiting for the model
+                    frame = next_frame()
+                    prepared = pool.submit(prepare_frame, frame.source, self.settings) if frame else None
+                    try:
+                        image_base64 = current_prepared.result()
+                        text = None
+                        if image_base64 is not None:
+                            text = client.analyze(image_base64, self.prompt, self.model)
+                    except BackendUnavailableError as e:
+                        logging.error(f"Stopping batch run {self.run_name}: {e}")
+                        with self.lock:
+                            self.failed += 1
+                        self.cancel()
+                        break
+                    except Exception as e:
+                        logging.error(f"Batch analysis of {current.key} failed: {e}")
+                        with self.lock:
+                            self.failed += 1
+                        continue
+                    self.add_result(current, text)
+                    if progress is not None:
+                        progress(self.analyzed + self.blank + self.failed, total)
+            finally:
+                if client is not shared_client:
+                    client.close()
+
+        with ProcessPoolExecutor(max_workers=self.processes, initializer=ignore_interrupts) as pool:
+            threads = [threading.Thread(target=request_loop, args=(pool,), name=f"batch-{i}", daemon=True)
+                       for i in range(self.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if shared_client is not None:
+            shared_client.close()
+        self.write_results()
+        self.history_manager.flush()
+        return self.analyzed, skipped, self.failed
+
+    def add_result(self, frame, text):
+        with self.lock:
+            if text is None:
+                self.blank += 1
+            else:
+                self.analyzed += 1
+            self.pending_results.append((frame.key, frame.captured_at.isoformat(), text, self.prompt, frame.frame_id))
+            if len(self.pending_results) < self.write_batch_size:
+                return
+            results, self.pending_results = self.pending_results, []
+        self.history_manager.add_batch_results(self.run_name, results)
+
+    def write_results(self):
+        with self.lock:
+            results, self.pending_results = self.pending_results, []
+        if results:
+            self.history_manager.add_batch_results(self.run_name, results)
+
+
+def parse_time(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an ISO date/time: {value!r}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="*", help="screenshot directories, files or glob patterns")
+    parser.add_argument("--prompt", required=True, help="prompt to analyze the frames with")
+    parser.add_argument("--archive", action="store_true", help="also analyze frames from the frame archive")
+    parser.add_argument("--start", type=parse_time, help="only frames captured at or after this time")
+    parser.add_argument("--end", type=parse_time, help="only frames captured at or before this time")
+    parser.add_argument("--config", default=CONFIG_PATH, help="JSON settings file (default: %(default)s)")
+    parser.add_argument("--backend", choices=["koboldcpp", "ollama", "pool"], help="overrides backend")
+    parser.add_argument("--model", help="Ollama model, overrides ollama_model")
+    parser.add_argument("--concurrency", type=int, help="requests in flight (default: batch_concurrency)")
+    parser.add_argument("--processes", type=int, help="preprocessing processes (default: batch_processes)")
+    parser.add_argument("--run", help="progress name; the default is derived from prompt, backend and model")
+    parser.add_argument("--restart", action="store_true", help="forget the run's progress and start over")
+    parser.add_argument("--log-file", default="app.log", help="log file, '-' for stderr (default: %(default)s)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(filename=None if args.log_file == "-" else args.log_file, level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    config = load_config(args.config)
+    if args.backend:
+        config["backend"] = args.backend
+    if args.model:
+        config["ollama_model"] = args.model
+
+    history_manager = HistoryManager(batch_size=config["history_batch_size"],
+                                     commit_interval=config["history_commit_interval"])
+    sources = args.sources
+    use_archive = args.archive or (not sources and config["frame_storage"] == "archive")
+    if not sources and not args.archive:
+        sources = ["saved_screenshots"]
+    frames = find_screenshots(sources, args.start, args.end)
+    if use_archive and os.path.isdir(config["archive_dir"]):
+        archive = FrameArchive.from_config(config, history_manager.db_path)
+        try:
+            frames += find_archived_frames(archive, args.start, args.end)
+        finally:
+            archive.close()
+    frames.sort(key=lambda frame: frame.captured_at)
+
+    analyzer = BatchAnalyzer(history_manager, config, args.prompt, run=args.run,
+                             concurrency=args.concurrency or config["batch_concurrency"],
+                             processes=args.processes or config["batch_processes"],
+                             write_batch_size=config["batch_write_size"])
+    if args.restart:
+        history_manager.reset_batch_progress(analyzer.run_name)
+        history_manager.flush()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: analyzer.cancel())
+
+    start_time = time.monotonic()
+    last_report = [0.0]
+
+    def progress(finished, total):
+        now = time.monotonic()
+        if now - last_report[0] >= 1.0 or finished == total:
+            last_report[0] = now
+            rate = finished / max(now - start_time, 1e-6)
+            print(f"\r{finished}/{total} frames, {analyzer.failed} failed, {rate:.2f} frames/s",
+                  end="", file=sys.stderr, flush=True)
+
+    print(f"Run {analyzer.run_name}: {len(frames)} frames found", file=sys.stderr)
+    try:
+        analyzed, skipped, failed = analyzer.run(frames, progress)
+    finally:
+        history_manager.close()
+    print(f"\nAnalyzed {analyzed} frames ({analyzer.blank} blank, {skipped} already done, {failed} failed) "
+          f"in {time.monotonic() - start_time:.1f}s", file=sys.stderr)
+    if analyzer.cancel_event.is_set():
+        print(f"Interrupted; run the same command again to resume run {analyzer.run_name}", file=sys.stderr)
+        return 1
+    return 0 if not failed else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
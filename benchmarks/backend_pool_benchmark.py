@@ -0,0 +1,155 @@
+"""
+Benchmark the backend pool against local stub servers: request distribution, failover and throughput.
+
+    python benchmarks/backend_pool_benchmark.py [--requests 200] [--concurrency 8]
+                                                [--servers koboldcpp:0.05 ollama:0.2 koboldcpp:0.1:0.2 down]
+
+Each server is BACKEND:LATENCY[:FAILURE_RATE]; the stubs answer the generate, streaming and health
+endpoints of KoboldCPP and Ollama after LATENCY seconds, and with HTTP 500 for the given share of
+requests. "down" is a KoboldCPP endpoint on a port nobody listens on. Every policy sends the same
+requests from `concurrency` threads; the per-endpoint statistics of the pool are printed afterwards.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend_client import BackendError  # noqa: E402
+from backend_pool import POOL_POLICIES, BackendPool, format_endpoint_stats  # noqa: E402
+from config import DEFAULT_CONFIG  # noqa: E402
+
+
+def stub_handler(latency, failure_rate):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        wbufsize = -1  # headers and body in one write; split writes add a delayed-ACK wait to every request
+
+        def send_body(self, status, body, content_type="application/json"):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/api/v1/model":
+                self.send_body(200, json.dumps({"result": "stub"}))
+            elif self.path == "/api/tags":
+                self.send_body(200, json.dumps({"models": []}))
+            else:
+                self.send_body(404, "{}")
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            time.sleep(latency)
+            if random.random() < failure_rate:
+                self.send_body(500, "{}")
+                return
+            text = f"described by port {self.server.server_port}"
+            if self.path == "/api/v1/generate":
+                self.send_body(200, json.dumps({"results": [{"text": text}]}))
+            elif self.path == "/api/extra/generate/stream":
+                self.send_body(200, f'data: {json.dumps({"token": text, "finish_reason": "stop"})}\n\n',
+                               "text/event-stream")
+            elif self.path == "/api/generate":
+                if payload.get("stream"):
+                    self.send_body(200, json.dumps({"response": text, "done": True}) + "\n", "application/x-ndjson")
+                else:
+                    self.send_body(200, json.dumps({"response": text, "done": True}))
+            else:
+                self.send_body(404, "{}")
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stubs(specs):
+    """
+    :return: (servers to shut down, backend_endpoints list)
+    """
+    servers = []
+    endpoints = []
+    for spec in specs:
+        if spec == "down":
+            endpoints.append({"backend": "koboldcpp", "url": f"http://127.0.0.1:{unused_port()}"})
+            continue
+        backend, latency, *rest = spec.split(":")
+        server = ThreadingHTTPServer(("127.0.0.1", 0), stub_handler(float(latency), float(rest[0]) if rest else 0.0))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        endpoints.append({"backend": backend, "url": f"http://127.0.0.1:{server.server_port}", "model": "stub"})
+    return servers, endpoints
+
+
+def run_policy(config, policy, requests, concurrency, stream):
+    config = dict(config, pool_policy=policy)
+    pool = BackendPool.from_config(config)
+    remaining = iter(range(requests))
+    lock = threading.Lock()
+    failed = []
+
+    def worker():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            try:
+                pool.analyze("aW1hZ2U=", "describe the image", "stub", on_token=(lambda token: None) if stream else None)
+            except BackendError:
+                with lock:
+                    failed.append(1)
+
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    print(f"{policy}: {requests} requests in {elapsed:.2f}s ({requests / elapsed:.1f}/s), {len(failed)} failed")
+    for stats in pool.stats():
+        print(f"    {format_endpoint_stats(stats)}")
+    pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--servers", nargs="+", default=["koboldcpp:0.05", "ollama:0.2", "koboldcpp:0.1:0.2", "down"])
+    parser.add_argument("--stream", action="store_true", help="use the streaming endpoints")
+    parser.add_argument("--verbose", action="store_true", help="show the pool's failover warnings")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR, format='%(message)s')
+
+    servers, endpoints = start_stubs(args.servers)
+    config = dict(DEFAULT_CONFIG, backend_endpoints=endpoints, pool_health_interval=1.0, pool_stats_interval=0,
+                  connect_timeout=0.5, max_retries=0)
+    try:
+        for policy in POOL_POLICIES:
+            run_policy(config, policy, args.requests, args.concurrency, args.stream)
+    finally:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark screen capture backends: grab latency and CPU time per backend and region size.
+
+    xvfb-run -a -s "-screen 0 1920x1080x24" python benchmarks/capture_benchmark.py [--repeat 30]
+
+Runs against the X display in $DISPLAY, so it also works on a real desktop. Each backend grabs every
+region size `repeat` times after a warm-up grab; the median and 95th percentile latency are reported
+together with the CPU time this process spent per grab. Work done inside the X server is not part of
+the CPU column, only of the latency.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capture import CAPTURE_BACKENDS, CaptureError  # noqa: E402
+
+
+REGION_SIZES = ["320x240", "800x600", "1280x720", "full"]
+
+
+def region_box(size, screen_size):
+    if size == "full":
+        return None
+    width, height = (int(value) for value in size.split("x"))
+    return 0, 0, min(width, screen_size[0]), min(height, screen_size[1])
+
+
+def measure(backend, bbox, repeat):
+    backend.grab(bbox)  # warm-up: shared memory segments, lazy imports
+    latencies, cpu_times = [], []
+    for _ in range(repeat):
+        start, start_cpu = time.perf_counter(), time.process_time()
+        image = backend.grab(bbox)
+        latencies.append(time.perf_counter() - start)
+        cpu_times.append(time.process_time() - start_cpu)
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return statistics.median(latencies), p95, statistics.mean(cpu_times), image.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=30, help="grabs per backend and region size")
+    parser.add_argument("--backends", nargs="+", default=list(CAPTURE_BACKENDS), choices=list(CAPTURE_BACKENDS))
+    parser.add_argument("--sizes", nargs="+", default=REGION_SIZES, help="WIDTHxHEIGHT or 'full'")
+    args = parser.parse_args()
+
+    print(f"Display {os.environ.get('DISPLAY')!r}, {args.repeat} grabs per row")
+    print(f"{'backend':<10} {'region':>10} {'median ms':>10} {'p95 ms':>8} {'cpu ms':>8} {'MB/s':>8}")
+    for name in args.backends:
+        backend_class = CAPTURE_BACKENDS[name]
+        if not backend_class.available():
+            print(f"{name:<10} not available")
+            continue
+        try:
+            backend = backend_class()
+            screen_size = backend.grab().size
+        except (CaptureError, OSError) as e:
+            print(f"{name:<10} failed to start: {e}")
+            continue
+        try:
+            for size in args.sizes:
+                median, p95, cpu, (width, height) = measure(backend, region_box(size, screen_size), args.repeat)
+                throughput = width * height * 3 / 1024 ** 2 / median
+                print(f"{name:<10} {f'{width}x{height}':>10} {median * 1000:>10.2f} {p95 * 1000:>8.2f} "
+                      f"{cpu * 1000:>8.2f} {throughput:>8.0f}")
+        finally:
+            backend.close()
+
+
+if __name__ == "__main__":
+    main()
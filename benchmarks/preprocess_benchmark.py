@@ -0,0 +1,103 @@
+"""
+Benchmark capture preprocessing: time and payload size per setting on synthetic screen frames.
+
+    python benchmarks/preprocess_benchmark.py [--repeat 5] [--sizes 1080p 4k]
+
+Each setting is resized and encoded `repeat` times; the median time is reported together with the
+size of the base64 payload that would be sent to the backend.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocess import PreprocessSettings, resize_image, encode_image_to_base64  # noqa: E402
+
+
+FRAME_SIZES = {
+    "1080p": (1920, 1080),
+    "1440p": (2560, 1440),
+    "4k": (3840, 2160),
+}
+
+SETTINGS = [
+    ("baseline (full LANCZOS, JPEG q75)", PreprocessSettings(reducing_gap=None)),
+    ("default (LANCZOS, reducing gap 1)", PreprocessSettings()),
+    ("LANCZOS, reducing gap 2", PreprocessSettings(reducing_gap=2.0)),
+    ("bicubic", PreprocessSettings(resample="bicubic")),
+    ("bilinear", PreprocessSettings(resample="bilinear")),
+    ("JPEG q90 4:4:4", PreprocessSettings(quality=90, subsampling="4:4:4")),
+    ("JPEG q60", PreprocessSettings(quality=60)),
+    ("WebP q75", PreprocessSettings(image_format="WEBP", quality=75)),
+    ("WebP q75 fast", PreprocessSettings(image_format="WEBP", quality=75, webp_method=0)),
+    ("grayscale JPEG q75", PreprocessSettings(grayscale=True)),
+    ("1.0 MP budget", PreprocessSettings(max_pixels=1_000_000)),
+    ("0.5 MP budget", PreprocessSettings(max_pixels=500_000)),
+]
+
+
+def synthetic_frame(width, height, seed=0):
+    """A desktop-like frame: window panels, lines of text and a photo-like gradient area."""
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), (32, 34, 40))
+    draw = ImageDraw.Draw(image)
+
+    for _ in range(6):
+        left = rng.randrange(0, width * 3 // 4)
+        top = rng.randrange(0, height * 3 // 4)
+        right = min(width, left + rng.randrange(width // 5, width // 2))
+        bottom = min(height, top + rng.randrange(height // 5, height // 2))
+        draw.rectangle((left, top, right, bottom), fill=(rng.randrange(200, 256),) * 3, outline=(90, 90, 90))
+        for y in range(top + 8, bottom - 16, 18):
+            words = " ".join("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randrange(2, 9)))
+                             for _ in range(rng.randrange(3, 14)))
+            draw.text((left + 8, y), words, fill=(20, 20, 20))
+
+    # Photo-like area with smooth gradients and noise, the hardest part to compress
+    photo_w, photo_h = width // 4, height // 4
+    gradient = Image.linear_gradient('L').resize((photo_w, photo_h))
+    noise = Image.effect_noise((photo_w, photo_h), 40)
+    photo = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    image.paste(photo, (width - photo_w - 20, height - photo_h - 20))
+    return image
+
+
+def measure(frame, settings, repeat):
+    resize_times, encode_times = [], []
+    payload = ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        resized = resize_image(frame, settings)
+        middle = time.perf_counter()
+        payload = encode_image_to_base64(resized, settings)
+        end = time.perf_counter()
+        resize_times.append(middle - start)
+        encode_times.append(end - middle)
+    return statistics.median(resize_times), statistics.median(encode_times), len(payload), resized.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per setting (median is reported)")
+    parser.add_argument("--sizes", nargs="+", default=["1080p", "4k"], choices=sorted(FRAME_SIZES))
+    args = parser.parse_args()
+
+    for size_name in args.sizes:
+        width, height = FRAME_SIZES[size_name]
+        frame = synthetic_frame(width, height)
+        print(f"\n{size_name} frame ({width}x{height}), median of {args.repeat} runs")
+        print(f"{'setting':<36} {'output':>11} {'resize ms':>10} {'encode ms':>10} {'total ms':>9} {'payload KB':>11}")
+        for name, settings in SETTINGS:
+            resize_time, encode_time, payload_size, output_size = measure(frame, settings, args.repeat)
+            print(f"{name:<36} {output_size[0]:>5}x{output_size[1]:<5} {resize_time * 1000:>10.1f} "
+                  f"{encode_time * 1000:>10.1f} {(resize_time + encode_time) * 1000:>9.1f} {payload_size / 1024:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import logging
+import threading
+
+
+class GenerationCancelled(Exception):
+    """Raised when a request is cancelled through its CancelToken before the model finished."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    Lets another thread abort a request in flight. The client registers how to stop the generation
+    on the server with on_cancel(); cancel() runs those callbacks once, on the cancelling thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reason = None
+        self.callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def cancel(self, reason="cancelled"):
+        with self.lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.warning(f"Error aborting request: {e}")
+
+    def on_cancel(self, callback):
+        """Run callback when the request is cancelled; right away if it already was."""
+        with self.lock:
+            if self.reason is None:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def check(self):
+        """:raises GenerationCancelled: If cancel() was called"""
+        if self.reason is not None:
+            raise GenerationCancelled(self.reason)
@@ -0,0 +1,320 @@
+import ctypes
+import ctypes.util
+import importlib.util
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureBackend:
+    """
+    Grabs screen contents. Subclasses implement grab() and, if they hold native resources, close().
+    """
+
+    name = None
+
+    @classmethod
+    def available(cls):
+        """Whether this backend can work in the current session, without opening anything expensive."""
+        return True
+
+    def grab(self, bbox=None):
+        """
+        :param bbox: (left, top, right, bottom) in screen pixels, right/bottom exclusive; None for the whole screen
+        :return: RGB PIL Image
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+CAPTURE_BACKENDS = OrderedDict()  # name -> class, in the order "auto" tries them
+
+
+def register_capture_backend(cls):
+    CAPTURE_BACKENDS[cls.name] = cls
+    return cls
+
+
+class _XImage(ctypes.Structure):
+    # Leading fields of Xlib's XImage; the struct is only ever accessed through a pointer
+    _fields_ = [
+        ("width", ctypes.c_int),
+        ("height", ctypes.c_int),
+        ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int),
+        ("bitmap_bit_order", ctypes.c_int),
+        ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int),
+        ("bits_per_pixel", ctypes.c_int),
+        ("red_mask", ctypes.c_ulong),
+        ("green_mask", ctypes.c_ulong),
+        ("blue_mask", ctypes.c_ulong),
+    ]
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong),
+        ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p),
+        ("readOnly", ctypes.c_int),
+    ]
+
+
+class _XErrorEvent(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_int),
+        ("display", ctypes.c_void_p),
+        ("resourceid", ctypes.c_ulong),
+        ("serial", ctypes.c_ulong),
+        ("error_code", ctypes.c_ubyte),
+        ("request_code", ctypes.c_ubyte),
+        ("minor_code", ctypes.c_ubyte),
+    ]
+
+
+_X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(_XErrorEvent))
+_x_errors = {}  # display address -> last X error code
+
+
+@_X_ERROR_HANDLER
+def _on_x_error(display, event):
+    # The default Xlib error handler exits the process; record errors instead
+    _x_errors[display] = event.contents.error_code
+    return 0
+
+
+_Z_PIXMAP = 2
+_ALL_PLANES = ctypes.c_ulong(-1).value
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+
+
+@register_capture_backend
+class XShmBackend(CaptureBackend):
+    """
+    X11 capture through the MIT-SHM extension, using Xlib via ctypes.
+
+    The X server copies the requested area straight into a shared memory segment, so a grab costs one
+    round trip and one copy instead of streaming the pixels over the X socket like XGetImage. Shared
+    images are kept for the most recent `cached_sizes` grab sizes, so repeated grabs of the same region
+    allocate nothing.
+    """
+
+    name = "xshm"
+
+    def __init__(self, display=None, cached_sizes=4):
+        self.xlib = ctypes.CDLL(ctypes.util.find_library("X11"))
+        self.xext = ctypes.CDLL(ctypes.util.find_library("Xext"))
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._declare()
+        self.lock = threading.Lock()
+        self.cached_sizes = cached_sizes
+        self.images = OrderedDict()  # (width, height) -> (XImage pointer, XShmSegmentInfo)
+        self.xlib.XSetErrorHandler(_on_x_error)
+
+        self.display = self.xlib.XOpenDisplay(display.encode() if display else None)
+        if not self.display:
+            raise CaptureError(f"Cannot open X display {display or os.environ.get('DISPLAY')!r}")
+        if not self.xext.XShmQueryExtension(self.display):
+            self.xlib.XCloseDisplay(self.display)
+            raise CaptureError("The X server does not support the MIT-SHM extension")
+        screen = self.xlib.XDefaultScreen(self.display)
+        self.root = self.xlib.XDefaultRootWindow(self.display)
+        self.visual = self.xlib.XDefaultVisual(self.display, screen)
+        self.depth = self.xlib.XDefaultDepth(self.display, screen)
+        self.screen_size = (self.xlib.XDisplayWidth(self.display, screen), self.xlib.XDisplayHeight(self.display, screen))
+
+    def _declare(self):
+        xlib, xext, libc = self.xlib, self.xext, self.libc
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xlib.XSetErrorHandler.argtypes = [_X_ERROR_HANDLER]
+        xlib.XSetErrorHandler.restype = ctypes.c_void_p
+        for function in (xlib.XDefaultScreen, xlib.XDefaultDepth, xlib.XDisplayWidth, xlib.XDisplayHeight):
+            function.restype = ctypes.c_int
+        xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultVisual.restype = ctypes.c_void_p
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDestroyImage.argtypes = [ctypes.POINTER(_XImage)]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                         ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage), ctypes.c_int,
+                                      ctypes.c_int, ctypes.c_ulong]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    @classmethod
+    def available(cls):
+        return (sys.platform.startswith("linux") and bool(os.environ.get("DISPLAY"))
+                and ctypes.util.find_library("X11") is not None and ctypes.util.find_library("Xext") is not None)
+
+    def _shared_image(self, width, height):
+        key = (width, height)
+        if key in self.images:
+            self.images.move_to_end(key)
+            return self.images[key][0]
+
+        info = _XShmSegmentInfo()
+        ximage = self.xext.XShmCreateImage(self.display, self.visual, self.depth, _Z_PIXMAP, None,
+                                           ctypes.byref(info), width, height)
+        if not ximage:
+            raise CaptureError(f"XShmCreateImage failed for {width}x{height}")
+        if ximage.contents.bits_per_pixel != 32:
+            self.xlib.XDestroyImage(ximage)
+            raise CaptureError(f"Unsupported pixel format: {ximage.contents.bits_per_pixel} bits per pixel")
+        info.shmid = self.libc.shmget(_IPC_PRIVATE, ximage.contents.bytes_per_line * height, _IPC_CREAT | 0o600)
+        if info.shmid < 0:
+            self.xlib.XDestroyImage(ximage)
+            raise CaptureError(f"shmget failed: {os.strerror(ctypes.get_errno())}")
+        address = self.libc.shmat(info.shmid, None, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            self.libc.shmctl(info.shmid, _IPC_RMID, None)
+            self.xlib.XDestroyImage(ximage)
+            raise CaptureError(f"shmat failed: {os.strerror(ctypes.get_errno())}")
+        info.shmaddr = ximage.contents.data = address
+        info.readOnly = 0
+        _x_errors.pop(self.display, None)
+        self.xext.XShmAttach(self.display, ctypes.byref(info))
+        self.xlib.XSync(self.display, 0)
+        # Marked for removal now, so the segment is freed even if the process dies without close()
+        self.libc.shmctl(info.shmid, _IPC_RMID, None)
+        error = _x_errors.pop(self.display, None)
+        if error is not None:
+            self._release(ximage, info, attached=False)
+            raise CaptureError(f"XShmAttach failed with X error {error}")
+
+        self.images[key] = (ximage, info)
+        while len(self.images) > self.cached_sizes:
+            _, (old_image, old_info) = self.images.popitem(last=False)
+            self._release(old_image, old_info)
+        return ximage
+
+    def _release(self, ximage, info, attached=True):
+        if attached:
+            self.xext.XShmDetach(self.display, ctypes.byref(info))
+            self.xlib.XSync(self.display, 0)
+        # XDestroyImage would free() the shared memory as if it were its own buffer
+        ximage.contents.data = None
+        self.xlib.XDestroyImage(ximage)
+        self.libc.shmdt(ctypes.c_void_p(info.shmaddr))
+
+    def grab(self, bbox=None):
+        screen_width, screen_height = self.screen_size
+        left, top, right, bottom = bbox if bbox is not None else (0, 0, screen_width, screen_height)
+        left, top = max(int(left), 0), max(int(top), 0)
+        right, bottom = min(int(right), screen_width), min(int(bottom), screen_height)
+        if right <= left or bottom <= top:
+            raise CaptureError(f"Capture box {bbox} is outside the {screen_width}x{screen_height} screen")
+        width, height = right - left, bottom - top
+
+        with self.lock:
+            ximage = self._shared_image(width, height)
+            _x_errors.pop(self.display, None)
+            if not self.xext.XShmGetImage(self.display, self.root, ximage, left, top, _ALL_PLANES):
+                self.xlib.XSync(self.display, 0)
+                raise CaptureError(f"XShmGetImage failed with X error {_x_errors.pop(self.display, None)}")
+            stride = ximage.contents.bytes_per_line
+            data = ctypes.string_at(ximage.contents.data, stride * height)
+        # 32 bpp little-endian ZPixmap is B, G, R, padding
+        return Image.frombytes("RGB", (width, height), data, "raw", "BGRX", stride)
+
+    def close(self):
+        with self.lock:
+            if not self.display:
+                return
+            for ximage, info in self.images.values():
+                self._release(ximage, info)
+            self.images.clear()
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+
+
+@register_capture_backend
+class ImageGrabBackend(CaptureBackend):
+    """Pillow's ImageGrab: GDI on Windows, screencapture on macOS, XCB on Linux."""
+
+    name = "imagegrab"
+
+    @classmethod
+    def available(cls):
+        if sys.platform in ("win32", "darwin"):
+            return True
+        return getattr(Image.core, "HAVE_XCB", False) and bool(os.environ.get("DISPLAY"))
+
+    def grab(self, bbox=None):
+        from PIL import ImageGrab
+        image = ImageGrab.grab(bbox=bbox)
+        return image if image.mode == "RGB" else image.convert("RGB")
+
+
+@register_capture_backend
+class PyAutoGUIBackend(CaptureBackend):
+    """pyautogui.screenshot; on Linux it shells out to a screenshot tool, which makes it the slowest."""
+
+    name = "pyautogui"
+
+    @classmethod
+    def available(cls):
+        return importlib.util.find_spec("pyautogui") is not None
+
+    def grab(self, bbox=None):
+        import pyautogui
+        if bbox is None:
+            image = pyautogui.screenshot()
+        else:
+            left, top, right, bottom = bbox
+            image = pyautogui.screenshot(region=(left, top, right - left, bottom - top))
+        return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def create_capture_backend(name="auto"):
+    """
+    :param name: A key of CAPTURE_BACKENDS, or "auto" for the first one that is available and starts
+    """
+    if name != "auto":
+        if name not in CAPTURE_BACKENDS:
+            raise ValueError(f"Unknown capture backend: {name}")
+        return CAPTURE_BACKENDS[name]()
+
+    for backend_class in CAPTURE_BACKENDS.values():
+        if not backend_class.available():
+            continue
+        try:
+            backend = backend_class()
+        except (CaptureError, OSError) as e:
+            logging.warning(f"Capture backend {backend_class.name} unavailable: {e}")
+            continue
+        logging.info(f"Using capture backend {backend_class.name}")
+        return backend
+    logging.warning("No capture backend reports itself available, falling back to imagegrab")
+    return ImageGrabBackend()
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+
+
+CONFIG_PATH = "config.json"
+
+DEFAULT_CONFIG = {
+    # What is analyzed and by which backend: "koboldcpp", "ollama" (using ollama_model) or "pool"
+    "system_prompt": "describe the image",
+    "backend": "koboldcpp",
+    "ollama_model": "minicpm-v",
+
+    # Backend servers
+    "koboldcpp_url": "http://localhost:5001",
+    "ollama_url": "http://localhost:11434",
+    "connect_timeout": 5.0,  # seconds to establish a connection
+    "read_timeout": 180.0,  # seconds to wait for the model between bytes of the response
+    "max_retries": 2,  # retries after the first attempt for connection errors, timeouts and 5xx responses
+    "retry_backoff": 0.5,  # base delay in seconds, doubled per retry and jittered
+    "circuit_failure_threshold": 3,  # consecutive failures before a backend is considered down
+    "circuit_reset_timeout": 30.0,  # seconds before a down backend is tried again
+    # Servers used by the "pool" backend, e.g. [{"backend": "koboldcpp", "url": "http://gpu1:5001"},
+    # {"backend": "ollama", "url": "http://gpu2:11434", "model": "llava", "weight": 2, "max_in_flight": 4}]
+    "backend_endpoints": [],
+    "pool_policy": "least_loaded",  # "least_loaded" or "latency" (shortest expected wait)
+    "pool_max_in_flight": 2,  # requests per endpoint at the same time, unless set per endpoint
+    "pool_health_interval": 10.0,  # seconds between health checks of the endpoints, 0 to disable
+    "pool_stats_interval": 300.0,  # seconds between endpoint statistics in the log, 0 to disable
+    "ollama_keep_alive": "30m",  # how long Ollama keeps the model loaded after a request ("10m", seconds, -1 for ever), None for the server default
+    "warm_up": True,  # load the model with a tiny request at startup and after a backend or model change
+    "keep_warm_lead": 600.0,  # seconds before the timer window opens in which the model is kept loaded
+    "keep_warm_interval": 120.0,  # seconds between keep-warm requests in that time
+    "stream_responses": True,  # show text in the overlay while it is being generated
+    "stream_update_interval": 0.1,  # minimum seconds between overlay repaints while streaming
+
+    # Capture pipeline
+    "capture_backend": "auto",  # "xshm" (X11 shared memory), "imagegrab", "pyautogui"; auto picks the first that works
+    "capture_interval": 5.0,  # seconds between captures; the starting point when adaptive_schedule is on
+    "adaptive_schedule": True,  # adjust the interval to screen activity and backend latency
+    "min_capture_interval": 1.0,
+    "max_capture_interval": 30.0,
+    "target_duty_cycle": 0.5,  # largest share of time the backend should spend on this app's requests
+    "preprocess_workers": 2,  # threads saving and resizing captures
+    "capture_queue_size": 2,  # captures waiting for preprocessing
+    "frame_queue_size": 1,  # preprocessed frames waiting for the model
+    "queue_overflow_policy": "drop_oldest",  # or "drop_newest": which frame to discard when a queue is full
+
+    # Named capture regions analyzed on their own schedules, e.g. {"name": "chat", "box": [0, 0, 800, 600],
+    # "prompt": "Summarize the new messages", "interval": 10}. box is left, top, right, bottom in screen
+    # pixels; prompt and interval default to the overlay's prompt and capture_interval.
+    "capture_regions": [],
+    "region_batch_size": 4,  # regions packed into one request; 1 sends one request per region
+
+    # Dirty tiles: when only a small part of the screen changed since the last analysis, send crops of
+    # the changed areas (sharing the max_pixels budget) together with the previous description
+    "dirty_tiles": True,
+    "tile_size": 64,  # pixels
+    "tile_pixel_threshold": 24,  # luminance difference (0-255) that marks a pixel as changed
+    "tile_max_area": 0.3,  # if more than this share of the frame changed, the whole frame is sent
+    "tile_max_crops": 4,  # changed areas are merged until there are at most this many crops
+    "tile_full_refresh": 10,  # send the whole frame again after this many crop-only analyses
+
+    # Preprocessing, see preprocess.PreprocessSettings
+    "max_pixels": 1_800_000,  # captures larger than this are scaled down
+    "resample": "lanczos",  # nearest, box, bilinear, hamming, bicubic or lanczos
+    "reducing_gap": 1.0,  # fast integer pre-shrink before resampling; null to resample the full image
+    "image_format": "JPEG",  # JPEG, WEBP or PNG; check that your backend can decode WebP before using it
+    "image_quality": 75,
+    "jpeg_subsampling": "4:2:0",  # 4:4:4 keeps small colored text sharper at a larger payload
+    "grayscale": False,
+
+    # History database writes are grouped into transactions by a background thread
+    "history_batch_size": 100,  # most rows per transaction
+    "history_commit_interval": 0.5,  # seconds to wait for more rows before committing
+
+    # Full-size captures: "archive" appends them, compressed, to segment files in archive_dir;
+    # "png" saves one PNG file per capture in saved_screenshots
+    "frame_storage": "archive",
+    "archive_dir": "frame_archive",
+    "archive_codec": "zlib",  # zlib or zstd compress the raw pixels (fast); png or webp are lossless image files
+    "archive_segment_size": 256 * 1024 ** 2,  # bytes per segment file
+    "archive_dedup": True,  # store identical captures once
+
+    # Retention, enforced a little at a time by a background thread. null means no limit.
+    # The size and age limits also apply, separately, to the frame archive, which drops whole segments
+    "screenshot_max_bytes": 10 * 1024 ** 3,  # total size of saved_screenshots
+    "screenshot_max_count": None,
+    "screenshot_max_age": None,  # seconds
+    # [age, spacing] pairs in seconds: screenshots older than age are thinned to one per spacing.
+    # The default keeps every frame from the last hour, one per minute for the last day,
+    # one per hour for the last week and one per day before that.
+    "screenshot_downsampling": [[3600, 60], [86400, 3600], [7 * 86400, 86400]],
+    "history_max_rows": None,
+    "history_max_age": None,  # seconds
+    "retention_interval": 60.0,  # seconds between retention passes
+    "retention_batch_size": 500,  # most files deleted per pass
+
+    # Batch re-analysis of saved captures (python -m batch)
+    "batch_concurrency": 2,  # requests in flight to the backend
+    "batch_processes": None,  # processes decoding and encoding frames; None uses one per CPU
+    "batch_write_size": 50,  # results committed to the history database per transaction
+
+    # Alerts: "combined" asks for the description and the alert verdicts in one request, "text_only" judges
+    # the conditions from the description in a short text request, "separate" sends the image a second time
+    "alert_mode": "combined",
+    "alert_max_length": 4,  # tokens generated per rule for a text-only verdict
+    # Alert rules, e.g. {"name": "error", "condition": "Is an error dialog shown?", "keywords": ["error"],
+    # "pattern": null, "min_change": 0}. See alerts.AlertRule for the pre-filters.
+    "alert_rules": [],
+
+    # Frames whose 256-bit dHash differs from the last analyzed frame by at most this many bits
+    # are treated as unchanged and reuse the previous description. Set to -1 to analyze every frame.
+    "frame_change_threshold": 6,
+    # A request still running when a newer capture differs from its frame by more than this many bits
+    # is cancelled and the newer frame is described instead. Set to -1 to always let requests finish.
+    "preempt_threshold": 24,
+    "preempt_max_consecutive": 2,  # after this many preemptions in a row the next request is left to finish
+
+    # Near-duplicate result cache: entries within result_cache_max_distance bits of a 64-bit dHash
+    # are reused instead of calling the backend
+    "result_cache_max_entries": 5000,
+    "result_cache_max_age": 7 * 24 * 3600,  # seconds
+    "result_cache_max_distance": 4,
+}
+
+
+def load_config(path=CONFIG_PATH):
+    """
+    Load settings from a JSON file on top of DEFAULT_CONFIG. Any key can also be overridden
+    with an environment variable named SCREEN_ANALYSIS_<KEY>, e.g. SCREEN_ANALYSIS_OLLAMA_URL.
+    :param path: Path to the JSON config file; a missing file is not an error
+    :return: Dict of settings
+    """
+    config = dict(DEFAULT_CONFIG)
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                config.update(json.load(f))
+            logging.info(f"Loaded configuration from {path}")
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading config file {path}: {e}")
+
+    for key, default in DEFAULT_CONFIG.items():
+        value = os.environ.get(f"SCREEN_ANALYSIS_{key.upper()}")
+        if value is None:
+            continue
+        try:
+            config[key] = _parse_env_value(value, default)
+        except ValueError:
+            logging.error(f"Invalid value for SCREEN_ANALYSIS_{key.upper()}: {value!r}")
+    return config
+
+
+def _parse_env_value(value, default):
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, (int, float)):
+        return type(default)(value)
+    if isinstance(default, str):
+        return value
+    # Lists, dicts and unset (None) values are given as JSON
+    return json.loads(value)
@@ -0,0 +1,697 @@
+import copy
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import alerts
+import regions
+from cancellation import CancelToken, GenerationCancelled
+from capture import create_capture_backend
+from frame_archive import FrameArchive
+from frame_change import FrameChangeDetector, TileChangeDetector, dhash, hamming_distance
+from history import HistoryManager
+from pipeline import CapturePipeline
+from preprocess import PreprocessSettings, resize_image, encode_image_to_base64
+from result_cache import ResultCache
+from retention import RetentionManager
+from scheduler import AdaptiveScheduler
+
+
+def preprocess_frame(frame, settings, screenshot_dir, retention=None, archive=None, luminance=False):
+    """
+    Save the full-size screenshot and produce the resized, encoded image sent to the model.
+    Runs on the preprocess worker pool, off the capturing thread.
+    :param frame: pipeline.Frame with raw_image set
+    :param settings: PreprocessSettings
+    :param retention: RetentionManager the saved screenshot is registered with
+    :param archive: FrameArchive to append the screenshot to instead of saving a PNG file
+    :param luminance: Also compute the luminance array used for dirty-tile detection
+    """
+    captured_at = frame.captured_at
+    if archive is not None:
+        frame.frame_id = archive.append(frame.raw_image, captured_at)
+        logging.info(f"Screenshot archived as frame {frame.frame_id}")
+    else:
+        timestamp = f"{captured_at:%Y%m%d_%H%M%S}_{captured_at.microsecond // 1000:03d}"
+        filename = f"screenshot_{timestamp}.png"
+        frame.path = os.path.join(screenshot_dir, filename)
+        frame.raw_image.save(frame.path)
+        logging.info(f"Screenshot saved: {frame.path}")
+        if retention is not None:
+            retention.record(frame.path, captured_at)
+
+    if frame.regions is not None:
+        # One grab covers every region due this cycle; each is cropped from it and encoded on its own
+        frame.region_images = []
+        for region, box in frame.regions:
+            image = resize_image(frame.raw_image.crop(box), settings)
+            if image.getbbox() is None:
+                logging.warning(f"Captured image of region {region.name} is empty")
+                frame.region_images.append((None, None))
+            else:
+                frame.region_images.append((image, encode_image_to_base64(image, settings)))
+        return frame
+
+    if luminance:
+        frame.luma = TileChangeDetector.luminance(frame.raw_image)
+    frame.image = resize_image(frame.raw_image, settings)
+    frame.is_empty = frame.image.getbbox() is None
+    if frame.is_empty:
+        logging.warning("Captured image is empty")
+    else:
+        frame.image_base64 = encode_image_to_base64(frame.image, settings)
+        logging.info(f"Captured image size: {frame.image.size}, payload {len(frame.image_base64) // 1024} KB")
+    return frame
+
+
+def build_crop_prompt(prompt, previous_description, boxes, frame_size):
+    """
+    Prompt for a request that carries only the changed parts of the screen.
+    :param boxes: (left, top, right, bottom) of each attached crop, in frame pixels
+    """
+    width, height = frame_size
+    areas = "\n".join(f"{i}. x {left}-{right}, y {top}-{bottom}"
+                      for i, (left, top, right, bottom) in enumerate(boxes, 1))
+    return (f"{prompt}\n\n"
+            f"Only part of the screen ({width}x{height} pixels) changed since it was last described as:\n"
+            f"{previous_description}\n\n"
+            f"The attached images are the changed areas, in this order:\n{areas}\n"
+            f"Describe the whole screen as it is now, updating the previous description with what the changed areas show.")
+
+
+class StreamThrottle:
+    """
+    Accumulates streamed tokens and forwards the text so far at most once per interval,
+    so the overlay repaints at a bounded rate however fast tokens arrive.
+    :param clean: Applied to the text so far before it is forwarded
+    """
+
+    def __init__(self, emit, interval, clean=str.strip):
+        self.emit = emit
+        self.interval = interval
+        self.clean = clean
+        self.chunks = []
+        self.last_emit = 0.0
+
+    def __call__(self, token):
+        self.chunks.append(token)
+        now = time.monotonic()
+        if now - self.last_emit >= self.interval:
+            self.last_emit = now
+            self.emit(self.clean(''.join(self.chunks)))
+
+
+class AnalysisEngine:
+    """
+    Capture, preprocessing, backend requests, history and alerts without any GUI.
+
+    The overlay drives an engine from Qt timers and a QThread; headless.py runs one on its own. Captures
+    are submitted with capture() or capture_regions() from one thread while run_analysis() consumes the
+    preprocessed frames on another. Results are reported through the on_* callbacks, which are called
+    on the analysis thread:
+
+    - on_analysis(description, frame_id)
+    - on_region_analysis(region name, description, prompt, frame_id)
+    - on_partial(text so far) while a response is streamed
+    - on_alert(rule label, analysis text)
+    - on_schedule(interval, reason) when the adaptive schedule changes the capture interval
+    - on_cancelled(reason) when a request was abandoned before the model finished
+    - on_error(message) when processing a frame failed
+    """
+
+    def __init__(self, config, screenshot_dir="saved_screenshots"):
+        """
+        :param config: Settings dict from config.load_config()
+        """
+        self.config = config
+        self.system_prompt = config["system_prompt"]
+        self.backend = config["backend"]
+        self.ollama_model = config["ollama_model"]
+        self.capture_box = None  # (left, top, right, bottom) in screen coordinates, None for full screen
+        self.paused = False
+        # Named regions replace capture_box when any are defined
+        self.regions = regions.RegionSet.from_config(config["capture_regions"], config["capture_interval"])
+        self.alert_engine = alerts.AlertEngine.from_config(config["alert_rules"])
+        if config["alert_mode"] not in alerts.ALERT_MODES:
+            logging.error(f"Unknown alert_mode {config['alert_mode']!r}, using 'combined'")
+            config["alert_mode"] = "combined"
+        self.active_check = None  # optional callable; frames are discarded while it returns False
+        self.on_analysis = None
+        self.on_region_analysis = None
+        self.on_partial = None
+        self.on_alert = None
+        self.on_schedule = None
+        self.on_cancelled = None
+        self.on_error = None
+
+        self.history_manager = HistoryManager(batch_size=config["history_batch_size"],
+                                              commit_interval=config["history_commit_interval"])
+        self.screenshot_dir = screenshot_dir
+        os.makedirs(screenshot_dir, exist_ok=True)
+        self.capture_backend = None  # created on the first grab
+        self.capture_lock = threading.Lock()
+        self.frame_archive = None
+        if config["frame_storage"] == "archive":
+            self.frame_archive = FrameArchive.from_config(config, self.history_manager.db_path)
+        # Keeps saved screenshots and the history database within the configured limits
+        self.retention = RetentionManager.from_config(config, screenshot_dir, self.history_manager, self.frame_archive)
+
+        # Captures are saved and resized on a worker pool and queued for the analysis thread
+        self.preprocess_settings = PreprocessSettings.from_config(config)
+        self.pipeline = CapturePipeline(
+            self.preprocess,
+            workers=config["preprocess_workers"],
+            capture_queue_size=config["capture_queue_size"],
+            frame_queue_size=config["frame_queue_size"],
+            overflow_policy=config["queue_overflow_policy"],
+            keep_raw_images=config["dirty_tiles"])
+
+        self.running = True
+        self.change_detector = FrameChangeDetector(threshold=config["frame_change_threshold"])
+        self.tile_detector = None
+        if config["dirty_tiles"]:
+            self.tile_detector = TileChangeDetector(tile_size=config["tile_size"],
+                                                    pixel_threshold=config["tile_pixel_threshold"],
+                                                    max_boxes=config["tile_max_crops"],
+                                                    max_area=config["tile_max_area"])
+        self.crop_analyses = 0  # crop-only analyses since the whole frame was last sent
+        # Per named region: change detector, analysis key and last description
+        self.region_detectors = {}
+        self.region_keys = {}
+        self.region_descriptions = {}
+        self.last_description = None
+        self.last_analysis_key = None
+        self.skipped_inferences = 0
+        self.result_cache = ResultCache(max_entries=config["result_cache_max_entries"],
+                                        max_age=config["result_cache_max_age"],
+                                        max_distance=config["result_cache_max_distance"])
+        self.clients = {}
+        self.client_lock = threading.Lock()
+        # Warm-up state: the latency of the next request is logged as cold, or as warm when it
+        # started after the model was loaded by a warm-up request
+        self.warm_up_thread = None
+        self.warm_up_lock = threading.Lock()
+        self.pending_warm_up = None  # (backend, model, reason) requested while a warm-up was running
+        self.warmed_at = None
+        self.warm_up_latency = None
+        self.log_next_latency = True
+        self.last_keep_warm = None
+        # The request in flight: (frame seq, capture box, dHash of the frame or None, CancelToken)
+        self.current_request = None
+        self.request_lock = threading.Lock()
+        self.preemptions = 0  # requests cancelled in a row because a newer frame differed
+        self.capture_interval = config["capture_interval"]
+        self.scheduler = AdaptiveScheduler(initial_interval=config["capture_interval"],
+                                           min_interval=config["min_capture_interval"],
+                                           max_interval=config["max_capture_interval"],
+                                           target_duty_cycle=config["target_duty_cycle"])
+
+    def _notify(self, callback, *args):
+        if callback is not None:
+            callback(*args)
+
+    def analysis_active(self):
+        if self.paused:
+            return False
+        return self.active_check is None or self.active_check()
+
+    def grab(self, bbox=None):
+        with self.capture_lock:
+            if self.capture_backend is None:
+                self.capture_backend = create_capture_backend(self.config["capture_backend"])
+            return self.capture_backend.grab(bbox)
+
+    def capture(self, bbox=None):
+        """
+        Grab the screen (or bbox) and queue it for analysis.
+        :param bbox: (left, top, right, bottom) in screen coordinates, None for the whole screen
+        """
+        img = self.grab(bbox)
+        if bbox is not None:
+            logging.info(f"Screenshot taken of selected region: {','.join(str(value) for value in bbox)}")
+        else:
+            logging.info("Full screen screenshot taken")
+        # Saving and resizing happen on the preprocess workers
+        self.pipeline.submit(img, datetime.now(), bbox)
+
+    def capture_regions(self, due):
+        """
+        Grab the area covering every due region once and let the pipeline crop the regions from it.
+        :param due: CaptureRegions, from regions.due()
+        """
+        bbox = regions.union_box([region.box for region in due])
+        img = self.grab(bbox)
+        logging.info(f"Screenshot taken for regions {', '.join(region.name for region in due)}: {bbox}")
+        crops = [(region, (region.box[0] - bbox[0], region.box[1] - bbox[1],
+                           region.box[2] - bbox[0], region.box[3] - bbox[1])) for region in due]
+        self.pipeline.submit(img, datetime.now(), bbox, regions=crops)
+
+    def capture_due(self, now=None):
+        """Capture whatever is due: the named regions whose interval has passed, or the capture box."""
+        if len(self.regions):
+            due = self.regions.due(time.monotonic() if now is None else now)
+            if due:
+                self.capture_regions(due)
+        else:
+            self.capture(self.capture_box)
+
+    def next_capture_interval(self):
+        """Seconds until capture_due() should be called again."""
+        return self.regions.tick_interval() if len(self.regions) else self.capture_interval
+
+    def preprocess(self, frame):
+        # Runs on the preprocess workers
+        preprocess_frame(frame, self.preprocess_settings, self.screenshot_dir, self.retention,
+                         self.frame_archive, luminance=self.config["dirty_tiles"])
+        self.preempt_if_changed(frame)
+        return frame
+
+    def preempt_if_changed(self, frame):
+        """
+        Cancel the description request in flight when this newer capture of the same area differs
+        from the frame being described by more than preempt_threshold. After preempt_max_consecutive
+        preemptions in a row the request is left to finish, so a screen that never settles still
+        gets described.
+        """
+        threshold = self.config["preempt_threshold"]
+        if threshold < 0 or frame.regions is not None or frame.is_empty:
+            return
+        with self.request_lock:
+            current = self.current_request
+            if current is None or self.preemptions >= self.config["preempt_max_consecutive"]:
+                return
+        seq, box, image_hash, token = current
+        if image_hash is None or seq >= frame.seq or box != frame.region:
+            return
+        distance = hamming_distance(dhash(frame.image, self.change_detector.hash_size), image_hash)
+        if distance <= threshold:
+            return
+        with self.request_lock:
+            if self.current_request is not current:
+                return
+            self.preemptions += 1
+        token.cancel(f"superseded by frame {frame.seq} (distance {distance})")
+
+    def cancel_analysis(self, reason):
+        """
+        Abort the request in flight, e.g. because analysis was paused or the prompt or capture area changed.
+        The analysis thread records it as cancelled and goes on with the next frame.
+        """
+        with self.request_lock:
+            current = self.current_request
+        if current is not None:
+            current[3].cancel(reason)
+
+    def begin_request(self, frame, image_hash=None):
+        """
+        :param image_hash: dHash of the frame's image; requests without one are not preempted by newer frames
+        :return: CancelToken for the request
+        """
+        token = CancelToken()
+        with self.request_lock:
+            self.current_request = (frame.seq, frame.region, image_hash, token)
+        return token
+
+    def end_request(self):
+        with self.request_lock:
+            self.current_request = None
+
+    def record_cancelled(self, prompt, reason, elapsed, frame_id=None, region=None):
+        logging.info(f"Analysis{f' of region {region}' if region else ''} cancelled after {elapsed:.1f}s: {reason}")
+        self.history_manager.add_cancelled(prompt, reason, elapsed, frame_id, region)
+        self._notify(self.on_cancelled, reason)
+
+    def warm_up(self, reason="startup"):
+        """
+        Load the selected backend's model with a tiny request on a background thread, so the first
+        capture does not wait for it. Call at startup and after the backend or model changed.
+        While a warm-up is running, the selected backend and model are warmed up as soon as it finishes.
+        :return: The warm-up thread, or None when warm-up is off
+        """
+        if not self.config["warm_up"]:
+            # The next request loads the model itself and is reported as cold
+            self.log_next_latency = True
+            self.warmed_at = None
+            return None
+        backend = self.backend
+        model = self.ollama_model if backend in ("ollama", "pool") else None
+        with self.warm_up_lock:
+            if self.warm_up_thread is not None and self.warm_up_thread.is_alive():
+                self.pending_warm_up = (backend, model, reason)
+                return self.warm_up_thread
+            self.log_next_latency = True
+            self.warmed_at = None
+            self.warm_up_thread = threading.Thread(target=self._warm_up, args=(backend, model, reason),
+                                                   name="warm-up", daemon=True)
+            self.warm_up_thread.start()
+            return self.warm_up_thread
+
+    def _warm_up(self, backend, model, reason):
+        while True:
+            start_time = time.monotonic()
+            try:
+                self.get_client(backend).warm_up(model)
+            except Exception as e:
+                logging.warning(f"Warm-up of {backend} failed: {e}")
+                latency = None
+            else:
+                latency = time.monotonic() - start_time
+                logging.info(f"Warmed up {backend}{f' ({model})' if model else ''} after {reason} in {latency:.2f}s")
+            with self.warm_up_lock:
+                if self.pending_warm_up is None:
+                    if latency is not None:
+                        self.warm_up_latency = latency
+                        self.warmed_at = time.monotonic()
+                    return
+                # The backend or model changed meanwhile; this warm-up no longer counts
+                (backend, model, reason), self.pending_warm_up = self.pending_warm_up, None
+                self.log_next_latency = True
+                self.warmed_at = None
+
+    def keep_warm(self, seconds_until_active):
+        """
+        Call regularly while analysis is paused. Once analysis resumes within keep_warm_lead seconds,
+        a warm-up request is sent every keep_warm_interval seconds so the model is loaded when it does.
+        :param seconds_until_active: Seconds until analysis resumes, None if unknown
+        """
+        if seconds_until_active is None or seconds_until_active > self.config["keep_warm_lead"]:
+            return
+        now = time.monotonic()
+        if self.last_keep_warm is not None and now - self.last_keep_warm < self.config["keep_warm_interval"]:
+            return
+        self.last_keep_warm = now
+        self.warm_up(f"pause, {seconds_until_active:.0f}s before resuming")
+
+    def log_latency(self, backend, start_time, elapsed):
+        # Only the first request after startup, a warm-up or a backend change is reported
+        if not self.log_next_latency:
+            return
+        self.log_next_latency = False
+        if self.warmed_at is not None and start_time >= self.warmed_at:
+            logging.info(f"First {backend} request took {elapsed:.2f}s (warm; the warm-up request took "
+                         f"{self.warm_up_latency:.2f}s)")
+        else:
+            logging.info(f"First {backend} request took {elapsed:.2f}s (cold)")
+
+    def run_analysis(self, on_wake=None):
+        """
+        Analyze preprocessed frames until stop() is called.
+        :param on_wake: Called after every frame and every wake-up of the loop, on the analysis thread
+        """
+        while self.running:
+            try:
+                # Blocks until the pipeline delivers a preprocessed frame; stop() wakes it without one
+                frame = self.pipeline.next_frame()
+                if frame is not None:
+                    if self.analysis_active():
+                        self.process_frame(frame)
+                    else:
+                        logging.info(f"Analysis paused, discarding frame {frame.seq}")
+                if on_wake is not None:
+                    on_wake()
+            except Exception as e:
+                if self.on_error is None:
+                    logging.error(f"Error in analysis thread: {e}")
+                else:
+                    self.on_error(str(e))
+
+    def process_frame(self, frame):
+        if frame.regions is not None:
+            self.process_regions(frame)
+            return
+        if frame.is_empty:
+            logging.warning("Skipping analysis due to invalid screenshot")
+            self.reschedule(changed=False)
+            return
+        image = frame.image
+        logging.info(f"Analyzing frame {frame.seq} captured at {frame.captured_at:%H:%M:%S.%f} "
+                     f"(region {frame.region or 'full screen'}, "
+                     f"waited {time.monotonic() - frame.ready_at:.2f}s after preprocessing)")
+
+        if not self.frame_needs_analysis(image):
+            self.skipped_inferences += 1
+            logging.info(f"Frame unchanged (distance {self.change_detector.last_distance}), "
+                         f"reusing previous description. Skipped inferences: {self.skipped_inferences}")
+            self.reschedule(changed=False)
+            return
+
+        engine = self.alert_engine
+        frame_hash = self.change_detector.current_hash
+        alert_mode = self.config["alert_mode"]
+        system_prompt = self.system_prompt
+        prompt, crops = system_prompt, self.changed_crops(frame)
+        frame.raw_image = None
+        if crops is not None:
+            boxes, crops = crops
+            prompt = build_crop_prompt(prompt, self.last_description, boxes, frame.luma.shape[::-1])
+        combined_rules = engine.rules_before_description(frame_hash) if alert_mode == "combined" else []
+        results = {}
+        cancel = self.begin_request(frame, frame_hash)
+        start_time = time.monotonic()
+        try:
+            if combined_rules:
+                # Rules that need no text pre-filter are answered in the description request itself
+                response = self.analyze(image, alerts.build_combined_prompt(prompt, combined_rules),
+                                        frame.image_base64, crops, cancel=cancel, combined=True)
+                description, results = alerts.split_verdicts(response, combined_rules)
+                if len(results) < len(combined_rules):
+                    logging.warning("Model response lacked some alert verdicts, checking them from the description")
+            else:
+                description = self.analyze(image, prompt, frame.image_base64, crops, cancel=cancel)
+        except GenerationCancelled as e:
+            self.record_cancelled(system_prompt, e.reason, time.monotonic() - start_time, frame.frame_id)
+            return
+        finally:
+            self.end_request()
+
+        self.preemptions = 0
+        self.last_description = description
+        self.change_detector.mark_analyzed()
+        if self.tile_detector is not None:
+            self.tile_detector.mark_analyzed()
+            self.crop_analyses = self.crop_analyses + 1 if crops is not None else 0
+        self.history_manager.add_analysis(description, system_prompt, frame.frame_id)
+        self._notify(self.on_analysis, description, frame.frame_id)
+
+        if engine.has_active_rules():
+            # Rules surviving the local pre-filters are batched into a single request
+            pending = engine.rules_after_description(description, frame_hash, exclude=results)
+            if pending and alert_mode == "separate":
+                results.update(self.check_alert_condition(frame.image_base64 or image, description, pending))
+            elif pending:
+                results.update(self.check_alert_text(description, pending))
+            for rule in engine.record(results, frame_hash):
+                self._notify(self.on_alert, rule.label(), description)
+        self.reschedule(changed=True)
+
+    def process_regions(self, frame):
+        """
+        Analyze the named regions cropped from one grab. Changed regions are packed into as few
+        requests as possible and each description is reported for its own region.
+        """
+        backend = self.backend
+        pending = []
+        for (region, _), (image, image_base64) in zip(frame.regions, frame.region_images):
+            if image is None:
+                continue
+            prompt = region.prompt or self.system_prompt
+            detector = self.region_detectors.get(region.name)
+            if detector is None:
+                detector = self.region_detectors[region.name] = FrameChangeDetector(
+                    threshold=self.config["frame_change_threshold"])
+            key = (prompt, backend, self.ollama_model, region.box)
+            if self.region_keys.get(region.name) != key:
+                self.region_keys[region.name] = key
+                detector.reset()
+            if detector.has_changed(image) or region.name not in self.region_descriptions:
+                pending.append((region, image, image_base64, prompt))
+            else:
+                logging.info(f"Region {region.name} unchanged (distance {detector.last_distance}), skipping")
+        if not pending:
+            return
+
+        cancel = self.begin_request(frame)
+        start_time = time.monotonic()
+        try:
+            descriptions = self.analyze_regions(pending, cancel)
+        except GenerationCancelled as e:
+            for region, _, _, prompt in pending:
+                self.record_cancelled(prompt, e.reason, time.monotonic() - start_time, frame.frame_id, region.name)
+            return
+        finally:
+            self.end_request()
+        for region, _, _, prompt in pending:
+            description = descriptions.get(region.name)
+            if description is None:
+                continue
+            self.region_detectors[region.name].mark_analyzed()
+            self.region_descriptions[region.name] = description
+            self.history_manager.add_analysis(description, prompt, frame.frame_id, region=region.name)
+            self._notify(self.on_region_analysis, region.name, description, prompt, frame.frame_id)
+
+        engine = self.alert_engine
+        if descriptions and engine.has_active_rules():
+            # Alert rules are judged on the new descriptions of all regions together, in one text request
+            text = "\n".join(f"{name}: {description}" for name, description in descriptions.items())
+            rules = engine.rules_after_description(text, None)
+            results = self.check_alert_text(text, rules) if rules else {}
+            for rule in engine.record(results, None):
+                self._notify(self.on_alert, rule.label(), text)
+
+    def analyze_regions(self, pending, cancel=None):
+        """
+        :param pending: [(CaptureRegion, image, image_base64, prompt)]
+        :param cancel: CancelToken for the requests
+        :return: {region name: description}
+        """
+        backend = self.backend
+        model = self.ollama_model if backend in ("ollama", "pool") else None
+        descriptions = {}
+        uncached = []
+        for item in pending:
+            region, image, _, prompt = item
+            cached = self.result_cache.lookup(self.result_cache.image_hash(image), prompt, backend, model)
+            if cached is not None:
+                descriptions[region.name] = cached
+            else:
+                uncached.append(item)
+
+        batch_size = max(1, self.config["region_batch_size"])
+        for start in range(0, len(uncached), batch_size):
+            batch = uncached[start:start + batch_size]
+            answers = {}
+            if len(batch) > 1:
+                prompt = regions.build_batch_prompt([(region.name, prompt) for region, _, _, prompt in batch])
+                start_time = time.monotonic()
+                response = self.get_client(backend).analyze([image_base64 for _, _, image_base64, _ in batch],
+                                                            prompt, model, cancel=cancel)
+                self.scheduler.record_inference(time.monotonic() - start_time)
+                self.log_latency(backend, start_time, time.monotonic() - start_time)
+                answers = regions.split_region_answers(response, len(batch))
+                logging.info(f"Analyzed {len(batch)} regions in one request, {len(answers)} answers parsed")
+            for index, (region, image, image_base64, prompt) in enumerate(batch):
+                if index in answers:
+                    descriptions[region.name] = answers[index]
+                    self.result_cache.store(self.result_cache.image_hash(image), prompt, backend, model,
+                                            answers[index])
+                else:
+                    # Single region, or the model's answer for this image could not be found
+                    descriptions[region.name] = self.analyze(image, prompt, image_base64, cancel=cancel)
+        return descriptions
+
+    def changed_crops(self, frame):
+        """
+        Crop the changed areas out of the full-size grab when they are a small part of the frame.
+        :return: (boxes, base64 crops), or None to send the whole frame
+        """
+        if self.tile_detector is None or frame.luma is None or frame.raw_image is None:
+            return None
+        boxes, share = self.tile_detector.changed_boxes(frame.luma)
+        if not boxes or self.last_description is None or self.crop_analyses >= self.config["tile_full_refresh"]:
+            return None
+        # The crops share the pixel budget of a full frame, so small areas are sent at full resolution
+        settings = copy.copy(self.preprocess_settings)
+        settings.max_pixels = self.preprocess_settings.max_pixels // len(boxes)
+        crops = [encode_image_to_base64(resize_image(frame.raw_image.crop(box), settings), settings)
+                 for box in boxes]
+        logging.info(f"{share:.1%} of the frame changed, sending {len(crops)} crops "
+                     f"({sum(len(crop) for crop in crops) // 1024} KB instead of {len(frame.image_base64) // 1024} KB)")
+        return boxes, crops
+
+    def reschedule(self, changed):
+        if not self.config["adaptive_schedule"]:
+            return
+        interval, reason = self.scheduler.record_frame(changed)
+        self.capture_interval = interval
+        self._notify(self.on_schedule, interval, reason)
+
+    def analyze(self, image, prompt, image_base64=None, crops=None, cancel=None, combined=False):
+        """
+        :param crops: Encoded images sent instead of the frame; the cache is still keyed on the whole frame
+        :param cancel: CancelToken that aborts the request
+        :param combined: The prompt asks for alert verdicts, which are kept out of the streamed text
+        :raises GenerationCancelled: When the request was cancelled
+        """
+        backend = self.backend
+        model = self.ollama_model if backend in ("ollama", "pool") else None
+        image_hash = self.result_cache.image_hash(image)
+        cached = self.result_cache.lookup(image_hash, prompt, backend, model)
+        if cached is not None:
+            return cached
+
+        on_token = None
+        if self.config["stream_responses"] and self.on_partial is not None:
+            on_token = StreamThrottle(self.on_partial, self.config["stream_update_interval"],
+                                      alerts.strip_partial_verdicts if combined else str.strip)
+        start_time = time.monotonic()
+        description = self.get_client(backend).analyze(crops or image_base64 or image, prompt, model,
+                                                       on_token=on_token, cancel=cancel)
+        self.scheduler.record_inference(time.monotonic() - start_time)
+        self.log_latency(backend, start_time, time.monotonic() - start_time)
+        self.result_cache.store(image_hash, prompt, backend, model, description)
+        return description
+
+    def get_client(self, backend):
+        # Clients are kept for the lifetime of the engine so their connections are reused
+        with self.client_lock:
+            client = self.clients.get(backend)
+            if client is None:
+                # Imported here so starting up does not wait for requests
+                from backend_client import create_backend_client
+                client = self.clients[backend] = create_backend_client(backend, self.config)
+            return client
+
+    def frame_needs_analysis(self, image):
+        # A different prompt or backend invalidates the previous description
+        analysis_key = (self.system_prompt, self.backend, self.ollama_model, self.capture_box,
+                        self.alert_engine.version)
+        if analysis_key != self.last_analysis_key:
+            self.last_analysis_key = analysis_key
+            self.change_detector.reset()
+            if self.tile_detector is not None:
+                self.tile_detector.reset()
+
+        changed = self.change_detector.has_changed(image)
+        return changed or self.last_description is None
+
+    def check_alert_condition(self, image, analysis_text, rules):
+        # One extra image request for all rules, sent to the selected backend
+        backend = self.backend
+        model = self.ollama_model if backend in ("ollama", "pool") else None
+        response = self.get_client(backend).analyze(image, alerts.build_image_check_prompt(rules, analysis_text), model)
+        return alerts.parse_answers(response, rules)
+
+    def check_alert_text(self, analysis_text, rules):
+        # Judge all rules from the description alone; only short answers are generated
+        backend = self.backend
+        model = self.ollama_model if backend in ("ollama", "pool") else None
+        response = self.get_client(backend).generate_text(alerts.build_text_check_prompt(rules, analysis_text),
+                                                          model, max_length=self.config["alert_max_length"] * len(rules))
+        return alerts.parse_answers(response, rules)
+
+    def stop(self):
+        """Make run_analysis() return; the request in progress is cancelled."""
+        self.running = False
+        self.cancel_analysis("stopping")
+        self.pipeline.wake()
+
+    def close(self):
+        """Release everything; call after run_analysis() has returned."""
+        self.pipeline.close()
+        if self.warm_up_thread is not None:
+            self.warm_up_thread.join(timeout=self.config["connect_timeout"])
+        for client in self.clients.values():
+            client.close()
+        self.clients.clear()
+        with self.capture_lock:
+            if self.capture_backend is not None:
+                self.capture_backend.close()
+                self.capture_backend = None
+        self.retention.close()
+        self.result_cache.close()
+        if self.frame_archive is not None:
+            self.frame_archive.close()
+        # Commit any history rows still queued in the writer thread
+        self.history_manager.close()
@@ -0,0 +1,279 @@
+import hashlib
+import importlib.util
+import io
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from PIL import Image
+
+
+# "zlib" and "zstd" compress the raw pixels, which is several times faster than PNG at about
+# the same size; "png" and "webp" (lossless) store standard image files
+ARCHIVE_CODECS = ("zlib", "zstd", "png", "webp")
+
+
+def encode_frame(image, codec, raw=None):
+    """
+    :param raw: image.tobytes(), if the caller already has it
+    :return: Compressed bytes
+    """
+    if codec == "zlib":
+        return zlib.compress(raw if raw is not None else image.tobytes(), 1)
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=1).compress(raw if raw is not None else image.tobytes())
+    buffer = io.BytesIO()
+    if codec == "png":
+        image.save(buffer, format="PNG", compress_level=1)
+    else:
+        image.save(buffer, format="WEBP", lossless=True, method=0, quality=0)
+    return buffer.getvalue()
+
+
+def decode_frame(data, codec, mode, size):
+    """
+    :param data: Compressed bytes or a memoryview of them
+    """
+    if codec == "zlib":
+        return Image.frombytes(mode, size, zlib.decompress(data))
+    if codec == "zstd":
+        import zstandard
+        return Image.frombytes(mode, size, zstandard.ZstdDecompressor().decompress(data))
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def read_frame(path, offset, length, codec, mode, width, height):
+    """
+    Read one frame straight from its segment file, without a FrameArchive. Used by worker processes.
+    :return: PIL Image
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    if len(data) != length:
+        raise OSError(f"Frame at {path}:{offset} is truncated")
+    return decode_frame(data, codec, mode, (width, height))
+
+
+class FrameArchive:
+    """
+    Append-only storage for full-size captures.
+
+    Frames are compressed and appended to segment files (segment_000001.bin, ...) in `directory`.
+    Their location is indexed in the `frames` table of the history database, which links each frame
+    to its analysis_history row through analysis_history.frame_id. A new segment is started once the
+    current one reaches segment_size bytes. Frames with identical pixels are stored once when dedup is
+    on. Frames are read back through a memory map of their segment, so opening one old frame reads
+    only that frame from disk. Space is reclaimed by dropping whole segments, oldest first.
+    """
+
+    def __init__(self, directory='frame_archive', db_path='analysis_history.db', codec="zlib",
+                 segment_size=256 * 1024 ** 2, dedup=True):
+        if codec not in ARCHIVE_CODECS:
+            raise ValueError(f"Unknown archive codec: {codec}")
+        if codec == "zstd" and importlib.util.find_spec("zstandard") is None:
+            logging.warning("zstandard is not installed, archiving frames with zlib")
+            codec = "zlib"
+        self.directory = directory
+        self.codec = codec
+        self.segment_size = segment_size
+        self.dedup = dedup
+        self.lock = threading.Lock()
+        self.maps = {}  # segment id -> (file, mmap) for reads
+        os.makedirs(directory, exist_ok=True)
+        # Used by the preprocess workers, the GUI and the retention thread, always under self.lock
+        self.conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self.init_db()
+        self.segment_id, self.segment_file = self.open_segment()
+
+    @classmethod
+    def from_config(cls, config, db_path):
+        return cls(config["archive_dir"], db_path, codec=config["archive_codec"],
+                   segment_size=config["archive_segment_size"], dedup=config["archive_dedup"])
+
+    def init_db(self):
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS frame_segments (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    first_at REAL,
+                    last_at REAL
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS frames (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    segment_id INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    codec TEXT NOT NULL,
+                    mode TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    captured_at REAL NOT NULL,
+                    content_hash BLOB
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_frames_content_hash ON frames (content_hash)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_frames_segment ON frames (segment_id)')
+
+    def open_segment(self):
+        """Continue the newest segment, or start the first one."""
+        row = self.conn.execute('SELECT id, path FROM frame_segments ORDER BY id DESC LIMIT 1').fetchone()
+        if row is None:
+            return self.new_segment()
+        return row[0], open(row[1], 'ab')
+
+    def new_segment(self, segment_id=1):
+        path = os.path.join(self.directory, f"segment_{segment_id:06d}.bin")
+        with self.conn:
+            self.conn.execute('INSERT INTO frame_segments (id, path) VALUES (?, ?)', (segment_id, path))
+        logging.info(f"Started frame archive segment {path}")
+        return segment_id, open(path, 'ab')
+
+    def append(self, image, captured_at):
+        """
+        Store a capture. Safe to call from several threads.
+        :param captured_at: datetime of the capture
+        :return: Frame id to link with the history row
+        """
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGB')
+        raw = image.tobytes() if self.codec in ("zlib", "zstd") or self.dedup else None
+        content_hash = hashlib.blake2b(raw, digest_size=16).digest() if self.dedup else None
+        if content_hash is not None:
+            with self.lock:
+                row = self.conn.execute('SELECT id FROM frames WHERE content_hash = ? LIMIT 1',
+                                        (content_hash,)).fetchone()
+            if row is not None:
+                return row[0]
+
+        # Compress outside the lock so preprocess workers can encode in parallel
+        data = encode_frame(image, self.codec, raw)
+        timestamp = captured_at.timestamp()
+        with self.lock:
+            offset = self.segment_file.tell()
+            if offset and offset + len(data) > self.segment_size:
+                self.segment_file.close()
+                self.segment_id, self.segment_file = self.new_segment(self.segment_id + 1)
+                offset = 0
+            self.segment_file.write(data)
+            self.segment_file.flush()
+            with self.conn:
+                cursor = self.conn.execute('''
+                    INSERT INTO frames (segment_id, offset, length, codec, mode, width, height, captured_at, content_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (self.segment_id, offset, len(data), self.codec, image.mode, image.width, image.height,
+                      timestamp, content_hash))
+                self.conn.execute('UPDATE frame_segments SET size = ?, first_at = COALESCE(first_at, ?), last_at = ? '
+                                  'WHERE id = ?', (offset + len(data), timestamp, timestamp, self.segment_id))
+            return cursor.lastrowid
+
+    def _map(self, segment_id, path, end):
+        """Memory map of a segment covering at least `end` bytes; the active segment is remapped as it grows."""
+        mapped = self.maps.get(segment_id)
+        if mapped is not None and len(mapped[1]) >= end:
+            return mapped[1]
+        if mapped is not None:
+            mapped[1].close()
+            mapped[0].close()
+        f = open(path, 'rb')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps[segment_id] = (f, mm)
+        return mm
+
+    def load(self, frame_id):
+        """
+        :return: The archived PIL Image, or None if the frame is not (or no longer) in the archive
+        """
+        with self.lock:
+            row = self.conn.execute('''
+                SELECT f.segment_id, s.path, f.offset, f.length, f.codec, f.mode, f.width, f.height
+                FROM frames f JOIN frame_segments s ON s.id = f.segment_id WHERE f.id = ?
+            ''', (frame_id,)).fetchone()
+            if row is None:
+                return None
+            segment_id, path, offset, length, codec, mode, width, height = row
+            if segment_id == self.segment_id:
+                self.segment_file.flush()
+            try:
+                mm = self._map(segment_id, path, offset + length)
+            except (OSError, ValueError) as e:
+                logging.error(f"Cannot read frame {frame_id} from {path}: {e}")
+                return None
+            view = memoryview(mm)[offset:offset + length]
+            try:
+                return decode_frame(view, codec, mode, (width, height))
+            finally:
+                view.release()
+
+    def frame_locations(self, start=None, end=None):
+        """
+        Where the frames captured between start and end (datetimes, inclusive) are stored.
+        :return: List of (frame id, captured_at timestamp, location) ordered by capture time, where
+            location is the argument tuple for read_frame()
+        """
+        with self.lock:
+            self.segment_file.flush()
+            rows = self.conn.execute('''
+                SELECT f.id, f.captured_at, s.path, f.offset, f.length, f.codec, f.mode, f.width, f.height
+                FROM frames f JOIN frame_segments s ON s.id = f.segment_id
+                WHERE f.captured_at >= ? AND f.captured_at <= ? ORDER BY f.captured_at, f.id
+            ''', (start.timestamp() if start else 0, end.timestamp() if end else float('inf'))).fetchall()
+        return [(row[0], row[1], tuple(row[2:])) for row in rows]
+
+    def total_bytes(self):
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM frame_segments').fetchone()[0]
+
+    def drop_segments(self, max_bytes=None, max_age=None, now=None):
+        """
+        Delete whole segments, oldest first, until the archive fits in max_bytes and holds nothing
+        older than max_age seconds. The segment being written is never dropped.
+        :return: Number of segments deleted
+        """
+        now = time.time() if now is None else now
+        dropped = 0
+        with self.lock:
+            segments = self.conn.execute('SELECT id, path, size, last_at FROM frame_segments WHERE id != ? '
+                                         'ORDER BY id', (self.segment_id,)).fetchall()
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM frame_segments').fetchone()[0]
+            for segment_id, path, size, last_at in segments:
+                too_big = max_bytes is not None and total > max_bytes
+                too_old = max_age is not None and last_at is not None and last_at < now - max_age
+                if not (too_big or too_old):
+                    break
+                mapped = self.maps.pop(segment_id, None)
+                if mapped is not None:
+                    mapped[1].close()
+                    mapped[0].close()
+                with self.conn:
+                    self.conn.execute('DELETE FROM frames WHERE segment_id = ?', (segment_id,))
+                    self.conn.execute('DELETE FROM frame_segments WHERE id = ?', (segment_id,))
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                dropped += 1
+        if dropped:
+            logging.info(f"Dropped {dropped} frame archive segments, {total / 1024 ** 2:.1f} MB left")
+        return dropped
+
+    def close(self):
+        with self.lock:
+            for f, mm in self.maps.values():
+                mm.close()
+                f.close()
+            self.maps.clear()
+            self.segment_file.close()
+            self.conn.close()
@@ -0,0 +1,191 @@
+import logging
+
+from PIL import Image
+
+
+def dhash(image, hash_size=8):
+    """
+    Compute a difference hash (dHash) of an image.
+    :param image: PIL Image object
+    :param hash_size: Width/height of the hash grid; the hash has hash_size * hash_size bits
+    :return: Hash as a Python int
+    """
+    # Shrink to a (hash_size + 1) x hash_size grayscale thumbnail and compare neighbouring pixels
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = small.tobytes()
+    row_width = hash_size + 1
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * row_width
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class FrameChangeDetector:
+    """
+    Decides whether a new frame differs enough from the last analyzed frame to be worth
+    sending to the model. Frames are compared by the Hamming distance of their dHash.
+    """
+
+    def __init__(self, threshold=6, hash_size=16):
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.last_hash = None
+        self.current_hash = None
+        self.last_distance = None
+
+    def has_changed(self, image):
+        self.current_hash = dhash(image, self.hash_size)
+        if self.last_hash is None:
+            self.last_distance = None
+            return True
+        self.last_distance = hamming_distance(self.current_hash, self.last_hash)
+        return self.last_distance > self.threshold
+
+    def mark_analyzed(self):
+        # Remember the frame that the current description belongs to, so a failed
+        # analysis never causes the next frame to be skipped
+        self.last_hash = self.current_hash
+
+    def reset(self):
+        self.last_hash = None
+        self.current_hash = None
+        self.last_distance = None
+        logging.info("Frame change detector reset")
+
+
+class TileChangeDetector:
+    """
+    Finds the parts of the screen that changed since the last analyzed frame.
+
+    Frames are compared as full-resolution luminance arrays over a grid of tile_size tiles. A
+    tile is dirty when any of its pixels differs by more than pixel_threshold. Neighbouring dirty
+    tiles are merged into bounding boxes, and boxes are merged further until there are at most
+    max_boxes of them. Boxes are only worth computing when little changed: once more than max_area
+    of the tiles are dirty the whole frame is treated as changed.
+    """
+
+    def __init__(self, tile_size=64, pixel_threshold=24, max_boxes=4, max_area=0.3):
+        self.tile_size = tile_size
+        self.pixel_threshold = pixel_threshold
+        self.max_boxes = max_boxes
+        self.max_area = max_area
+        self.reference = None
+        self.current = None
+
+    @staticmethod
+    def luminance(image):
+        # numpy is imported on first use so the hash-only users of this module start quickly
+        import numpy as np
+        return np.asarray(image.convert('L'))
+
+    def dirty_tiles(self, luma):
+        """
+        :param luma: 2D uint8 array from luminance()
+        :return: 2D bool array with one entry per tile, or None when there is no comparable reference
+        """
+        import numpy as np
+        self.current = luma
+        if self.reference is None or self.reference.shape != luma.shape:
+            return None
+        size = self.tile_size
+        height, width = luma.shape
+        rows, cols = -(-height // size), -(-width // size)
+        diff = np.abs(luma.astype(np.int16) - self.reference.astype(np.int16)) > self.pixel_threshold
+        # Pad to whole tiles so the grid can be reduced with a reshape instead of a Python loop
+        padded = np.zeros((rows * size, cols * size), dtype=bool)
+        padded[:height, :width] = diff
+        return padded.reshape(rows, size, cols, size).any(axis=(1, 3))
+
+    def changed_boxes(self, luma):
+        """
+        :return: (list of (left, top, right, bottom) pixel boxes, changed share of the frame area).
+            The boxes are None when there is no reference to compare with or more than max_area changed.
+        """
+        tiles = self.dirty_tiles(luma)
+        if tiles is None:
+            return None, 1.0
+        dirty_share = float(tiles.mean())
+        if dirty_share > self.max_area:
+            return None, dirty_share
+        height, width = luma.shape
+        size = self.tile_size
+        boxes = merge_boxes(tile_components(tiles), self.max_boxes)
+        boxes = [(left * size, top * size, min(right * size, width), min(bottom * size, height))
+                 for left, top, right, bottom in boxes]
+        area = sum((right - left) * (bottom - top) for left, top, right, bottom in boxes)
+        return boxes, area / float(width * height)
+
+    def mark_analyzed(self):
+        self.reference = self.current
+
+    def reset(self):
+        self.reference = None
+        self.current = None
+
+
+def tile_components(tiles):
+    """
+    Group dirty tiles that touch (including diagonally) into bounding boxes.
+    :return: List of (left, top, right, bottom) in tile units, right/bottom exclusive
+    """
+    import numpy as np
+    rows, cols = tiles.shape
+    seen = np.zeros_like(tiles)
+    boxes = []
+    for row, col in zip(*np.nonzero(tiles)):
+        if seen[row, col]:
+            continue
+        seen[row, col] = True
+        stack = [(row, col)]
+        top, left, bottom, right = row, col, row, col
+        while stack:
+            r, c = stack.pop()
+            top, left, bottom, right = min(top, r), min(left, c), max(bottom, r), max(right, c)
+            for nr in range(max(r - 1, 0), min(r + 2, rows)):
+                for nc in range(max(c - 1, 0), min(c + 2, cols)):
+                    if tiles[nr, nc] and not seen[nr, nc]:
+                        seen[nr, nc] = True
+                        stack.append((nr, nc))
+        boxes.append((int(left), int(top), int(right) + 1, int(bottom) + 1))
+    return boxes
+
+
+def merge_boxes(boxes, max_boxes):
+    """
+    Merge overlapping boxes, then keep merging the pair whose union adds the least area until
+    at most max_boxes remain.
+    """
+    def union(a, b):
+        return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+    def area(box):
+        return (box[2] - box[0]) * (box[3] - box[1])
+
+    def overlaps(a, b):
+        return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+    boxes = list(boxes)
+    while True:
+        pair = None
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                if overlaps(boxes[i], boxes[j]):
+                    pair = (i, j)
+                    break
+            if pair:
+                break
+        if pair is None and len(boxes) > max(1, max_boxes):
+            pair = min(((i, j) for i in range(len(boxes)) for j in range(i + 1, len(boxes))),
+                       key=lambda p: area(union(boxes[p[0]], boxes[p[1]])) - area(boxes[p[0]]) - area(boxes[p[1]]))
+        if pair is None:
+            return boxes
+        i, j = pair
+        merged = union(boxes[i], boxes[j])
+        boxes = [box for k, box in enumerate(boxes) if k not in pair] + [merged]
@@ -0,0 +1,133 @@
+"""
+Run screen analysis without the overlay.
+
+    python -m headless [--config config.json] [--prompt TEXT] [--region LEFT TOP RIGHT BOTTOM]
+                       [--duration SECONDS] [--count N] [--json]
+
+Descriptions and alerts are printed to stdout as they arrive and saved to the history database like in
+the overlay. All other settings, including capture_regions, come from the config file. On a server
+without a display, run it against a virtual framebuffer:
+
+    xvfb-run -a -s "-screen 0 1920x1080x24" python -m headless --config config.json
+
+Nothing from PyQt5 is imported, and the capture backend and HTTP client are only loaded when first used.
+"""
+import argparse
+import json
+import logging
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+
+from config import CONFIG_PATH, load_config
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=CONFIG_PATH, help="JSON settings file (default: %(default)s)")
+    parser.add_argument("--prompt", help="analysis prompt, overrides system_prompt")
+    parser.add_argument("--backend", choices=["koboldcpp", "ollama", "pool"], help="overrides backend")
+    parser.add_argument("--model", help="Ollama model, overrides ollama_model")
+    parser.add_argument("--region", nargs=4, type=int, metavar=("LEFT", "TOP", "RIGHT", "BOTTOM"),
+                        help="capture only this part of the screen")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--count", type=int, help="stop after this many analyses")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per result")
+    parser.add_argument("--log-file", default="app.log", help="log file, '-' for stderr (default: %(default)s)")
+    return parser.parse_args(argv)
+
+
+class HeadlessRunner:
+    """
+    Captures on the engine's schedule in the calling thread and analyzes on a background thread
+    until stopped, the duration has passed or `count` results were printed.
+    """
+
+    def __init__(self, engine, duration=None, count=None, as_json=False, out=sys.stdout):
+        self.engine = engine
+        self.duration = duration
+        self.count = count
+        self.as_json = as_json
+        self.out = out
+        self.results = 0
+        self.stop_event = threading.Event()
+        engine.on_analysis = lambda description, frame_id: self.report("analysis", description, frame_id=frame_id)
+        engine.on_region_analysis = lambda name, description, prompt, frame_id: self.report(
+            "analysis", description, frame_id=frame_id, region=name)
+        engine.on_alert = lambda label, text: self.report("alert", text, rule=label)
+        engine.on_error = lambda message: logging.error(f"Error in analysis thread: {message}")
+
+    def report(self, kind, text, **fields):
+        if self.as_json:
+            line = json.dumps(dict(type=kind, time=datetime.now().isoformat(timespec="seconds"), text=text, **fields))
+        elif kind == "alert":
+            line = f"ALERT [{fields['rule']}] {text}"
+        elif fields.get("region"):
+            line = f"[{fields['region']}] {text}"
+        else:
+            line = text
+        print(line, file=self.out, flush=True)
+        if kind == "analysis":
+            self.results += 1
+            if self.count is not None and self.results >= self.count:
+                self.stop()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        engine = self.engine
+        analysis_thread = threading.Thread(target=engine.run_analysis, name="analysis", daemon=True)
+        analysis_thread.start()
+        deadline = time.monotonic() + self.duration if self.duration else None
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    engine.capture_due()
+                except Exception as e:
+                    logging.error(f"Error taking screenshot: {e}")
+                wait = engine.next_capture_interval()
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        break
+                self.stop_event.wait(wait)
+        finally:
+            engine.stop()
+            analysis_thread.join()
+            engine.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(filename=None if args.log_file == "-" else args.log_file, level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    config = load_config(args.config)
+    if args.prompt:
+        config["system_prompt"] = args.prompt
+    if args.backend:
+        config["backend"] = args.backend
+    if args.model:
+        config["ollama_model"] = args.model
+
+    # Imported after logging is set up so the engine's startup messages are not lost
+    from engine import AnalysisEngine
+    engine = AnalysisEngine(config)
+    if args.region:
+        engine.capture_box = tuple(args.region)
+    runner = HeadlessRunner(engine, duration=args.duration, count=args.count, as_json=args.json)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: runner.stop())
+    logging.info(f"Headless analysis started with backend {engine.backend}")
+    warm_up = engine.warm_up()
+    if warm_up is not None:
+        # Nothing is shown before the first result anyway, so let the model load before capturing
+        warm_up.join()
+    runner.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
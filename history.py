@@ -0,0 +1,568 @@
+import csv
+import gzip
+import importlib.util
+import io
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+_STOP = object()
+
+SNIPPET_TOKENS = 16  # words of context in search result snippets
+
+EXPORT_FORMATS = ("json", "jsonl", "csv")
+EXPORT_COLUMNS = ('id', 'timestamp', 'analysis_text', 'prompt', 'region')
+CSV_HEADER = ['ID', 'Timestamp', 'Analysis Text', 'Prompt', 'Region']
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+
+
+def available_compressions():
+    """Compression options for exports; zstd needs the optional zstandard package."""
+    compressions = [None, "gzip"]
+    if importlib.util.find_spec("zstandard") is not None:
+        compressions.append("zstd")
+    return compressions
+
+
+def export_options_from_filename(filename):
+    """
+    Guess (format, compression) from a name like history.jsonl.gz.
+    :return: Format defaults to "json" and compression to None when the suffix is not recognised
+    """
+    stem, suffix = os.path.splitext(filename.lower())
+    compression = COMPRESSION_SUFFIXES.get(suffix)
+    if compression:
+        suffix = os.path.splitext(stem)[1]
+    fmt = suffix.lstrip('.')
+    return (fmt if fmt in EXPORT_FORMATS else "json"), compression
+
+
+def open_export_file(filename, compression=None):
+    """
+    Open a text stream for an export, compressing it on the fly if requested.
+    :param compression: None, "gzip" or "zstd"
+    """
+    if compression is None:
+        return open(filename, 'w', newline='', encoding='utf-8')
+    if compression == "gzip":
+        return gzip.open(filename, 'wt', newline='', encoding='utf-8')
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+        raw = open(filename, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw), newline='', encoding='utf-8')
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def build_fts_query(text):
+    """
+    Turn a search box string into an FTS5 MATCH expression. Words must all match (in any order),
+    "quoted text" matches as a phrase, word* matches as a prefix and the last word is always
+    treated as a prefix so results appear while typing. Every term is quoted, so FTS5 operators
+    and punctuation in the input cannot cause syntax errors.
+    :return: MATCH expression, or '' when the input has no searchable terms
+    """
+    parts = []
+    for phrase, word in re.findall(r'"([^"]*)"?|(\S+)', text):
+        if phrase:
+            parts.append('"' + phrase.replace('"', '""') + '"')
+            continue
+        prefix = word.endswith('*')
+        word = word.strip('*"')
+        if word:
+            parts.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    if parts and not parts[-1].endswith('*') and text and not text[-1].isspace() and not text.endswith('"'):
+        parts[-1] += '*'
+    return ' '.join(parts)
+
+
+def highlight(text, query, context=60):
+    """Fallback snippet for databases without FTS5: the first match with some context, in [brackets]."""
+    index = text.lower().find(query.lower())
+    if index < 0:
+        return text[:context * 2]
+    start = max(0, index - context)
+    end = index + len(query)
+    return (('…' if start else '') + text[start:index] + '[' + text[index:end] + ']' +
+            text[end:end + context] + ('…' if end + context < len(text) else ''))
+
+
+def connect_db(db_path, **kwargs):
+    """
+    Open a connection to the history database with the settings every connection to it uses.
+    The busy timeout lets writers other than the history writer wait for its commits.
+    """
+    conn = sqlite3.connect(db_path, timeout=10, **kwargs)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # With WAL, NORMAL only syncs at checkpoints; a crash can lose the last commits but never corrupts
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-16000')  # 16 MB page cache
+    conn.execute('PRAGMA mmap_size=268435456')  # 256 MB memory-mapped reads
+    return conn
+
+
+class HistoryManager:
+    """
+    Analysis history in SQLite (WAL mode).
+
+    Writes are queued and committed by a background writer thread that owns the only write
+    connection, so callers on the GUI thread never wait for a commit. Inserts that arrive close
+    together are grouped into one transaction. Reads use one connection per calling thread; in
+    WAL mode they do not block behind the writer. Call flush() to wait for queued writes and
+    close() on shutdown.
+    """
+
+    def __init__(self, db_path='analysis_history.db', batch_size=100, commit_interval=0.5):
+        """
+        :param batch_size: Most inserts grouped into one transaction
+        :param commit_interval: Seconds the writer waits for more inserts before committing a batch
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.write_queue = queue.Queue()
+        self.local = threading.local()
+        self.read_connections = []
+        self.read_lock = threading.Lock()
+        self.fts_enabled = False
+        self.init_db()
+        self.writer = threading.Thread(target=self._writer_loop, name="history-writer", daemon=True)
+        self.writer.start()
+
+    def connect(self, **kwargs):
+        return connect_db(self.db_path, **kwargs)
+
+    def init_db(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analysis_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT,
+                analysis_text TEXT,
+                prompt TEXT
+            )
+        ''')
+        # Columns added after the table was first released: the frame archive link and the capture region
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(analysis_history)')]
+        if 'frame_id' not in columns:
+            cursor.execute('ALTER TABLE analysis_history ADD COLUMN frame_id INTEGER')
+        if 'region' not in columns:
+            cursor.execute('ALTER TABLE analysis_history ADD COLUMN region TEXT')
+        # Keyset pagination key for the history view; also serves newest-first listings and exports
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_history_timestamp_id ON analysis_history (timestamp, id)')
+        # Frames finished by each batch re-analysis run (see batch.py), so an interrupted run can resume
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS batch_progress (
+                run TEXT NOT NULL,
+                frame_key TEXT NOT NULL,
+                PRIMARY KEY (run, frame_key)
+            )
+        ''')
+        # Requests abandoned before the model finished, e.g. because the screen changed meanwhile
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cancelled_analyses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT NOT NULL,
+                prompt TEXT,
+                frame_id INTEGER,
+                region TEXT,
+                reason TEXT,
+                elapsed REAL
+            )
+        ''')
+        conn.commit()
+        self.fts_enabled = self.init_fts(conn)
+        conn.close()
+
+    def init_fts(self, conn):
+        """
+        Create the FTS5 index over analysis_text and prompt, kept in sync by triggers, and backfill
+        it once for databases created before the index existed.
+        :return: False when this SQLite build has no FTS5; searches then fall back to LIKE
+        """
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'analysis_history_fts'")
+        exists = cursor.fetchone() is not None
+        try:
+            with conn:
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS analysis_history_fts USING fts5(
+                        analysis_text, prompt, content='analysis_history', content_rowid='id'
+                    )
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS analysis_history_fts_insert AFTER INSERT ON analysis_history BEGIN
+                        INSERT INTO analysis_history_fts (rowid, analysis_text, prompt)
+                        VALUES (new.id, new.analysis_text, new.prompt);
+                    END
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS analysis_history_fts_delete AFTER DELETE ON analysis_history BEGIN
+                        INSERT INTO analysis_history_fts (analysis_history_fts, rowid, analysis_text, prompt)
+                        VALUES ('delete', old.id, old.analysis_text, old.prompt);
+                    END
+                ''')
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS analysis_history_fts_update AFTER UPDATE ON analysis_history BEGIN
+                        INSERT INTO analysis_history_fts (analysis_history_fts, rowid, analysis_text, prompt)
+                        VALUES ('delete', old.id, old.analysis_text, old.prompt);
+                        INSERT INTO analysis_history_fts (rowid, analysis_text, prompt)
+                        VALUES (new.id, new.analysis_text, new.prompt);
+                    END
+                ''')
+                if not exists:
+                    logging.info("Building full-text search index for existing history")
+                    cursor.execute("INSERT INTO analysis_history_fts (analysis_history_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Full-text search unavailable, falling back to LIKE searches: {e}")
+            return False
+        return True
+
+    def read_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False only so close() can close it; each connection is used by one thread
+            conn = self.local.conn = self.connect(check_same_thread=False)
+            with self.read_lock:
+                self.read_connections.append(conn)
+        return conn
+
+    def _writer_loop(self):
+        conn = self.connect()
+        stopping = False
+        while not stopping:
+            item = self.write_queue.get()
+            rows, waiters, jobs = [], [], []
+            deadline = time.monotonic() + self.commit_interval
+            while True:
+                if item is _STOP:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                elif callable(item):
+                    jobs.append(item)
+                else:
+                    rows.append(item)
+                # A flush or shutdown commits straight away; otherwise keep collecting until the batch is full
+                if stopping or waiters or len(rows) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.write_queue.get(timeout=max(0.0, remaining)) if remaining > 0 \
+                        else self.write_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if rows:
+                try:
+                    with conn:
+                        conn.executemany('INSERT INTO analysis_history (timestamp, analysis_text, prompt, frame_id, region) '
+                                         'VALUES (?, ?, ?, ?, ?)', rows)
+                except sqlite3.Error as e:
+                    logging.error(f"Error writing {len(rows)} history rows: {e}")
+            for job in jobs:
+                try:
+                    with conn:
+                        job(conn)
+                except sqlite3.Error as e:
+                    logging.error(f"Error in history maintenance: {e}")
+            for waiter in waiters:
+                waiter.set()
+        conn.close()
+
+    def add_analysis(self, analysis_text, prompt, frame_id=None, region=None):
+        """
+        :param frame_id: FrameArchive id of the analyzed capture
+        :param region: Name of the capture region the analysis belongs to
+        """
+        timestamp = datetime.now().isoformat()
+        self.write_queue.put((timestamp, analysis_text, prompt, frame_id, region))
+
+    def add_cancelled(self, prompt, reason, elapsed, frame_id=None, region=None):
+        """
+        Record a request that was cancelled; it produced no analysis.
+        :param elapsed: Seconds the request ran before it was cancelled
+        """
+        timestamp = datetime.now().isoformat()
+
+        def job(conn):
+            conn.execute('INSERT INTO cancelled_analyses (timestamp, prompt, frame_id, region, reason, elapsed) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', (timestamp, prompt, frame_id, region, reason, elapsed))
+        self.write_queue.put(job)
+
+    def add_batch_results(self, run, results):
+        """
+        Queue the results of a batch run. The history rows and the run's progress records are
+        committed in one transaction, so a frame counts as finished exactly when its result is saved.
+        :param results: (frame key, timestamp, analysis text or None, prompt, frame id) tuples; frames
+            without text are only marked as finished
+        """
+        def job(conn):
+            conn.executemany('INSERT INTO analysis_history (timestamp, analysis_text, prompt, frame_id) VALUES (?, ?, ?, ?)',
+                             [(timestamp, text, prompt, frame_id)
+                              for _, timestamp, text, prompt, frame_id in results if text is not None])
+            conn.executemany('INSERT OR IGNORE INTO batch_progress (run, frame_key) VALUES (?, ?)',
+                             [(run, key) for key, _, _, _, _ in results])
+        self.write_queue.put(job)
+
+    def batch_progress(self, run):
+        """
+        :return: Set of frame keys the batch run has already finished
+        """
+        conn = self.read_connection()
+        return {row[0] for row in conn.execute('SELECT frame_key FROM batch_progress WHERE run = ?', (run,))}
+
+    def reset_batch_progress(self, run):
+        def job(conn):
+            conn.execute('DELETE FROM batch_progress WHERE run = ?', (run,))
+        self.write_queue.put(job)
+
+    def prune(self, max_rows=None, max_age=None, limit=1000):
+        """
+        Queue deletion of the oldest history rows beyond max_rows and of rows older than max_age
+        seconds. Runs on the writer thread; at most limit rows are deleted per call.
+        """
+        def job(conn):
+            deleted = 0
+            if max_age:
+                cutoff = (datetime.now() - timedelta(seconds=max_age)).isoformat()
+                deleted += conn.execute('''
+                    DELETE FROM analysis_history WHERE id IN (
+                        SELECT id FROM analysis_history WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?)
+                ''', (cutoff, limit)).rowcount
+            if max_rows and deleted < limit:
+                excess = conn.execute('SELECT COUNT(*) FROM analysis_history').fetchone()[0] - max_rows
+                if excess > 0:
+                    deleted += conn.execute('''
+                        DELETE FROM analysis_history WHERE id IN (
+                            SELECT id FROM analysis_history ORDER BY timestamp, id LIMIT ?)
+                    ''', (min(excess, limit - deleted),)).rowcount
+            if deleted:
+                logging.info(f"Retention: deleted {deleted} old history rows")
+
+        self.write_queue.put(job)
+
+    def flush(self, timeout=10):
+        """
+        Block until every queued write has been committed.
+        """
+        if not self.writer.is_alive():
+            return
+        done = threading.Event()
+        self.write_queue.put(done)
+        done.wait(timeout)
+
+    def close_read_connection(self):
+        """
+        Close the calling thread's read connection. Worker threads that end before the manager
+        is closed should call this so their connection is not kept open until close().
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            return
+        self.local.conn = None
+        with self.read_lock:
+            if conn in self.read_connections:
+                self.read_connections.remove(conn)
+        conn.close()
+
+    def close(self):
+        if self.writer.is_alive():
+            self.write_queue.put(_STOP)
+            self.writer.join()
+        with self.read_lock:
+            for conn in self.read_connections:
+                conn.close()
+            self.read_connections.clear()
+
+    def get_history(self, limit=100):
+        cursor = self.read_connection().cursor()
+        if limit is None:
+            cursor.execute('SELECT * FROM analysis_history ORDER BY timestamp DESC, id DESC')
+        else:
+            cursor.execute('SELECT * FROM analysis_history ORDER BY timestamp DESC, id DESC LIMIT ?', (limit,))
+        return cursor.fetchall()
+
+    def get_page(self, after=None, limit=200, preview_length=50):
+        """
+        One page of history, newest first, for lazy list views. Uses keyset pagination on the
+        (timestamp, id) index, so every page costs the same no matter how deep the view has scrolled.
+        :param after: (timestamp, id) of the last row of the previous page, None for the first page
+        :return: Rows of (id, timestamp, preview) with only the first preview_length characters of the text
+        """
+        cursor = self.read_connection().cursor()
+        if after is None:
+            cursor.execute('''
+                SELECT id, timestamp, substr(analysis_text, 1, ?) FROM analysis_history
+                ORDER BY timestamp DESC, id DESC LIMIT ?
+            ''', (preview_length, limit))
+        else:
+            cursor.execute('''
+                SELECT id, timestamp, substr(analysis_text, 1, ?) FROM analysis_history
+                WHERE (timestamp, id) < (?, ?)
+                ORDER BY timestamp DESC, id DESC LIMIT ?
+            ''', (preview_length, after[0], after[1], limit))
+        return cursor.fetchall()
+
+    def get_analysis(self, analysis_id):
+        cursor = self.read_connection().cursor()
+        cursor.execute('SELECT * FROM analysis_history WHERE id = ?', (analysis_id,))
+        return cursor.fetchone()
+
+    def search_history(self, query):
+        """
+        Search analysis texts and prompts. With FTS5, results are ranked by relevance and support
+        "phrases" and prefix* matches; otherwise a substring search ordered by time is used.
+        :return: Rows of (id, timestamp, analysis_text, prompt, snippet) where the snippet marks matches in [brackets]
+        """
+        return [row for batch in self.iter_search(query) for row in batch]
+
+    def iter_search(self, query, batch_size=100, cancelled=None):
+        """
+        Like search_history, but yields the results in batches as SQLite produces them.
+        :param cancelled: Optional callable, polled while the query runs; when it returns True the query
+            is interrupted and sqlite3.OperationalError is raised from the generator
+        """
+        conn = self.read_connection()
+        if cancelled is not None:
+            conn.set_progress_handler(lambda: 1 if cancelled() else 0, 1000)
+        try:
+            cursor, fallback = self._execute_search(conn, query, cancelled)
+            while cursor is not None:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if fallback:
+                    rows = [row + (highlight(row[2] or '', query),) for row in rows]
+                yield rows
+        finally:
+            if cancelled is not None:
+                conn.set_progress_handler(None, 0)
+
+    def _execute_search(self, conn, query, cancelled=None):
+        """
+        :return: (cursor positioned before the first result or None for no results, True for the LIKE fallback)
+        """
+        cursor = conn.cursor()
+        if self.fts_enabled:
+            match = build_fts_query(query)
+            if not match:
+                return None, False
+            try:
+                cursor.execute(f'''
+                    SELECT h.id, h.timestamp, h.analysis_text, h.prompt,
+                           snippet(analysis_history_fts, 0, '[', ']', '…', {SNIPPET_TOKENS})
+                    FROM analysis_history_fts
+                    JOIN analysis_history h ON h.id = analysis_history_fts.rowid
+                    WHERE analysis_history_fts MATCH ?
+                    ORDER BY rank
+                ''', (match,))
+                return cursor, False
+            except sqlite3.OperationalError as e:
+                if cancelled is not None and cancelled():
+                    raise
+                logging.warning(f"Full-text search failed for {query!r}, using substring search: {e}")
+
+        cursor.execute('SELECT id, timestamp, analysis_text, prompt FROM analysis_history '
+                       'WHERE analysis_text LIKE ? OR prompt LIKE ? ORDER BY timestamp DESC, id DESC',
+                       (f'%{query}%', f'%{query}%'))
+        return cursor, True
+
+    def export(self, filename, fmt=None, compression=None, start=None, end=None, prompt=None,
+               progress=None, cancelled=None, chunk_size=1000):
+        """
+        Stream history rows, newest first, into a JSON, JSON Lines or CSV file. Rows are read from
+        the cursor in chunks and written straight out, so memory use does not grow with the history.
+        :param fmt: "json", "jsonl" or "csv"; guessed from the file name when None
+        :param compression: None, "gzip" or "zstd"; guessed from a .gz/.zst suffix when fmt is None
+        :param start: Only rows at or after this datetime (or ISO timestamp string)
+        :param end: Only rows before this datetime (or ISO timestamp string)
+        :param prompt: Only rows whose prompt contains this text
+        :param progress: Called as progress(rows_written, total_rows) after every chunk
+        :param cancelled: Polled between chunks; when it returns True the partial file is removed
+        :return: Number of rows written, or None if the export was cancelled
+        """
+        if fmt is None:
+            fmt, compression = export_options_from_filename(filename)
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {fmt}")
+        self.flush()
+
+        conditions, params = [], []
+        if start is not None:
+            conditions.append('timestamp >= ?')
+            params.append(start if isinstance(start, str) else start.isoformat())
+        if end is not None:
+            conditions.append('timestamp < ?')
+            params.append(end if isinstance(end, str) else end.isoformat())
+        if prompt:
+            conditions.append('prompt LIKE ?')
+            params.append(f'%{prompt}%')
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+
+        # A private connection, so exports can run on any thread without leaving a connection behind
+        conn = self.connect()
+        written = 0
+        try:
+            total = conn.execute(f'SELECT COUNT(*) FROM analysis_history {where}', params).fetchone()[0]
+            cursor = conn.execute(f'SELECT {", ".join(EXPORT_COLUMNS)} FROM analysis_history {where} '
+                                  f'ORDER BY timestamp DESC, id DESC', params)
+            with open_export_file(filename, compression) as f:
+                if fmt == "csv":
+                    writer = csv.writer(f)
+                    writer.writerow(CSV_HEADER)
+                elif fmt == "json":
+                    f.write('[')
+                while True:
+                    if cancelled is not None and cancelled():
+                        break
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    if fmt == "csv":
+                        writer.writerows(rows)
+                    elif fmt == "jsonl":
+                        f.writelines(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n'
+                                     for row in rows)
+                    else:
+                        for row in rows:
+                            # Same layout as json.dump(..., indent=2) of the whole list, one item at a time
+                            item = json.dumps(dict(zip(EXPORT_COLUMNS, row)), indent=2, ensure_ascii=False)
+                            f.write((',\n  ' if written else '\n  ') + item.replace('\n', '\n  '))
+                            written += 1
+                    if fmt != "json":
+                        written += len(rows)
+                    if progress is not None:
+                        progress(written, total)
+                if fmt == "json":
+                    f.write('\n]' if written else ']')
+        finally:
+            conn.close()
+
+        if cancelled is not None and cancelled():
+            os.remove(filename)
+            logging.info(f"History export to {filename} cancelled")
+            return None
+        logging.info(f"Exported {written} history rows to {filename}")
+        return written
+
+    def export_to_json(self, filename):
+        return self.export(filename, "json")
+
+    def export_to_csv(self, filename):
+        return self.export(filename, "csv")
+
+    def get_analysis_by_timestamp(self, timestamp):
+        cursor = self.read_connection().cursor()
+        cursor.execute('SELECT * FROM analysis_history WHERE timestamp = ?', (timestamp,))
+        return cursor.fetchone()
@@ -0,0 +1,189 @@
+import logging
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QObject, QTimer, pyqtSignal, pyqtSlot
+
+
+_STOP = object()
+
+
+class HistoryListModel(QAbstractListModel):
+    """
+    List model for the history dialog.
+
+    Browsing loads rows page by page through fetchMore as the view scrolls, so opening the dialog
+    costs one small query however large the database is. Each row keeps its database id, which
+    the view reads through IdRole to fetch the full analysis by primary key.
+    Search results are shown with show_rows and are not paginated.
+    """
+
+    IdRole = Qt.UserRole + 1
+
+    def __init__(self, history_manager, page_size=200, parent=None):
+        super().__init__(parent)
+        self.history_manager = history_manager
+        self.page_size = page_size
+        self.rows = []  # (id, timestamp, text shown after the timestamp)
+        self.paginated = True
+        self.exhausted = False
+
+    def show_all(self):
+        """Browse the whole history, newest first; rows are loaded as the view asks for them."""
+        self.beginResetModel()
+        self.rows = []
+        self.paginated = True
+        self.exhausted = False
+        self.endResetModel()
+
+    def show_rows(self, rows):
+        """Show a fixed list of (id, timestamp, text) rows, such as search results."""
+        self.beginResetModel()
+        self.rows = list(rows)
+        self.paginated = False
+        self.endResetModel()
+
+    def append_rows(self, rows):
+        """Add (id, timestamp, text) rows to the end of a list started with show_rows."""
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < len(self.rows):
+            return None
+        analysis_id, timestamp, text = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            if self.paginated:
+                return f"{timestamp}: {(text or '').replace(chr(10), ' ')}..."
+            return f"{timestamp}: {(text or '').replace(chr(10), ' ')}"
+        if role == self.IdRole:
+            return analysis_id
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.paginated and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        after = (self.rows[-1][1], self.rows[-1][0]) if self.rows else None
+        page = self.history_manager.get_page(after, self.page_size)
+        if len(page) < self.page_size:
+            self.exhausted = True
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+            self.rows.extend(page)
+            self.endInsertRows()
+
+
+class HistorySearchController(QObject):
+    """
+    Runs history searches for a search box without blocking the GUI thread.
+
+    set_query waits until typing pauses for debounce_ms, then hands the query to a worker thread.
+    A newer query cancels the one still running (SQLite's progress handler aborts it mid-statement).
+    Results are shown in the model batch by batch as they arrive. The last cache_size completed
+    searches are kept so that going back to an earlier query, e.g. with backspace, is instant.
+    Call close() when the search box goes away.
+    """
+
+    batch_ready = pyqtSignal(int, list)  # (generation, rows)
+    search_done = pyqtSignal(int, str, bool)  # (generation, query, completed)
+
+    def __init__(self, history_manager, model, debounce_ms=250, cache_size=32, batch_size=100, parent=None):
+        super().__init__(parent)
+        self.history_manager = history_manager
+        self.model = model
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.cache = OrderedDict()  # query -> rows, most recently used last
+        self.generation = 0
+        self.pending_query = ''
+        self.pending_rows = []
+        self.cancel_event = threading.Event()
+        self.jobs = queue.Queue()
+
+        self.debounce_timer = QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(debounce_ms)
+        self.debounce_timer.timeout.connect(self.start_search)
+
+        self.batch_ready.connect(self.add_batch)
+        self.search_done.connect(self.finish_search)
+        self.worker = threading.Thread(target=self._search_loop, name="history-search", daemon=True)
+        self.worker.start()
+
+    @pyqtSlot(str)
+    def set_query(self, query):
+        self.pending_query = query.strip()
+        # Whatever is running now is already out of date
+        self.cancel_event.set()
+        self.debounce_timer.start()
+
+    def start_search(self):
+        self.generation += 1
+        self.cancel_event.set()
+        query = self.pending_query
+        if not query:
+            self.model.show_all()
+            return
+        if query in self.cache:
+            self.cache.move_to_end(query)
+            self.model.show_rows(self.cache[query])
+            return
+        self.cancel_event = threading.Event()
+        self.pending_rows = []
+        self.model.show_rows([])
+        self.jobs.put((self.generation, query, self.cancel_event))
+
+    def _search_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is _STOP:
+                break
+            generation, query, cancel_event = job
+            if cancel_event.is_set():
+                continue
+            completed = False
+            try:
+                for batch in self.history_manager.iter_search(query, self.batch_size, cancel_event.is_set):
+                    self.batch_ready.emit(generation, [(row[0], row[1], row[4]) for row in batch])
+                completed = True
+            except sqlite3.OperationalError as e:
+                if not cancel_event.is_set():
+                    logging.error(f"History search for {query!r} failed: {e}")
+            self.search_done.emit(generation, query, completed and not cancel_event.is_set())
+        self.history_manager.close_read_connection()
+
+    @pyqtSlot(int, list)
+    def add_batch(self, generation, rows):
+        # Batches of a superseded search can still be queued when the next one starts
+        if generation != self.generation:
+            return
+        self.pending_rows.extend(rows)
+        self.model.append_rows(rows)
+
+    @pyqtSlot(int, str, bool)
+    def finish_search(self, generation, query, completed):
+        if generation != self.generation or not completed:
+            return
+        self.cache[query] = self.pending_rows
+        self.pending_rows = []
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def close(self, timeout=2.0):
+        self.debounce_timer.stop()
+        self.cancel_event.set()
+        self.jobs.put(_STOP)
+        # The running query is interrupted, so this is quick; it keeps the worker from emitting
+        # signals on a controller that is about to be deleted with its dialog
+        self.worker.join(timeout)
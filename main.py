@@ -1,306 +1,137 @@
 
 import sys
 import time
-import pyautogui
-from PIL import Image, ImageGrab
-import io
-import requests
-import base64
 import logging
-import os
-import json
-import csv
+import re
 import sqlite3
-from datetime import datetime, time as dt_time
+import threading
+from datetime import datetime, timedelta, time as dt_time
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QLabel, QPushButton, QVBoxLayout, QWidget, QMenu,
-                             QHBoxLayout, QFileDialog, QInputDialog, QMessageBox, QSizePolicy, QLayout, QStyle, QDialog, QLineEdit, QListWidget, QScrollArea, QTextEdit, QTimeEdit, QDialogButtonBox, QRadioButton)
-from PyQt5.QtCore import Qt, QTimer, QPoint, QRect, QThread, QObject, pyqtSignal, pyqtSlot, QSize, QTime
-from PyQt5.QtGui import QFont, QPainter, QPen, QPixmap, QCursor, QColor
-import json
+                             QHBoxLayout, QFileDialog, QInputDialog, QMessageBox, QSizePolicy, QLayout, QStyle, QDialog, QLineEdit, QListWidget, QListView, QScrollArea, QTextEdit, QTimeEdit, QDialogButtonBox, QRadioButton, QSpinBox,
+                             QComboBox, QCheckBox, QDateTimeEdit, QProgressBar)
+from PyQt5.QtCore import Qt, QTimer, QPoint, QRect, QThread, QObject, pyqtSignal, pyqtSlot, QSize, QTime, QDateTime
+from PyQt5.QtGui import QFont, QPainter, QPen, QPixmap, QImage, QCursor, QColor
 from queue import Queue
+from config import load_config
+from backend_client import create_backend_client
+from backend_pool import format_endpoint_stats
+from capture import create_capture_backend
+from engine import AnalysisEngine
+import alerts
+import regions
+from history import available_compressions
+from history_model import HistoryListModel, HistorySearchController
+from preprocess import resize_image
 
 
-# KoboldCPP server settings
-KOBOLDCPP_URL = "http://localhost:5001/api/v1/generate"
-
 logging.basicConfig(filename='app.log', level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+CONFIG = load_config()
+
+
+def pil_to_pixmap(image):
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    data = image.tobytes()
+    qimage = QImage(data, image.width, image.height, image.width * 3, QImage.Format_RGB888)
+    # QImage does not own `data`; the copy does
+    return QPixmap.fromImage(qimage.copy())
+
 
-def resize_image(image):
+class ExportWorker(QObject):
     """
-    Resize the image if it exceeds 1.8 million pixels while maintaining aspect ratio.
-    :param image: PIL Image object
-    :return: Resized PIL Image object if necessary, otherwise the original image
+    Runs a history export on its own thread so the export dialog stays responsive.
     """
-    MAX_PIXELS = 1_800_000  # 1.8 million pixels
-    
-    # Calculate current number of pixels
-    current_pixels = image.width * image.height
-    
-    # If the image is already small enough, return it as is
-    if current_pixels <= MAX_PIXELS:
-        return image
-    
-    # Calculate the scale factor needed to reduce to 1.8 million pixels
-    scale_factor = (MAX_PIXELS / current_pixels) ** 0.5
-    
-    # Calculate new dimensions, ensuring we round down
-    new_width = int(image.width * scale_factor)
-    new_height = int(image.height * scale_factor)
-    
-    # Resize the image using LANCZOS resampling
-    return image.resize((new_width, new_height), Image.LANCZOS)
-
-
-def encode_image_to_base64(image):
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8') 
-
-class HistoryManager:
-    def __init__(self, db_path='analysis_history.db'):
-        self.db_path = db_path
-        self.init_db()
-
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS analysis_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT,
-                analysis_text TEXT,
-                prompt TEXT
-            )
-        ''')
-        conn.commit()
-        conn.close()
-
-    def add_analysis(self, analysis_text, prompt):
-        timestamp = datetime.now().isoformat()
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO analysis_history (timestamp, analysis_text, prompt) VALUES (?, ?, ?)',
-                       (timestamp, analysis_text, prompt))
-        conn.commit()
-        conn.close()
-
-    def get_history(self, limit=100):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        if limit is None:
-            cursor.execute('SELECT * FROM analysis_history ORDER BY timestamp DESC')
-        else:
-            cursor.execute('SELECT * FROM analysis_history ORDER BY timestamp DESC LIMIT ?', (limit,))
-        history = cursor.fetchall()
-        conn.close()
-        return history
-
-    def search_history(self, query):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM analysis_history WHERE analysis_text LIKE ? OR prompt LIKE ? ORDER BY timestamp DESC',
-                       (f'%{query}%', f'%{query}%'))
-        results = cursor.fetchall()
-        conn.close()
-        return results
-
-    def export_to_json(self, filename):
-        history = self.get_history(limit=None)
-        data = [{'id': item[0], 'timestamp': item[1], 'analysis_text': item[2], 'prompt': item[3]} for item in history]
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-
-    def export_to_csv(self, filename):
-        history = self.get_history(limit=None)
-        with open(filename, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['ID', 'Timestamp', 'Analysis Text', 'Prompt'])
-            writer.writerows(history)
-
-    def get_analysis_by_timestamp(self, timestamp):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM analysis_history WHERE timestamp = ?', (timestamp,))
-        analysis = cursor.fetchone()
-        conn.close()
-        return analysis
+    progress = pyqtSignal(int, int)  # (rows written, total rows)
+    export_finished = pyqtSignal(object)  # rows written, None if cancelled
+    export_failed = pyqtSignal(str)
+
+    def __init__(self, history_manager, filename, **options):
+        super().__init__()
+        self.history_manager = history_manager
+        self.filename = filename
+        self.options = options
+        self.cancel_event = threading.Event()
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            written = self.history_manager.export(self.filename, progress=self.progress.emit,
+                                                  cancelled=self.cancel_event.is_set, **self.options)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            logging.error(f"History export to {self.filename} failed: {e}")
+            self.export_failed.emit(str(e))
+            return
+        self.export_finished.emit(written)
+
+    def cancel(self):
+        self.cancel_event.set()
 
 
 class AnalysisWorker(QObject):
-    analysis_complete = pyqtSignal(str)
+    """
+    Runs the engine's analysis loop on a QThread and forwards its callbacks as Qt signals,
+    so the overlay receives them on the GUI thread.
+    """
+    analysis_complete = pyqtSignal(str, object)  # (description, archived frame id or None)
+    region_analysis_complete = pyqtSignal(str, str, str, object)  # (region name, description, prompt, frame id)
+    partial_result = pyqtSignal(str)
     alert_triggered = pyqtSignal(str, str)
     error_occurred = pyqtSignal(str)
+    analysis_cancelled = pyqtSignal(str)  # reason
     request_screenshot = pyqtSignal()
-    screenshot_taken = pyqtSignal()  # Changed to no-argument signal
+    schedule_changed = pyqtSignal(float, str)
 
-    def __init__(self):
+    def __init__(self, engine):
         super().__init__()
-        self.running = True
         self.queue = Queue()
-        self.overlay = None
-
-    def set_overlay(self, overlay):
-        self.overlay = overlay
+        self.engine = engine
+        engine.on_analysis = self.analysis_complete.emit
+        engine.on_region_analysis = self.region_analysis_complete.emit
+        engine.on_partial = self.partial_result.emit
+        engine.on_alert = self.alert_triggered.emit
+        engine.on_schedule = self.schedule_changed.emit
+        engine.on_cancelled = self.analysis_cancelled.emit
+        engine.on_error = self.error_occurred.emit
 
     @pyqtSlot()
     def run_analysis(self):
-        while self.running:
-            try:
-                current_time = datetime.now().time()
-                if (self.overlay and 
-                    not self.overlay.is_paused and 
-                    not self.overlay.analysis_paused and
-                    (not self.overlay.timer_start or 
-                     (self.overlay.timer_start <= current_time < self.overlay.timer_end))):
-                    
-                    self.request_screenshot.emit()
-                    # Wait for the screenshot to be taken
-                    timeout = 5  # 5 seconds timeout
-                    start_time = time.time()
-                    while (not hasattr(self.overlay, 'current_image') or 
-                           self.overlay.current_image is None or 
-                           self.overlay.current_image.getbbox() is None):
-                        if time.time() - start_time > timeout:
-                            logging.warning("Timeout waiting for valid screenshot")
-                            break
-                        time.sleep(0.1)
-
-                    if self.overlay.current_image and self.overlay.current_image.getbbox() is not None:
-                        # Choose the appropriate backend for analysis
-                        if self.overlay.backend == "koboldcpp":
-                            description = analyze_image_with_koboldcpp(self.overlay.current_image, self.overlay.system_prompt)
-                        else:  # Ollama
-                            description = analyze_image_with_ollama(self.overlay.current_image, self.overlay.system_prompt, self.overlay.ollama_model)
-                        
-                        self.analysis_complete.emit(description)
-                        
-                        if self.overlay.alert_active:
-                            self.check_alert_condition(self.overlay.current_image, description)
-                    else:
-                        logging.warning("Skipping analysis due to invalid screenshot")
-                
-                # Process any pending UI updates
-                while not self.queue.empty():
-                    func, args = self.queue.get()
-                    func(*args)
-            
-            except Exception as e:
-                self.error_occurred.emit(str(e))
-            
-            time.sleep(5)  # Wait for 5 seconds before the next analysis cycle
+        self.engine.run_analysis(on_wake=self.run_queued)
 
-
-    def check_alert_condition(self, image, analysis_text):
-        check_prompt = f"Based on the image and the following analysis, determine if the condition '{self.overlay.alert_prompt}' is met. Respond with only 'Yes' or 'No'.\n\nImage analysis: {analysis_text}"
-        
-        response = analyze_image_with_koboldcpp(image, check_prompt)
-        
-        if response.strip().lower() == 'yes':
-            self.alert_triggered.emit(self.overlay.alert_prompt, analysis_text)
+    def run_queued(self):
+        # Process any pending UI updates
+        while not self.queue.empty():
+            func, args = self.queue.get()
+            func(*args)
 
     def stop(self):
-        self.running = False
+        self.engine.stop()
 
     def queue_function(self, func, *args):
         self.queue.put((func, args))
-
-
-def analyze_image_with_koboldcpp(image, prompt):
-    if image is None:
-        # Use a blank 1x1 pixel image when no image is provided
-        blank_image = Image.new('RGB', (1, 1), color='white')
-        image_base64 = encode_image_to_base64(blank_image)
-    else:
-        image_base64 = encode_image_to_base64(image)
-    
-    payload = {
-        "n": 1,
-        "max_context_length": 8192,
-        "max_length": 100,
-        "rep_pen": 1.15,
-        "temperature": 0.3,
-        "top_p": 1,
-        "top_k": 0,
-        "top_a": 0,
-        "typical": 1,
-        "tfs": 1,
-        "rep_pen_range": 320,
-        "rep_pen_slope": 0.7,
-        "sampler_order": [6,0,1,3,4,2,5], #[6, 5, 0, 1, 3, 4, 2],
-        "memory": "<|start_header_id|>system<|end_header_id|>\n\n <｜begin_of_sentence｜>{prompt}\n\n",
-        "trim_stop": True,
-        "images": [image_base64],
-        "genkey": "KCPP4535",
-        "min_p": 0.1,
-        "dynatemp_range": 0,
-        "dynatemp_exponent": 1,
-        "smoothing_factor": 0,
-        "banned_tokens": [],
-        "render_special": False,
-        "presence_penalty": 0,
-        "logit_bias": {},
-        "prompt": f"\n(Attached Image)\n<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n",
-        "quiet": True,
-        "stop_sequence": ["<|eot_id|><|start_header_id|>user<|end_header_id|>", "<|eot_id|><|start_header_id|>assistant<|end_header_id|>"],
-        "use_default_badwordsids": False,
-        "bypass_eos": False
-    }
-    
-    try:
-        response = requests.post(KOBOLDCPP_URL, json=payload)
-        response.raise_for_status()
-        result = response.json()
-        return result['results'][0]['text'].strip()
-    except requests.RequestException as e:
-        print(f"Error communicating with KoboldCPP: {e}")
-        return "Unable to analyze image at this time."
-    
-
-def analyze_image_with_ollama(image, prompt, model="llava"):
-    image_base64 = encode_image_to_base64(image)
-    
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "stream": False,  # Change this to True if you want to handle streaming
-        "images": [image_base64]
-    }
-    
-    try:
-        response = requests.post("http://localhost:11434/api/generate", json=payload, stream=True)
-        response.raise_for_status()
-        
-        full_response = ""
-        for line in response.iter_lines():
-            if line:
-                decoded_line = line.decode('utf-8')
-                response_data = json.loads(decoded_line)
-                if 'response' in response_data:
-                    full_response += response_data['response']
-                if 'done' in response_data and response_data['done']:
-                    break
-        
-        return full_response.strip()
-    except requests.RequestException as e:
-        print(f"Error communicating with Ollama: {e}")
-        return "Unable to analyze image at this time."
+        self.engine.pipeline.wake()
 
 
 class TransparentOverlay(QMainWindow):
     def __init__(self):
         super().__init__()
+        # Capture, analysis, history and alerts; the overlay only drives it and shows the results
+        self.engine = AnalysisEngine(CONFIG)
+        self.history_manager = self.engine.history_manager
+        self.alert_engine = self.engine.alert_engine
+        self.frame_archive = self.engine.frame_archive
+        self.pipeline = self.engine.pipeline
         self.initUI()
         self.capture_region = None
+        # Named regions replace the single capture_region when any are defined
+        self.regions = self.engine.regions
+        self.region_texts = {}
+        self.on_region_selected = None  # set while a named region is being selected
         self.is_capturing = False
         self.origin = None
         self.current = None
-        self.system_prompt = "describe the image"
         self.is_paused = False
-        self.alert_prompt = ""
-        self.alert_active = False
-        self.current_image = None
         self.analysis_results = []
         self.is_selecting_region = False  # New flag to track region selection state
         self.analysis_paused = False  # New flag to control analysis
@@ -308,32 +139,37 @@ class TransparentOverlay(QMainWindow):
         self.end_point = None
         self.buttons_visible = True  # New attribute to track button visibility
         self.hide_during_screenshot = True  # New attribute to control overlay visibility during screenshots
-        self.history_manager = HistoryManager()
         # Add new attributes for timer functionality
         self.timer_start = None
         self.timer_end = None
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.check_timer)
         self.timer.start(60000)  # Check every minute
-        self.backend = "koboldcpp"  # Default backend
-        self.ollama_model = "minicpm-v"  # Default Ollama model
         self.initUI()
 
-        # Create a directory for saved screenshots
-        self.screenshot_dir = "saved_screenshots"
-        os.makedirs(self.screenshot_dir, exist_ok=True)
-
         self.analysis_thread = QThread()
-        self.analysis_worker = AnalysisWorker()
+        self.analysis_worker = AnalysisWorker(self.engine)
         self.analysis_worker.moveToThread(self.analysis_thread)
         self.analysis_thread.started.connect(self.analysis_worker.run_analysis)
-        self.analysis_worker.analysis_complete.connect(self.update_text)
+        self.analysis_worker.analysis_complete.connect(self.show_analysis)
+        self.analysis_worker.region_analysis_complete.connect(self.show_region_analysis)
+        self.analysis_worker.partial_result.connect(self.show_partial_text)
+        self.analysis_worker.analysis_cancelled.connect(self.show_cancelled)
         self.analysis_worker.alert_triggered.connect(self.trigger_alert)
         self.analysis_worker.error_occurred.connect(self.handle_error)
         self.analysis_worker.request_screenshot.connect(self.take_screenshot)
-        
-        self.analysis_worker.set_overlay(self)
+        self.analysis_worker.schedule_changed.connect(self.update_schedule)
+        self.engine.active_check = self.analysis_active
         self.analysis_thread.start()
+        self.engine.warm_up()
+
+        self.capture_timer = QTimer(self)
+        self.capture_timer.timeout.connect(self.capture_tick)
+        self.capture_timer.start(int(CONFIG["capture_interval"] * 1000))
+        self.status_label.setText(f"Capturing every {CONFIG['capture_interval']:.1f}s")
+        if len(self.regions):
+            self.update_region_timer()
+        QTimer.singleShot(0, self.capture_tick)
 
 
 
@@ -355,6 +191,12 @@ class TransparentOverlay(QMainWindow):
         self.label.setFont(QFont('Arial', 12))
         self.label.setWordWrap(True)
         main_layout.addWidget(self.label)
+
+        # Shows the current capture interval and why the scheduler chose it
+        self.status_label = QLabel(self)
+        self.status_label.setStyleSheet("color: lightgray; background-color: rgba(0, 0, 0, 128); padding: 2px 10px;")
+        self.status_label.setFont(QFont('Arial', 9))
+        main_layout.addWidget(self.status_label)
         
         self.button_widget = QWidget(self)
         self.button_layout = QFlowLayout(self.button_widget)
@@ -381,6 +223,8 @@ class TransparentOverlay(QMainWindow):
             ("Pause", self.toggle_pause_resume),
             ("Save Results", self.save_results),
             ("Set Alert", self.set_alert_prompt),
+            ("Alert Rules", self.show_alert_rules_dialog),
+            ("Regions", self.show_regions_dialog),
             ("Resize Overlay", self.resize_overlay),
             ("Toggle Hide", self.toggle_hide_during_screenshot)  # New button
         ]
@@ -438,7 +282,64 @@ class TransparentOverlay(QMainWindow):
         # Automatically save the analysis to history
         self.history_manager.add_analysis(text, self.system_prompt)
 
+    @property
+    def system_prompt(self):
+        return self.engine.system_prompt
+
+    @system_prompt.setter
+    def system_prompt(self, prompt):
+        if prompt != self.engine.system_prompt:
+            self.engine.cancel_analysis("prompt changed")
+        self.engine.system_prompt = prompt
+
+    @property
+    def backend(self):
+        return self.engine.backend
+
+    @backend.setter
+    def backend(self, backend):
+        if backend != self.engine.backend:
+            self.engine.cancel_analysis("backend changed")
+        self.engine.backend = backend
+
+    @property
+    def ollama_model(self):
+        return self.engine.ollama_model
+
+    @ollama_model.setter
+    def ollama_model(self, model):
+        if model != self.engine.ollama_model:
+            self.engine.cancel_analysis("model changed")
+        self.engine.ollama_model = model
+
+    @pyqtSlot(str, object)
+    def show_analysis(self, text, frame_id):
+        # The engine has already saved the analysis to history
+        self.label.setText(text)
+        self.analysis_results.append(text)
+
+    @pyqtSlot(str, str, str, object)
+    def show_region_analysis(self, name, text, prompt, frame_id):
+        self.region_texts[name] = text
+        self.label.setText("\n\n".join(f"[{region}] {description}" for region, description in self.region_texts.items()))
+        self.analysis_results.append(f"[{name}] {text}")
+
+    @pyqtSlot(str)
+    def show_partial_text(self, text):
+        # Text still being generated is only displayed; update_text stores the final result
+        self.label.setText(text)
+
+    @pyqtSlot(str)
+    def show_cancelled(self, reason):
+        # Replace the partial text of the abandoned request with the last finished description
+        if self.region_texts:
+            self.label.setText("\n\n".join(f"[{region}] {description}" for region, description in self.region_texts.items()))
+        elif self.analysis_results:
+            self.label.setText(self.analysis_results[-1])
+
     def show_history_dialog(self):
+        # Make sure the latest results are visible in the dialog
+        self.history_manager.flush()
         dialog = QDialog(self)
         dialog.setWindowTitle("Analysis History")
         dialog.setMinimumSize(600, 400)  # Set a minimum size for better usability
@@ -449,40 +350,28 @@ class TransparentOverlay(QMainWindow):
         search_box.setPlaceholderText("Search history...")
         layout.addWidget(search_box)
 
-        # Add list widget to display history
-        list_widget = QListWidget(dialog)
-        layout.addWidget(list_widget)
+        # The list loads history a page at a time as it is scrolled
+        model = HistoryListModel(self.history_manager, parent=dialog)
+        list_view = QListView(dialog)
+        list_view.setUniformItemSizes(True)  # lets the view skip measuring every row
+        list_view.setModel(model)
+        layout.addWidget(list_view)
 
-        # Function to update the list widget
-        def update_list(query=''):
-            list_widget.clear()
-            if query:
-                history = self.history_manager.search_history(query)
-            else:
-                history = self.history_manager.get_history()
-            for item in history:
-                list_widget.addItem(f"{item[1]}: {item[2][:50]}...")
-
-        # Connect search box to update function
-        search_box.textChanged.connect(update_list)
+        # Searches run in the background once typing pauses; results fill the list as they arrive
+        search_controller = HistorySearchController(self.history_manager, model, parent=dialog)
+        search_box.textChanged.connect(search_controller.set_query)
 
         # Function to open selected analysis
-        def open_analysis(item):
-            selected_text = item.text()
-            parts = selected_text.split(":")  # Split the string into parts
-            timestamp = parts[0] + ":" + parts[1] + ":" + parts[2]  # Reconstruct the timestamp
-            print(timestamp)
-            full_analysis = self.history_manager.get_analysis_by_timestamp(timestamp)
+        def open_analysis(index):
+            full_analysis = self.history_manager.get_analysis(index.data(HistoryListModel.IdRole))
             if full_analysis:
                 self.show_analysis_detail(full_analysis)
 
-        # Connect list widget item click to open_analysis function
-        list_widget.itemClicked.connect(open_analysis)
-
-        # Initial population of the list
-        update_list()
+        # Connect list item click to open_analysis function
+        list_view.clicked.connect(open_analysis)
 
         dialog.exec_()
+        search_controller.close()
 
     def show_analysis_detail(self, analysis):
         detail_dialog = QDialog(self)
@@ -516,6 +405,24 @@ class TransparentOverlay(QMainWindow):
         analysis_text.setReadOnly(True)
         content_layout.addWidget(analysis_text)
 
+        # The archived capture is only read from disk when asked for
+        frame_id = analysis[4] if len(analysis) > 4 else None
+        if frame_id is not None and self.frame_archive is not None:
+            frame_button = QPushButton("Show Screenshot", detail_dialog)
+            frame_label = QLabel(detail_dialog)
+            content_layout.addWidget(frame_button)
+            content_layout.addWidget(frame_label)
+
+            def show_frame():
+                image = self.frame_archive.load(frame_id)
+                if image is None:
+                    frame_label.setText("The screenshot is no longer in the archive.")
+                else:
+                    frame_label.setPixmap(pil_to_pixmap(image).scaledToWidth(760, Qt.SmoothTransformation))
+                frame_button.hide()
+
+            frame_button.clicked.connect(show_frame)
+
         detail_dialog.exec_()
 
     def show_export_dialog(self):
@@ -523,29 +430,121 @@ class TransparentOverlay(QMainWindow):
         dialog.setWindowTitle("Export History")
         layout = QVBoxLayout(dialog)
 
-        json_button = QPushButton("Export as JSON", dialog)
-        csv_button = QPushButton("Export as CSV", dialog)
-
-        layout.addWidget(json_button)
-        layout.addWidget(csv_button)
-
-        def export_json():
-            filename, _ = QFileDialog.getSaveFileName(self, "Save JSON", "", "JSON Files (*.json)")
-            if filename:
-                self.history_manager.export_to_json(filename)
-                QMessageBox.information(self, "Export Successful", f"Data exported to {filename}")
-
-        def export_csv():
-            filename, _ = QFileDialog.getSaveFileName(self, "Save CSV", "", "CSV Files (*.csv)")
-            if filename:
-                self.history_manager.export_to_csv(filename)
-                QMessageBox.information(self, "Export Successful", f"Data exported to {filename}")
+        # Format and compression; the file name suffix is chosen to match
+        format_combo = QComboBox(dialog)
+        for label, fmt in (("JSON", "json"), ("JSON Lines", "jsonl"), ("CSV", "csv")):
+            format_combo.addItem(label, fmt)
+        compression_combo = QComboBox(dialog)
+        for compression in available_compressions():
+            compression_combo.addItem(compression or "No compression", compression)
+        layout.addWidget(QLabel("Format:"))
+        layout.addWidget(format_combo)
+        layout.addWidget(compression_combo)
+
+        # Optional filters
+        date_check = QCheckBox("Only entries between", dialog)
+        start_edit = QDateTimeEdit(QDateTime.currentDateTime().addDays(-7), dialog)
+        end_edit = QDateTimeEdit(QDateTime.currentDateTime(), dialog)
+        for edit in (start_edit, end_edit):
+            edit.setCalendarPopup(True)
+            edit.setEnabled(False)
+            date_check.toggled.connect(edit.setEnabled)
+        date_layout = QHBoxLayout()
+        date_layout.addWidget(date_check)
+        date_layout.addWidget(start_edit)
+        date_layout.addWidget(QLabel("and"))
+        date_layout.addWidget(end_edit)
+        layout.addLayout(date_layout)
+        prompt_filter = QLineEdit(dialog)
+        prompt_filter.setPlaceholderText("Only entries whose prompt contains...")
+        layout.addWidget(prompt_filter)
+
+        progress_bar = QProgressBar(dialog)
+        progress_bar.setValue(0)
+        layout.addWidget(progress_bar)
+
+        export_button = QPushButton("Export...", dialog)
+        cancel_button = QPushButton("Close", dialog)
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(export_button)
+        button_layout.addWidget(cancel_button)
+        layout.addLayout(button_layout)
+
+        export = {}  # the running export's thread and worker
+
+        def finish_export():
+            export["thread"].quit()
+            export["thread"].wait()
+            export.clear()
+            export_button.setEnabled(True)
+            cancel_button.setText("Close")
+
+        def on_progress(written, total):
+            progress_bar.setMaximum(max(total, 1))
+            progress_bar.setValue(written)
+
+        def on_finished(written):
+            if not export:
+                return
+            filename = export["worker"].filename
+            finish_export()
+            if written is None:
+                progress_bar.setValue(0)
+                return
+            progress_bar.setValue(progress_bar.maximum())
+            QMessageBox.information(self, "Export Successful", f"{written} entries exported to {filename}")
+
+        def on_failed(message):
+            if not export:
+                return
+            finish_export()
+            QMessageBox.warning(self, "Export Failed", message)
+
+        def start_export():
+            fmt = format_combo.currentData()
+            compression = compression_combo.currentData()
+            suffix = "." + fmt + {None: "", "gzip": ".gz", "zstd": ".zst"}[compression]
+            filename, _ = QFileDialog.getSaveFileName(self, "Export History", "history" + suffix,
+                                                      f"{format_combo.currentText()} (*{suffix})")
+            if not filename:
+                return
+            if not filename.lower().endswith(suffix):
+                filename += suffix
+            options = {"fmt": fmt, "compression": compression, "prompt": prompt_filter.text().strip() or None}
+            if date_check.isChecked():
+                options["start"] = start_edit.dateTime().toPyDateTime()
+                options["end"] = end_edit.dateTime().toPyDateTime()
+
+            thread = QThread(dialog)
+            worker = ExportWorker(self.history_manager, filename, **options)
+            worker.moveToThread(thread)
+            thread.started.connect(worker.run)
+            worker.progress.connect(on_progress)
+            worker.export_finished.connect(on_finished)
+            worker.export_failed.connect(on_failed)
+            export.update(thread=thread, worker=worker)
+            export_button.setEnabled(False)
+            cancel_button.setText("Cancel")
+            progress_bar.setValue(0)
+            thread.start()
+
+        def cancel_or_close():
+            if export:
+                export["worker"].cancel()
+            else:
+                dialog.reject()
 
-        json_button.clicked.connect(export_json)
-        csv_button.clicked.connect(export_csv)
+        export_button.clicked.connect(start_export)
+        cancel_button.clicked.connect(cancel_or_close)
 
         dialog.exec_()
-    
+        # Closing the dialog while an export runs cancels it
+        if export:
+            export["worker"].cancel()
+            export["thread"].quit()
+            export["thread"].wait()
+            export.clear()
+
     @pyqtSlot(str, str)
     def trigger_alert(self, alert_prompt, analysis_text):
         QTimer.singleShot(0, lambda: self._show_alert(alert_prompt, analysis_text))
@@ -565,9 +564,11 @@ class TransparentOverlay(QMainWindow):
         self.update_text(f"An error occurred: {error_message}")
 
     def closeEvent(self, event):
+        self.capture_timer.stop()
         self.analysis_worker.stop()
         self.analysis_thread.quit()
         self.analysis_thread.wait()
+        self.engine.close()
         super().closeEvent(event)
     
 
@@ -577,6 +578,8 @@ class TransparentOverlay(QMainWindow):
         self.pause_resume_button.setText(button_text)  # Update button text
         status = "paused" if self.is_paused else "resumed"
         self.update_text(f"Capture and analysis {status}")
+        if self.is_paused:
+            self.engine.cancel_analysis("paused")
         
         if not self.is_paused:
             self.is_selecting_region = False
@@ -621,6 +624,8 @@ class TransparentOverlay(QMainWindow):
         toggle_pause_action = context_menu.addAction("Pause/Resume")
         save_results_action = context_menu.addAction("Save Results")
         set_alert_action = context_menu.addAction("Set Alert Condition")
+        alert_rules_action = context_menu.addAction("Alert Rules")
+        regions_action = context_menu.addAction("Regions")
         clear_alert_action = context_menu.addAction("Clear Alert")
         resize_action = context_menu.addAction("Resize Overlay")
         toggle_hide = context_menu.addAction("Toggle Hide")
@@ -641,6 +646,10 @@ class TransparentOverlay(QMainWindow):
             self.save_results()
         elif action == set_alert_action:
             self.set_alert_prompt()
+        elif action == alert_rules_action:
+            self.show_alert_rules_dialog()
+        elif action == regions_action:
+            self.show_regions_dialog()
         elif action == clear_alert_action:
             self.clear_alert()
         elif action == resize_action:
@@ -685,14 +694,21 @@ class TransparentOverlay(QMainWindow):
     
     def region_select_release(self, event):
         self.end_point = event.pos()
-        if self.start_point and self.end_point:
+        if self.start_point and self.end_point and self.on_region_selected is not None:
+            callback, self.on_region_selected = self.on_region_selected, None
+            callback(QRect(self.start_point, self.end_point).normalized())
+        elif self.start_point and self.end_point:
             self.capture_region = QRect(self.start_point, self.end_point).normalized()
+            self.engine.capture_box = self.screen_box(self.capture_region)
+            self.engine.cancel_analysis("capture region changed")
             logging.info(f"Region selected: {self.capture_region}")
             self.update_text(f"Region selected: {self.capture_region}")
         self.is_selecting_region = False
         self.analysis_paused = False
         self.select_window.close()
         self.show()
+        # Frames of the old region are no longer of interest
+        self.pipeline.flush()
         self.trigger_analysis()
 
 
@@ -731,27 +747,164 @@ class TransparentOverlay(QMainWindow):
         prompt, ok = QInputDialog.getText(self, 'Set Alert Prompt', 
                                           'Enter alert condition (e.g., "Can you see birds?"):')
         if ok and prompt:
-            self.alert_prompt = prompt
-            self.alert_active = True
-            self.update_text(f"Alert set for condition: {self.alert_prompt}")
+            self.alert_engine.add_rule(alerts.AlertRule("Alert", prompt))
+            self.update_text(f"Alert set for condition: {prompt}")
         elif ok:
-            self.alert_prompt = ""
-            self.alert_active = False
+            self.alert_engine.remove_rule("Alert")
             self.update_text("Alert cleared")
 
     def clear_alert(self):
-        self.alert_prompt = ""
-        self.alert_active = False
-        self.update_text("Alert condition cleared")
+        self.alert_engine.clear()
+        self.update_text("Alert conditions cleared")
 
-    def check_alert_condition(self, image, analysis_text):
-        check_prompt = f"Based on the image and the following analysis, determine if the condition '{self.alert_prompt}' is met. Respond with only 'Yes' or 'No'.\n\nImage analysis: {analysis_text}"
-        
-        response = analyze_image_with_koboldcpp(image, check_prompt)
-        
-        if response.strip().lower() == 'yes':
-            self.trigger_alert(analysis_text)
+    def show_alert_rules_dialog(self):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Alert Rules")
+        dialog.setMinimumSize(600, 300)
+        layout = QVBoxLayout(dialog)
+
+        # Each row shows the rule's condition, pre-filters and evaluation statistics
+        list_widget = QListWidget(dialog)
+        layout.addWidget(list_widget)
+
+        def update_list():
+            list_widget.clear()
+            for rule in self.alert_engine.active_rules():
+                filters = []
+                if rule.keywords:
+                    filters.append(f"keywords: {', '.join(rule.keywords)}")
+                if rule.pattern:
+                    filters.append(f"pattern: {rule.pattern.pattern}")
+                if rule.min_change:
+                    filters.append(f"min change: {rule.min_change}")
+                list_widget.addItem(f"{rule.label()} [{'; '.join(filters) or 'no pre-filter'}]\n    {rule.stats_text()}")
+
+        def add_rule():
+            rule_dialog = QDialog(dialog)
+            rule_dialog.setWindowTitle("Add Alert Rule")
+            form = QVBoxLayout(rule_dialog)
+            inputs = {}
+            for key, label in [("name", "Name:"), ("condition", "Condition (e.g. \"Can you see birds?\"):"),
+                               ("keywords", "Only check when the description contains one of (comma-separated):"),
+                               ("pattern", "Only check when the description matches regex:")]:
+                form.addWidget(QLabel(label))
+                inputs[key] = QLineEdit(rule_dialog)
+                form.addWidget(inputs[key])
+            form.addWidget(QLabel("Only check when the frame changed by more than (hash bits, 0 = always):"))
+            min_change_input = QSpinBox(rule_dialog)
+            min_change_input.setRange(0, 256)
+            form.addWidget(min_change_input)
+            button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+            button_box.accepted.connect(rule_dialog.accept)
+            button_box.rejected.connect(rule_dialog.reject)
+            form.addWidget(button_box)
+
+            if rule_dialog.exec_() != QDialog.Accepted:
+                return
+            condition = inputs["condition"].text().strip()
+            name = inputs["name"].text().strip() or condition
+            if not condition:
+                return
+            keywords = [keyword.strip() for keyword in inputs["keywords"].text().split(',')]
+            try:
+                rule = alerts.AlertRule(name, condition, keywords=keywords, pattern=inputs["pattern"].text() or None,
+                                        min_change=min_change_input.value())
+            except re.error as e:
+                QMessageBox.warning(self, "Invalid Pattern", f"The regular expression is invalid: {e}")
+                return
+            self.alert_engine.add_rule(rule)
+            self.update_text(f"Alert rule added: {rule.label()}")
+            update_list()
+
+        def remove_rule():
+            row = list_widget.currentRow()
+            rules = self.alert_engine.active_rules()
+            if 0 <= row < len(rules):
+                self.alert_engine.remove_rule(rules[row].name)
+                self.update_text(f"Alert rule removed: {rules[row].name}")
+                update_list()
+
+        button_row = QHBoxLayout()
+        for text, slot in [("Add Rule", add_rule), ("Remove Rule", remove_rule), ("Close", dialog.accept)]:
+            button = QPushButton(text, dialog)
+            button.clicked.connect(slot)
+            button_row.addWidget(button)
+        layout.addLayout(button_row)
+
+        update_list()
+        dialog.exec_()
+
+    def show_regions_dialog(self):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Capture Regions")
+        dialog.setMinimumSize(500, 300)
+        layout = QVBoxLayout(dialog)
+        layout.addWidget(QLabel("Named regions are captured together and analyzed with their own prompts.\n"
+                                "While any are defined they replace the single selected region."))
+
+        list_widget = QListWidget(dialog)
+        layout.addWidget(list_widget)
+
+        def update_list():
+            list_widget.clear()
+            for region in self.regions.all():
+                list_widget.addItem(f"{region.label()}\n    {region.prompt or '(overlay prompt)'}")
+
+        def add_region():
+            # The region is drawn on screen after the dialog closes
+            dialog.accept()
+            self.on_region_selected = self.add_named_region
+            self.select_region()
+
+        def remove_region():
+            row = list_widget.currentRow()
+            current = self.regions.all()
+            if 0 <= row < len(current):
+                self.regions.remove(current[row].name)
+                self.region_texts.pop(current[row].name, None)
+                self.update_text(f"Region removed: {current[row].name}")
+                self.regions_changed()
+                update_list()
+
+        button_row = QHBoxLayout()
+        for text, slot in [("Add Region", add_region), ("Remove Region", remove_region), ("Close", dialog.accept)]:
+            button = QPushButton(text, dialog)
+            button.clicked.connect(slot)
+            button_row.addWidget(button)
+        layout.addLayout(button_row)
+
+        update_list()
+        dialog.exec_()
 
+    def add_named_region(self, rect):
+        """
+        :param rect: Selected QRect, relative to the primary screen
+        """
+        box = self.screen_box(rect)
+        name, ok = QInputDialog.getText(self, "Region Name", "Name for this region:")
+        if not ok or not name.strip():
+            return
+        prompt, ok = QInputDialog.getText(self, "Region Prompt", "Prompt (leave empty to use the overlay prompt):")
+        if not ok:
+            return
+        interval, ok = QInputDialog.getDouble(self, "Region Interval", "Seconds between captures:",
+                                              CONFIG["capture_interval"], 0.5, 3600, 1)
+        if not ok:
+            return
+        region = regions.CaptureRegion(name.strip(), box, prompt=prompt.strip() or None, interval=interval)
+        self.regions.add(region)
+        logging.info(f"Region added: {region.label()}")
+        self.update_text(f"Region added: {region.label()}")
+        self.regions_changed()
+
+    def regions_changed(self):
+        self.engine.cancel_analysis("regions changed")
+        if len(self.regions):
+            self.update_region_timer()
+        else:
+            self.region_texts.clear()
+            self.capture_timer.setInterval(int(CONFIG["capture_interval"] * 1000))
+            self.status_label.setText(f"Capturing every {CONFIG['capture_interval']:.1f}s")
 
     def show_timer_dialog(self):
         dialog = QDialog(self)
@@ -802,9 +955,69 @@ class TransparentOverlay(QMainWindow):
                 if not self.is_paused:
                     self.toggle_pause_resume()
                     self.update_text("Analysis paused due to timer")
+                # Keep the model loaded shortly before the window opens
+                start = datetime.combine(datetime.now().date(), self.timer_start)
+                if start <= datetime.now():
+                    start += timedelta(days=1)
+                self.engine.keep_warm((start - datetime.now()).total_seconds())
 
 
 
+    def analysis_active(self):
+        current_time = datetime.now().time()
+        return (not self.is_paused and
+                not self.analysis_paused and
+                (not self.timer_start or
+                 (self.timer_start <= current_time < self.timer_end)))
+
+    def update_region_timer(self):
+        # With named regions the timer only checks which regions are due; each has its own interval
+        interval = self.regions.tick_interval()
+        self.capture_timer.setInterval(int(interval * 1000))
+        self.status_label.setText(f"Watching {len(self.regions)} regions, checking every {interval:.1f}s")
+
+    @pyqtSlot(float, str)
+    def update_schedule(self, interval, reason):
+        if len(self.regions):
+            return
+        # setInterval restarts the timer, so the next capture is `interval` seconds after this frame
+        self.capture_timer.setInterval(int(interval * 1000))
+        self.status_label.setText(f"Capturing every {interval:.1f}s: {reason}")
+
+    def capture_tick(self):
+        if not self.analysis_active():
+            return
+        if len(self.regions):
+            due = self.regions.due(time.monotonic())
+            if due:
+                self.take_region_screenshot(due)
+        else:
+            self.take_screenshot()
+
+    def screen_box(self, rect):
+        """
+        :param rect: QRect relative to the primary screen
+        :return: (left, top, right, bottom) in screen coordinates
+        """
+        screen_geometry = QApplication.primaryScreen().geometry()
+        return (rect.left() + screen_geometry.left(), rect.top() + screen_geometry.top(),
+                rect.right() + screen_geometry.left(), rect.bottom() + screen_geometry.top())
+
+    def take_region_screenshot(self, due):
+        if self.is_selecting_region:
+            return
+        if self.hide_during_screenshot:
+            self.hide()
+        QApplication.processEvents()
+        try:
+            # One grab of the area covering every due region; the pipeline crops the regions from it
+            self.engine.capture_regions(due)
+        except Exception as e:
+            logging.error(f"Error taking screenshot: {str(e)}")
+        finally:
+            if self.hide_during_screenshot:
+                self.show()
+
     @pyqtSlot()
     def take_screenshot(self):
         if self.is_selecting_region:
@@ -816,46 +1029,14 @@ class TransparentOverlay(QMainWindow):
         QApplication.processEvents()  # Ensure the hide takes effect
 
         try:
-            if self.capture_region and not self.is_selecting_region:
-                # Convert QRect to screen coordinates
-                screen = QApplication.primaryScreen()
-                screen_geometry = screen.geometry()
-                left = self.capture_region.left() + screen_geometry.left()
-                top = self.capture_region.top() + screen_geometry.top()
-                right = self.capture_region.right() + screen_geometry.left()
-                bottom = self.capture_region.bottom() + screen_geometry.top()
-
-                # Use ImageGrab for screen capture
-                img = ImageGrab.grab(bbox=(left, top, right, bottom))
-                logging.info(f"Screenshot taken of selected region: {left},{top},{right},{bottom}")
-            else:
-                img = ImageGrab.grab()
-                logging.info("Full screen screenshot taken")
-
-            if self.hide_during_screenshot:
-                self.show()  # Show the overlay immediately after taking the screenshot
-
-            # Save the full-size screenshot
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"screenshot_{timestamp}.png"
-            filepath = os.path.join(self.screenshot_dir, filename)
-            img.save(filepath)
-            logging.info(f"Screenshot saved: {filepath}")  
-            
-            self.current_image = resize_image(img)
-            
-            if self.current_image.getbbox() is None:
-                logging.warning("Captured image is empty")
-            else:
-                logging.info(f"Captured image size: {self.current_image.size}")
+            # Grabs the selected region, or the full screen when none is selected
+            self.engine.capture(self.engine.capture_box)
 
         except Exception as e:
             logging.error(f"Error taking screenshot: {str(e)}")
-            self.current_image = None
         finally:
             if self.hide_during_screenshot:
                 self.show()  # Show the overlay again only if it was hidden
-            self.analysis_worker.screenshot_taken.emit()
 
     def show_backend_dialog(self):
         dialog = QDialog(self)
@@ -864,14 +1045,25 @@ class TransparentOverlay(QMainWindow):
 
         koboldcpp_radio = QRadioButton("KoboldCPP", dialog)
         ollama_radio = QRadioButton("Ollama", dialog)
+        pool_radio = QRadioButton(f"Pool ({len(CONFIG['backend_endpoints'])} servers)", dialog)
+        pool_radio.setEnabled(bool(CONFIG["backend_endpoints"]))
         
         if self.backend == "koboldcpp":
             koboldcpp_radio.setChecked(True)
+        elif self.backend == "pool":
+            pool_radio.setChecked(True)
         else:
             ollama_radio.setChecked(True)
 
         layout.addWidget(koboldcpp_radio)
         layout.addWidget(ollama_radio)
+        layout.addWidget(pool_radio)
+
+        pool = self.engine.clients.get("pool")
+        if pool is not None:
+            stats_label = QLabel("\n".join(format_endpoint_stats(stats) for stats in pool.stats()), dialog)
+            stats_label.setWordWrap(True)
+            layout.addWidget(stats_label)
 
         # Add Ollama model selection
         ollama_model_label = QLabel("Ollama Model:")
@@ -885,14 +1077,17 @@ class TransparentOverlay(QMainWindow):
         layout.addWidget(button_box)
 
         if dialog.exec_() == QDialog.Accepted:
+            previous = (self.backend, self.ollama_model)
             if koboldcpp_radio.isChecked():
                 self.backend = "koboldcpp"
             else:
-                self.backend = "ollama"
+                self.backend = "pool" if pool_radio.isChecked() else "ollama"
                 self.ollama_model = ollama_model_input.text()
             self.update_text(f"Backend set to: {self.backend}")
-            if self.backend == "ollama":
+            if self.backend != "koboldcpp":
                 self.update_text(f"Ollama model set to: {self.ollama_model}")
+            if (self.backend, self.ollama_model) != previous:
+                self.engine.warm_up("backend change")
             
 
 class QFlowLayout(QLayout):
@@ -1003,22 +1198,23 @@ class QFlowLayout(QLayout):
     
 
 def capture_and_analyze(overlay):
+    client = create_backend_client("koboldcpp", CONFIG)
+    capture_backend = create_capture_backend(CONFIG["capture_backend"])
     while True:
         if not overlay.is_paused:
             if overlay.capture_region and not overlay.is_capturing:
-                screenshot = pyautogui.screenshot(region=(
+                screenshot = capture_backend.grab((
                     overlay.capture_region.x(),
                     overlay.capture_region.y(),
-                    overlay.capture_region.width(),
-                    overlay.capture_region.height()
+                    overlay.capture_region.x() + overlay.capture_region.width(),
+                    overlay.capture_region.y() + overlay.capture_region.height()
                 ))
             else:
-                screenshot = pyautogui.screenshot()
+                screenshot = capture_backend.grab()
             
             resized_image = resize_image(screenshot)
-            overlay.current_image = resized_image  # Store the current image
             
-            description = analyze_image_with_koboldcpp(resized_image, overlay.system_prompt)
+            description = client.analyze(resized_image, overlay.system_prompt)
             overlay.update_text(description)
         time.sleep(5)
 
@@ -1030,9 +1226,6 @@ def main():
     overlay = TransparentOverlay()
     overlay.show()
 
-    # Ensure the analysis worker is properly connected
-    overlay.analysis_worker.set_overlay(overlay)
-    
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
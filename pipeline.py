@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+from collections import deque
+
+
+class Frame:
+    """A captured screenshot on its way through the pipeline."""
+
+    def __init__(self, seq, raw_image, captured_at, region=None, regions=None):
+        self.seq = seq
+        self.raw_image = raw_image  # full-size grab, released after preprocessing unless the pipeline keeps it
+        self.captured_at = captured_at  # datetime of the grab
+        self.region = region  # (left, top, right, bottom) in screen coordinates, None for full screen
+        # Named regions cropped from this grab: [(CaptureRegion, box within raw_image)], None for a single region
+        self.regions = regions
+        self.region_images = None  # [(image, image_base64)] per named region, None for blank crops
+        self.image = None  # preprocessed image that is sent to the model
+        self.image_base64 = None  # self.image encoded for the backend request
+        self.is_empty = False  # True when the grab came back blank; computed once during preprocessing
+        self.path = None  # where the full-size screenshot was saved as a PNG
+        self.frame_id = None  # FrameArchive id when captures are archived instead
+        self.luma = None  # full-resolution luminance array for dirty-tile detection
+        self.ready_at = None  # time.monotonic() when preprocessing finished
+
+
+class FrameQueue:
+    """
+    Bounded, thread-safe queue between two pipeline stages. When it is full, put() never
+    blocks: with the "drop_oldest" policy the oldest waiting frame is discarded to make room,
+    with "drop_newest" the incoming frame is discarded instead.
+    """
+    POLICIES = ("drop_oldest", "drop_newest")
+
+    def __init__(self, maxsize=1, policy="drop_oldest", name="frames"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue overflow policy: {policy}")
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.name = name
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.woken = False
+        self.dropped = 0
+
+    def put(self, item):
+        """
+        :return: False if the item was dropped
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.items) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == "drop_newest":
+                    logging.info(f"{self.name} queue full, dropping newest frame (dropped {self.dropped})")
+                    return False
+                self.items.popleft()
+                logging.info(f"{self.name} queue full, dropping oldest frame (dropped {self.dropped})")
+            self.items.append(item)
+            self.cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Block until an item is available.
+        :return: The oldest item, or None on timeout, after wake() or once the queue is closed
+        """
+        with self.cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self.items and not self.closed and not self.woken:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            self.woken = False
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+    def wake(self):
+        # Make a blocked get() return None so the consumer can handle other work
+        with self.cond:
+            self.woken = True
+            self.cond.notify_all()
+
+    def clear(self):
+        with self.cond:
+            self.items.clear()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.items.clear()
+            self.cond.notify_all()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
+
+
+class CapturePipeline:
+    """
+    Connects the capture, preprocess and inference stages:
+
+        capture (GUI thread) -> capture_queue -> preprocess workers -> frame_queue -> inference
+
+    Captures are handed off immediately, so grabbing and preprocessing the next frame overlap
+    with inference of the current one. Both queues are bounded; when the backend is slower than
+    capture, frames are dropped according to the overflow policy instead of piling up.
+    """
+
+    def __init__(self, preprocess, workers=2, capture_queue_size=2, frame_queue_size=1,
+                 overflow_policy="drop_oldest", keep_raw_images=False):
+        """
+        :param preprocess: Callable taking a Frame and filling in its image; runs on the worker pool
+        :param keep_raw_images: Pass the full-size grab on to inference, e.g. to crop changed areas from it
+        """
+        self.preprocess = preprocess
+        self.keep_raw_images = keep_raw_images
+        self.capture_queue = FrameQueue(capture_queue_size, overflow_policy, name="Capture")
+        self.frame_queue = FrameQueue(frame_queue_size, overflow_policy, name="Inference")
+        self.seq = 0
+        self.last_delivered_seq = -1
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(max(1, workers)):
+            worker = threading.Thread(target=self._preprocess_loop, name=f"preprocess-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, raw_image, captured_at, region=None, regions=None):
+        with self.lock:
+            self.seq += 1
+            frame = Frame(self.seq, raw_image, captured_at, region, regions)
+        self.capture_queue.put(frame)
+        return frame
+
+    def _preprocess_loop(self):
+        while True:
+            frame = self.capture_queue.get()
+            if frame is None:
+                return  # queue closed
+            try:
+                self.preprocess(frame)
+            except Exception as e:
+                logging.error(f"Error preprocessing frame {frame.seq}: {str(e)}")
+                frame.raw_image = None
+                continue
+            if not self.keep_raw_images:
+                frame.raw_image = None
+            frame.ready_at = time.monotonic()
+            with self.lock:
+                # With several workers a newer frame may already have been delivered
+                if frame.seq < self.last_delivered_seq:
+                    logging.info(f"Discarding out-of-date frame {frame.seq}")
+                    continue
+                self.last_delivered_seq = frame.seq
+            self.frame_queue.put(frame)
+
+    def next_frame(self, timeout=None):
+        """
+        Wait for the next preprocessed frame. The caller wakes as soon as one is queued.
+        :return: Frame, or None on timeout, wake() or after close()
+        """
+        return self.frame_queue.get(timeout)
+
+    def wake(self):
+        self.frame_queue.wake()
+
+    def flush(self):
+        # Drop frames that were captured under settings that no longer apply
+        self.capture_queue.clear()
+        self.frame_queue.clear()
+
+    def close(self):
+        self.capture_queue.close()
+        self.frame_queue.close()
+        for worker in self.workers:
+            worker.join(timeout=5)
@@ -0,0 +1,110 @@
+import base64
+import io
+
+from PIL import Image
+
+
+RESAMPLE_FILTERS = {
+    "nearest": Image.NEAREST,
+    "box": Image.BOX,
+    "bilinear": Image.BILINEAR,
+    "hamming": Image.HAMMING,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
+
+
+class PreprocessSettings:
+    """
+    How captures are shrunk and encoded before they are sent to the model.
+    :param max_pixels: Pixel budget; larger images are scaled down keeping the aspect ratio
+    :param resample: Name of the final resampling filter, see RESAMPLE_FILTERS
+    :param reducing_gap: Pre-shrink by an integer factor with Image.reduce until the image is at most
+        reducing_gap times the target size, then apply the resampling filter. 1.0 shrinks as far as
+        possible first (fastest); None always uses the filter on the full image (slowest, highest quality).
+    :param image_format: "JPEG", "WEBP" or "PNG"
+    :param quality: JPEG/WebP quality 1-100
+    :param subsampling: JPEG chroma subsampling, "4:4:4", "4:2:2" or "4:2:0"
+    :param grayscale: Convert to grayscale first; often enough for text-heavy screens and cheaper to process
+    """
+
+    def __init__(self, max_pixels=1_800_000, resample="lanczos", reducing_gap=1.0, image_format="JPEG",
+                 quality=75, subsampling="4:2:0", grayscale=False, webp_method=4):
+        if resample not in RESAMPLE_FILTERS:
+            raise ValueError(f"Unknown resampling filter: {resample}")
+        self.max_pixels = max_pixels
+        self.resample = resample
+        self.reducing_gap = reducing_gap
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.subsampling = subsampling
+        self.grayscale = grayscale
+        self.webp_method = webp_method
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_pixels=config["max_pixels"],
+                   resample=config["resample"],
+                   reducing_gap=config["reducing_gap"],
+                   image_format=config["image_format"],
+                   quality=config["image_quality"],
+                   subsampling=config["jpeg_subsampling"],
+                   grayscale=config["grayscale"])
+
+
+DEFAULT_SETTINGS = PreprocessSettings()
+
+
+def resize_image(image, settings=DEFAULT_SETTINGS):
+    """
+    Resize the image if it exceeds the pixel budget while maintaining aspect ratio.
+    :param image: PIL Image object
+    :return: Resized PIL Image object if necessary, otherwise the original image
+    """
+    if settings.grayscale and image.mode != 'L':
+        # Converting first means the resize only has one channel to filter
+        image = image.convert('L')
+
+    # Calculate current number of pixels
+    current_pixels = image.width * image.height
+
+    # If the image is already small enough, return it as is
+    if current_pixels <= settings.max_pixels:
+        return image
+
+    # Calculate the scale factor needed to reduce to the pixel budget
+    scale_factor = (settings.max_pixels / current_pixels) ** 0.5
+
+    # Calculate new dimensions, ensuring we round down
+    new_width = max(1, int(image.width * scale_factor))
+    new_height = max(1, int(image.height * scale_factor))
+
+    return image.resize((new_width, new_height), RESAMPLE_FILTERS[settings.resample],
+                        reducing_gap=settings.reducing_gap)
+
+
+def encode_image(image, settings=DEFAULT_SETTINGS):
+    """
+    Encode the image in the configured format.
+    :return: io.BytesIO positioned at the end of the encoded data
+    """
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    buffered = io.BytesIO()
+    if settings.image_format == "JPEG":
+        image.save(buffered, format="JPEG", quality=settings.quality, subsampling=settings.subsampling)
+    elif settings.image_format == "WEBP":
+        image.save(buffered, format="WEBP", quality=settings.quality, method=settings.webp_method)
+    else:
+        image.save(buffered, format=settings.image_format)
+    return buffered
+
+
+def encode_image_to_base64(image, settings=DEFAULT_SETTINGS):
+    # getbuffer() exposes the encoded bytes without the copy getvalue() would make
+    buffer = encode_image(image, settings).getbuffer()
+    try:
+        return base64.b64encode(buffer).decode('ascii')
+    finally:
+        buffer.release()
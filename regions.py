@@ -0,0 +1,128 @@
+import logging
+import re
+import threading
+
+
+REGION_ANSWER_PATTERN = re.compile(r'^[\s*#]*REGION\s*(\d+)\s*\**\s*:\s*\**', re.IGNORECASE | re.MULTILINE)
+
+
+class CaptureRegion:
+    """
+    A named part of the screen that is analyzed on its own schedule.
+    :param box: (left, top, right, bottom) in screen coordinates
+    :param prompt: Prompt for this region; None uses the overlay's prompt
+    :param interval: Seconds between captures of this region; None uses capture_interval
+    """
+
+    def __init__(self, name, box, prompt=None, interval=None, enabled=True):
+        self.name = name
+        self.box = tuple(int(value) for value in box)
+        self.prompt = prompt
+        self.interval = interval
+        self.enabled = enabled
+        self.next_due = 0.0  # time.monotonic() of the next capture
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], data["box"], prompt=data.get("prompt"), interval=data.get("interval"),
+                   enabled=data.get("enabled", True))
+
+    def label(self):
+        left, top, right, bottom = self.box
+        interval = f"every {self.interval:g}s" if self.interval else "default interval"
+        return f"{self.name}: {right - left}x{bottom - top} at {left},{top}, {interval}"
+
+
+class RegionSet:
+    """
+    The named capture regions and when each of them is next due. Regions can be edited from
+    the GUI thread while the analysis thread reads them.
+    """
+
+    def __init__(self, regions=(), default_interval=5.0):
+        self.default_interval = default_interval
+        self.regions = {}
+        self.lock = threading.Lock()
+        for region in regions:
+            self.add(region)
+
+    @classmethod
+    def from_config(cls, region_dicts, default_interval):
+        regions = []
+        for data in region_dicts:
+            try:
+                regions.append(CaptureRegion.from_dict(data))
+            except (KeyError, TypeError, ValueError) as e:
+                logging.error(f"Invalid capture region {data!r}: {e}")
+        return cls(regions, default_interval)
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for region in self.regions.values() if region.enabled)
+
+    def add(self, region):
+        with self.lock:
+            self.regions[region.name] = region
+
+    def remove(self, name):
+        with self.lock:
+            return self.regions.pop(name, None)
+
+    def clear(self):
+        with self.lock:
+            self.regions.clear()
+
+    def all(self):
+        with self.lock:
+            return list(self.regions.values())
+
+    def interval_of(self, region):
+        return region.interval or self.default_interval
+
+    def tick_interval(self):
+        """Shortest region interval: how often the capture timer has to check for due regions."""
+        with self.lock:
+            intervals = [self.interval_of(region) for region in self.regions.values() if region.enabled]
+        return min(intervals) if intervals else self.default_interval
+
+    def due(self, now):
+        """
+        Regions due at `now` (time.monotonic()); their next capture is scheduled straight away.
+        """
+        with self.lock:
+            due = [region for region in self.regions.values() if region.enabled and region.next_due <= now]
+            for region in due:
+                region.next_due = now + self.interval_of(region)
+        return due
+
+
+def union_box(boxes):
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+def build_batch_prompt(items):
+    """
+    One prompt for several region crops sent in the same request.
+    :param items: (region name, prompt) per attached image, in attachment order
+    """
+    tasks = "\n".join(f"{i}. Image {i} ({name}): {prompt}" for i, (name, prompt) in enumerate(items, 1))
+    return (f"{len(items)} images are attached, each showing a different part of the screen. "
+            f"Answer the task for each image separately. Start each answer on its own line with "
+            f"'REGION <number>:' and do not mix up the images.\n{tasks}")
+
+
+def split_region_answers(response, count):
+    """
+    Split a response to build_batch_prompt into the per-image answers.
+    :return: {index (0-based): answer} for the images the model answered
+    """
+    matches = list(REGION_ANSWER_PATTERN.finditer(response))
+    answers = {}
+    for match, following in zip(matches, matches[1:] + [None]):
+        index = int(match.group(1)) - 1
+        end = following.start() if following is not None else len(response)
+        text = response[match.end():end].strip()
+        if 0 <= index < count and text:
+            answers[index] = text
+    return answers
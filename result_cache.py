@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+
+from frame_change import dhash, hamming_distance
+from history import connect_db
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over integer hashes using Hamming distance, so near-duplicate
+    lookups only visit the branches that can contain a match instead of scanning every entry.
+    """
+
+    def __init__(self):
+        # Each node is [hash, set of entry ids, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value, entry_id):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, {entry_id}, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].add(entry_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, {entry_id}, {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """
+        :return: List of (distance, entry_id) within max_distance of value, nearest first
+        """
+        matches = []
+        if self.root is None:
+            return matches
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, entry_id) for entry_id in node[1])
+            # Triangle inequality: only children within [d - max, d + max] can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        matches.sort()
+        return matches
+
+
+class ResultCache:
+    """
+    Persistent cache of analysis results keyed by (perceptual image hash, prompt, backend, model).
+    Lives in the same SQLite database as the analysis history. Entries are evicted least recently
+    used first once max_entries is exceeded, and entries older than max_age seconds are dropped.
+    Each thread keeps one connection, opened like HistoryManager's so cache writes wait for the
+    history writer's commits instead of failing with "database is locked". Call close() on shutdown.
+    """
+
+    def __init__(self, db_path='analysis_history.db', max_entries=5000, max_age=7 * 24 * 3600, max_distance=4):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_distance = max_distance
+        self.trees = {}  # (prompt, backend, model) -> BKTree
+        self.entries = {}  # entry id -> (key, image hash)
+        self.live_counts = {}  # key -> number of live entries in its tree
+        self.hits = 0
+        self.misses = 0
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.init_db()
+        self.load_index()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False only so close() can close it; each connection is used by one thread
+            conn = self.local.conn = connect_db(self.db_path, check_same_thread=False)
+            with self.connections_lock:
+                self.connections.append(conn)
+        return conn
+
+    def close(self):
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+
+    def init_db(self):
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS result_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                image_hash TEXT,
+                prompt TEXT,
+                backend TEXT,
+                model TEXT,
+                analysis_text TEXT,
+                created_at REAL,
+                last_used_at REAL,
+                hit_count INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_result_cache_last_used ON result_cache (last_used_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_result_cache_created ON result_cache (created_at)')
+        conn.commit()
+
+    def load_index(self):
+        self.evict()
+        cursor = self.connection().cursor()
+        cursor.execute('SELECT id, image_hash, prompt, backend, model FROM result_cache')
+        for entry_id, image_hash, prompt, backend, model in cursor:
+            self._index(entry_id, int(image_hash, 16), (prompt, backend, model))
+        logging.info(f"Result cache loaded with {len(self.entries)} entries")
+
+    def _index(self, entry_id, image_hash, key):
+        tree = self.trees.get(key)
+        if tree is None:
+            tree = self.trees[key] = BKTree()
+        tree.add(image_hash, entry_id)
+        self.entries[entry_id] = (key, image_hash)
+        self.live_counts[key] = self.live_counts.get(key, 0) + 1
+
+    def _rebuild_tree(self, key):
+        # BK-trees do not support removal, so evicted ids are skipped during lookups
+        # and the tree is rebuilt once most of its ids are stale
+        tree = BKTree()
+        for entry_id, (entry_key, image_hash) in self.entries.items():
+            if entry_key == key:
+                tree.add(image_hash, entry_id)
+        if tree.size:
+            self.trees[key] = tree
+        else:
+            self.trees.pop(key, None)
+            self.live_counts.pop(key, None)
+
+    @staticmethod
+    def image_hash(image):
+        return dhash(image, hash_size=8)
+
+    def lookup(self, image_hash, prompt, backend, model):
+        """
+        :return: Cached analysis text of the nearest matching frame, or None on a miss
+        """
+        key = (prompt, backend, model or '')
+        tree = self.trees.get(key)
+        if tree is not None:
+            for distance, entry_id in tree.search(image_hash, self.max_distance):
+                if entry_id not in self.entries:
+                    continue
+                analysis_text = self._touch(entry_id)
+                if analysis_text is not None:
+                    self.hits += 1
+                    logging.info(f"Result cache hit (distance {distance}, hits {self.hits}, misses {self.misses})")
+                    return analysis_text
+        self.misses += 1
+        return None
+
+    def _touch(self, entry_id):
+        now = time.time()
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT analysis_text, created_at FROM result_cache WHERE id = ?', (entry_id,))
+        row = cursor.fetchone()
+        if row is None or (self.max_age and now - row[1] >= self.max_age):
+            self.evict()
+            return None
+        with conn:
+            conn.execute('UPDATE result_cache SET last_used_at = ?, hit_count = hit_count + 1 WHERE id = ?',
+                         (now, entry_id))
+        return row[0]
+
+    def store(self, image_hash, prompt, backend, model, analysis_text):
+        now = time.time()
+        key = (prompt, backend, model or '')
+        conn = self.connection()
+        with conn:
+            cursor = conn.execute('INSERT INTO result_cache (image_hash, prompt, backend, model, analysis_text, '
+                                  'created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (f'{image_hash:x}', key[0], key[1], key[2], analysis_text, now, now))
+        entry_id = cursor.lastrowid
+        self._index(entry_id, image_hash, key)
+        if len(self.entries) > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        now = time.time()
+        cutoff = now - self.max_age if self.max_age else float('-inf')
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM result_cache WHERE created_at < ?', (cutoff,))
+        evicted = [row[0] for row in cursor.fetchall()]
+        cursor.execute('SELECT COUNT(*) FROM result_cache WHERE created_at >= ?', (cutoff,))
+        remaining = cursor.fetchone()[0]
+        if remaining > self.max_entries:
+            # Trim to 90% of the limit so eviction does not run on every store
+            cursor.execute('SELECT id FROM result_cache WHERE created_at >= ? ORDER BY last_used_at ASC LIMIT ?',
+                           (cutoff, remaining - int(self.max_entries * 0.9)))
+            evicted.extend(row[0] for row in cursor.fetchall())
+        if evicted:
+            cursor.executemany('DELETE FROM result_cache WHERE id = ?', [(entry_id,) for entry_id in evicted])
+            conn.commit()
+
+        touched_keys = set()
+        for entry_id in evicted:
+            entry = self.entries.pop(entry_id, None)
+            if entry is not None:
+                touched_keys.add(entry[0])
+                self.live_counts[entry[0]] -= 1
+        for key in touched_keys:
+            tree = self.trees.get(key)
+            if tree is not None and self.live_counts[key] < tree.size // 2:
+                self._rebuild_tree(key)
+        if evicted:
+            logging.info(f"Result cache evicted {len(evicted)} entries")
@@ -0,0 +1,261 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+_STOP = object()
+
+
+class RetentionPolicy:
+    """
+    Limits on how many saved screenshots are kept. Any limit can be None for no limit.
+    :param max_bytes: Total size of all screenshots
+    :param max_count: Number of screenshots
+    :param max_age: Seconds; older screenshots are deleted
+    :param downsampling: List of (age, spacing) pairs in seconds: screenshots older than age are thinned
+        to at most one per spacing, e.g. [(3600, 60), (86400, 3600)] keeps everything from the last hour,
+        one per minute for the rest of the day and one per hour before that
+    """
+
+    def __init__(self, max_bytes=None, max_count=None, max_age=None, downsampling=()):
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.max_age = max_age
+        # Levels must get coarser with age: a screenshot reaches level i only after level i - 1
+        self.downsampling = sorted((float(age), float(spacing)) for age, spacing in downsampling)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_bytes=config["screenshot_max_bytes"],
+                   max_count=config["screenshot_max_count"],
+                   max_age=config["screenshot_max_age"],
+                   downsampling=config["screenshot_downsampling"] or ())
+
+
+class RetentionManager:
+    """
+    Enforces a RetentionPolicy on the screenshot directory and trims the analysis history.
+
+    Saved screenshots are recorded in a small index table (path, capture time, size) as they are
+    written, so enforcing the limits never lists or stats the directory; the directory is only
+    scanned once, to index screenshots saved before the index existed. A background thread
+    applies the limits every `interval` seconds, deleting at most `batch_size` files per pass so
+    a large backlog is worked off gradually instead of in one long stall.
+    """
+
+    def __init__(self, policy, screenshot_dir, db_path='analysis_history.db', history_manager=None,
+                 history_max_rows=None, history_max_age=None, interval=60.0, batch_size=500, archive=None):
+        """
+        :param history_manager: HistoryManager whose rows are trimmed to history_max_rows / history_max_age (seconds)
+        :param archive: FrameArchive held to the policy's max_bytes and max_age by dropping whole segments
+        """
+        self.policy = policy
+        self.archive = archive
+        self.screenshot_dir = screenshot_dir
+        self.db_path = db_path
+        self.history_manager = history_manager
+        self.history_max_rows = history_max_rows
+        self.history_max_age = history_max_age
+        self.interval = interval
+        self.batch_size = batch_size
+        self.total_bytes = 0
+        self.total_count = 0
+        self.records = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name="retention", daemon=True)
+        self.worker.start()
+
+    @classmethod
+    def from_config(cls, config, screenshot_dir, history_manager, archive=None):
+        return cls(RetentionPolicy.from_config(config), screenshot_dir, history_manager.db_path, history_manager,
+                   history_max_rows=config["history_max_rows"],
+                   history_max_age=config["history_max_age"],
+                   interval=config["retention_interval"],
+                   batch_size=config["retention_batch_size"],
+                   archive=archive)
+
+    def record(self, path, captured_at, size=None):
+        """
+        Add a newly saved screenshot to the index. Safe to call from any thread.
+        :param captured_at: datetime of the capture
+        :param size: File size in bytes; looked up when None
+        """
+        if size is None:
+            size = os.path.getsize(path)
+        self.records.put((path, captured_at.timestamp(), size))
+
+    def close(self):
+        if self.worker.is_alive():
+            self.records.put(_STOP)
+            self.worker.join()
+
+    def init_db(self, conn):
+        """
+        :return: True if the index was just created and existing screenshots still need to be indexed
+        """
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'screenshots'").fetchone()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS screenshots (
+                    path TEXT PRIMARY KEY,
+                    captured_at REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    level INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_screenshots_captured_at ON screenshots (captured_at)')
+            # level = how many downsampling steps the screenshot has survived
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_screenshots_level ON screenshots (level, captured_at)')
+        return exists is None
+
+    def import_directory(self, conn):
+        """One-time indexing of screenshots saved before the index existed."""
+        rows = []
+        try:
+            with os.scandir(self.screenshot_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.startswith('screenshot_'):
+                        stat = entry.stat()
+                        rows.append((entry.path, stat.st_mtime, stat.st_size))
+        except FileNotFoundError:
+            return
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO screenshots (path, captured_at, size) VALUES (?, ?, ?)', rows)
+        logging.info(f"Indexed {len(rows)} existing screenshots in {self.screenshot_dir}")
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        if self.init_db(conn):
+            self.import_directory(conn)
+        self.total_count, self.total_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM screenshots').fetchone()
+
+        next_pass = time.monotonic()
+        stopping = False
+        while not stopping:
+            rows = []
+            try:
+                item = self.records.get(timeout=max(0.0, next_pass - time.monotonic()))
+                while True:
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    rows.append(item)
+                    item = self.records.get_nowait()
+            except queue.Empty:
+                pass
+            if rows:
+                self._insert(conn, rows)
+            if not stopping and time.monotonic() >= next_pass:
+                try:
+                    deleted = self.enforce(conn)
+                except (sqlite3.Error, OSError) as e:
+                    logging.error(f"Retention pass failed: {e}")
+                    deleted = 0
+                # A full batch means there is a backlog; keep working it off in small steps
+                next_pass = time.monotonic() + (1.0 if deleted >= self.batch_size else self.interval)
+        conn.close()
+
+    def _insert(self, conn, rows):
+        with conn:
+            for path, captured_at, size in rows:
+                if conn.execute('INSERT OR IGNORE INTO screenshots (path, captured_at, size) VALUES (?, ?, ?)',
+                                (path, captured_at, size)).rowcount:
+                    self.total_count += 1
+                    self.total_bytes += size
+
+    def _delete(self, conn, rows):
+        """
+        :param rows: (path, size) pairs
+        """
+        for path, _ in rows:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with conn:
+            conn.executemany('DELETE FROM screenshots WHERE path = ?', [(path,) for path, _ in rows])
+        self.total_count -= len(rows)
+        self.total_bytes -= sum(size for _, size in rows)
+        return len(rows)
+
+    def enforce(self, conn, now=None):
+        """
+        One retention pass: age limit, downsampling, then the count and size limits (oldest first).
+        Also drops old frame archive segments and asks the history manager to trim old history rows.
+        :return: Number of screenshots deleted, at most batch_size
+        """
+        now = time.time() if now is None else now
+        policy = self.policy
+        budget = self.batch_size
+        deleted = 0
+
+        if policy.max_age:
+            rows = conn.execute('SELECT path, size FROM screenshots WHERE captured_at < ? ORDER BY captured_at LIMIT ?',
+                                (now - policy.max_age, budget)).fetchall()
+            deleted += self._delete(conn, rows)
+
+        for level, (age, spacing) in enumerate(policy.downsampling, 1):
+            if deleted >= budget:
+                break
+            deleted += self.downsample(conn, level, now - age, spacing, budget - deleted)
+
+        excess = 0
+        if policy.max_count and self.total_count > policy.max_count:
+            excess = self.total_count - policy.max_count
+        if deleted < budget and excess:
+            rows = conn.execute('SELECT path, size FROM screenshots ORDER BY captured_at LIMIT ?',
+                                (min(excess, budget - deleted),)).fetchall()
+            deleted += self._delete(conn, rows)
+
+        if deleted < budget and policy.max_bytes and self.total_bytes > policy.max_bytes:
+            cursor = conn.execute('SELECT path, size FROM screenshots ORDER BY captured_at')
+            over, rows = self.total_bytes - policy.max_bytes, []
+            while over > 0 and len(rows) < budget - deleted:
+                row = cursor.fetchone()
+                if row is None:
+                    break
+                rows.append(row)
+                over -= row[1]
+            cursor.close()
+            deleted += self._delete(conn, rows)
+
+        if self.archive is not None and (policy.max_bytes or policy.max_age):
+            self.archive.drop_segments(policy.max_bytes, policy.max_age, now)
+
+        if deleted:
+            logging.info(f"Retention: deleted {deleted} screenshots, {self.total_count} kept "
+                         f"({self.total_bytes / 1024 ** 2:.1f} MB)")
+        if self.history_manager is not None and (self.history_max_rows or self.history_max_age):
+            self.history_manager.prune(max_rows=self.history_max_rows, max_age=self.history_max_age,
+                                       limit=self.batch_size)
+        return deleted
+
+    def downsample(self, conn, level, cutoff, spacing, budget):
+        """
+        Thin screenshots captured before cutoff that are still at level - 1 to one per spacing seconds.
+        Survivors move to `level`, so each screenshot is looked at once per downsampling step.
+        :return: Number of screenshots deleted
+        """
+        rows = conn.execute('SELECT path, captured_at, size FROM screenshots WHERE level = ? AND captured_at < ? '
+                            'ORDER BY captured_at LIMIT ?', (level - 1, cutoff, budget)).fetchall()
+        keep, drop = [], []
+        last_bucket = None
+        for path, captured_at, size in rows:
+            if spacing <= 0:
+                keep.append(path)
+                continue
+            bucket = int(captured_at // spacing)
+            if bucket != last_bucket:
+                # A screenshot kept in an earlier pass may already represent this bucket
+                taken = conn.execute('SELECT 1 FROM screenshots WHERE level >= ? AND captured_at >= ? AND captured_at < ? '
+                                     'LIMIT 1', (level, bucket * spacing, (bucket + 1) * spacing)).fetchone()
+                last_bucket = bucket
+                if taken is None:
+                    keep.append(path)
+                    continue
+            drop.append((path, size))
+        with conn:
+            conn.executemany('UPDATE screenshots SET level = ? WHERE path = ?', [(level, path) for path in keep])
+        return self._delete(conn, drop)
@@ -0,0 +1,68 @@
+import logging
+import threading
+from collections import deque
+
+
+class AdaptiveScheduler:
+    """
+    Chooses the time between captures from how busy the screen is and how long the backend takes.
+
+    - Each changed frame halves the interval, so the overlay catches up quickly once the screen is active.
+    - Each unchanged frame multiplies it by idle_backoff, up to a target set by the recent change rate.
+    - It never goes below the latency floor: average inference time / target_duty_cycle, which keeps
+      the share of time the GPU spends on this app at or below target_duty_cycle.
+    - The result is always clamped to [min_interval, max_interval].
+    """
+
+    def __init__(self, initial_interval=5.0, min_interval=1.0, max_interval=30.0, target_duty_cycle=0.5,
+                 idle_backoff=1.5, history=10):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.target_duty_cycle = min(max(target_duty_cycle, 0.01), 1.0)
+        self.idle_backoff = idle_backoff
+        self.latencies = deque(maxlen=history)
+        self.changes = deque(maxlen=history)
+        self.interval = self._clamp(initial_interval)
+        self.reason = "initial interval"
+        self.lock = threading.Lock()
+
+    def _clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def record_inference(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def record_frame(self, changed):
+        """
+        Update the interval after a frame was checked for changes.
+        :return: (interval in seconds, human readable reason)
+        """
+        with self.lock:
+            self.changes.append(bool(changed))
+            change_rate = sum(self.changes) / len(self.changes)
+            avg_latency = sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+            latency_floor = avg_latency / self.target_duty_cycle
+
+            # The busier the screen has been recently, the closer the target is to min_interval
+            activity_target = self.max_interval - (self.max_interval - self.min_interval) * change_rate
+            if changed:
+                interval = min(activity_target, self.interval / 2)
+                reason = f"screen active (change rate {change_rate:.0%})"
+            else:
+                interval = min(activity_target, self.interval * self.idle_backoff)
+                reason = f"screen idle (change rate {change_rate:.0%}), backing off"
+
+            if interval < latency_floor:
+                interval = latency_floor
+                reason = (f"limited by backend latency {avg_latency:.1f}s "
+                          f"(target GPU duty cycle {self.target_duty_cycle:.0%})")
+
+            clamped = self._clamp(interval)
+            if clamped != interval:
+                reason += ", at " + ("minimum" if clamped == self.min_interval else "maximum") + " interval"
+            if abs(clamped - self.interval) >= 0.05:
+                logging.info(f"Capture interval {self.interval:.1f}s -> {clamped:.1f}s: {reason}")
+            self.interval = clamped
+            self.reason = reason
+            return self.interval, self.reason